@@ -0,0 +1,163 @@
+"""
+深度 → XYZ 逆投影のベンチマーク
+
+deproject.py（NumPy + 視線グリッドのキャッシュ）を
+  - librealsense の rs2_deproject_pixel_to_point をそのまま移した 1 画素ずつの参照実装（精度確認）
+  - rs.pointcloud（pyrealsense2 がある場合。software_device に合成深度を流す）
+と比較する。カメラは不要。
+
+使い方:
+  python3 bench/bench_deproject.py
+  python3 bench/bench_deproject.py --intrinsics <session_dir>/intrinsics.json
+  python3 bench/bench_deproject.py --iters 200 --model brown_conrady
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from deproject import ray_grid, deproject_image, deproject_points, distortion_model
+
+RESOLUTIONS = [(640, 480), (1280, 720)]
+
+
+def _intrinsics(w, h, model):
+    """D4xx の color に近い合成内部パラメータ。"""
+    coeffs = [0.0] * 5 if model == 'none' else [-0.055, 0.065, 0.0008, -0.0004, -0.02]
+    return {'width': w, 'height': h, 'fx': 0.95 * w, 'fy': 0.95 * w,
+            'ppx': w / 2 - 3.2, 'ppy': h / 2 + 1.7,
+            'model': f'distortion.{model}', 'coeffs': coeffs, 'depth_scale': 0.001}
+
+
+def _synthetic_depth(w, h, rng):
+    yy, xx = np.mgrid[0:h, 0:w]
+    depth = 300 + 900 * (xx / w) * (0.5 + 0.5 * yy / h) + rng.normal(0, 3, size=(h, w))
+    depth[rng.random((h, w)) < 0.08] = 0
+    return depth.astype(np.uint16)
+
+
+def rs2_deproject_pixel_to_point(intr, u, v, depth):
+    """librealsense rsutil.h の 1 画素版（比較用の参照実装）。"""
+    c = intr['coeffs']
+    model = distortion_model(intr)
+    x = (u - intr['ppx']) / intr['fx']
+    y = (v - intr['ppy']) / intr['fy']
+    xo, yo = x, y
+    if model in ('brown_conrady', 'inverse_brown_conrady'):
+        for _ in range(10):
+            r2 = x * x + y * y
+            icdist = 1 / (1 + ((c[4] * r2 + c[1]) * r2 + c[0]) * r2)
+            xq, yq = (x / icdist, y / icdist) if model == 'inverse_brown_conrady' else (x, y)
+            dx = 2 * c[2] * xq * yq + c[3] * (r2 + 2 * xq * xq)
+            dy = 2 * c[3] * xq * yq + c[2] * (r2 + 2 * yq * yq)
+            x = (xo - dx) * icdist
+            y = (yo - dy) * icdist
+    return depth * x, depth * y, depth
+
+
+def _rs_pointcloud(intr, model):
+    """software_device + rs.pointcloud。pyrealsense2 が無ければ None。"""
+    try:
+        import pyrealsense2 as rs
+    except ImportError:
+        return None
+    w, h = intr['width'], intr['height']
+    rs_intr = rs.intrinsics()
+    rs_intr.width, rs_intr.height = w, h
+    rs_intr.fx, rs_intr.fy, rs_intr.ppx, rs_intr.ppy = intr['fx'], intr['fy'], intr['ppx'], intr['ppy']
+    rs_intr.model  = getattr(rs.distortion, model)
+    rs_intr.coeffs = list(intr['coeffs'])
+
+    dev    = rs.software_device()
+    sensor = dev.add_sensor('Depth')
+    vs = rs.video_stream()
+    vs.type, vs.index, vs.uid = rs.stream.depth, 0, 0
+    vs.width, vs.height, vs.fps, vs.bpp = w, h, 30, 2
+    vs.fmt, vs.intrinsics = rs.format.z16, rs_intr
+    profile = sensor.add_video_stream(vs)
+    sensor.add_read_only_option(rs.option.depth_units, intr['depth_scale'])
+    q = rs.frame_queue(4, keep_frames=True)
+    sensor.open(profile)
+    sensor.start(q)
+    pc = rs.pointcloud()
+    counter = [0]
+
+    def run(depth):
+        f = rs.software_video_frame()
+        f.pixels, f.bpp, f.stride = depth, 2, w * 2
+        counter[0] += 1
+        f.timestamp, f.frame_number = counter[0] * 33.3, counter[0]
+        f.domain  = rs.timestamp_domain.hardware_clock
+        f.profile = profile.as_video_stream_profile()
+        sensor.on_video_frame(f)
+        points = pc.calculate(q.wait_for_frame())
+        return np.asanyarray(points.get_vertices()).view(np.float32).reshape(h, w, 3).copy()
+
+    return run
+
+
+def _time(fn, iters):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - t0) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='深度 → XYZ 逆投影のベンチマーク')
+    parser.add_argument('--iters', type=int, default=100, help='計測回数')
+    parser.add_argument('--model', default='inverse_brown_conrady',
+                        choices=['none', 'brown_conrady', 'inverse_brown_conrady'],
+                        help='合成内部パラメータの歪みモデル')
+    parser.add_argument('--intrinsics', type=str, default=None, metavar='JSON',
+                        help='実際の intrinsics.json を使う（その解像度だけ計測）')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.intrinsics:
+        with open(args.intrinsics) as f:
+            cases = [json.load(f)]
+    else:
+        cases = [_intrinsics(w, h, args.model) for w, h in RESOLUTIONS]
+
+    for intr in cases:
+        w, h  = intr['width'], intr['height']
+        model = distortion_model(intr)
+        depth = _synthetic_depth(w, h, rng)
+        print(f"{w}x{h}  model={model}  coeffs={intr['coeffs']}")
+
+        t0 = time.perf_counter()
+        ray_grid(intr)
+        print(f"  視線グリッド作成（初回のみ）     {(time.perf_counter() - t0) * 1000:8.2f} ms")
+        print(f"  deproject_image  (H, W, 3)       {_time(lambda: deproject_image(depth, intr), args.iters):8.2f} ms")
+        print(f"  deproject_points (有効点のみ)    "
+              f"{_time(lambda: deproject_points(depth, intr, max_depth=1.0), args.iters):8.2f} ms")
+
+        # 参照実装との差（ランダムな 2000 画素）
+        xyz = deproject_image(depth, intr)
+        scale = intr.get('depth_scale', 0.001)
+        us = rng.integers(0, w, 2000)
+        vs = rng.integers(0, h, 2000)
+        ref = np.array([rs2_deproject_pixel_to_point(intr, u, v, depth[v, u] * scale)
+                        for u, v in zip(us, vs)])
+        err = np.abs(xyz[vs, us] - ref).max()
+        print(f"  参照実装（rsutil）との最大差     {err * 1000:8.4f} mm")
+
+        rs_run = _rs_pointcloud(intr, model)
+        if rs_run is None:
+            print("  rs.pointcloud                    pyrealsense2 が無いため省略")
+        else:
+            t_rs = _time(lambda: rs_run(depth), args.iters)
+            err  = np.abs(rs_run(depth) - xyz).max()
+            print(f"  rs.pointcloud                    {t_rs:8.2f} ms  (最大差 {err * 1000:.4f} mm)")
+        print()
+
+
+if __name__ == '__main__':
+    main()
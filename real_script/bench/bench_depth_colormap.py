@@ -0,0 +1,70 @@
+"""
+深度カラーマップのマイクロベンチマーク
+
+utils.make_depth_colormap（従来実装）と utils.DepthColormapper（LUT 版）を
+640x480 / 1280x720 の合成深度で比較する。カメラは不要。
+
+使い方:
+  python3 bench/bench_depth_colormap.py
+  python3 bench/bench_depth_colormap.py --iters 500 --update-every 5
+
+出力は 1 フレームあたりの平均時間 (ms) と高速化率。LUT 版の結果が従来実装と
+一致するか（update_every=1 の場合）も確認する。
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils import make_depth_colormap, DepthColormapper
+
+RESOLUTIONS = [(640, 480), (1280, 720)]
+
+
+def _synthetic_depth(w, h, rng):
+    """200〜1500mm の滑らかな面に雑音と欠損（0）を混ぜた深度画像。"""
+    yy, xx = np.mgrid[0:h, 0:w]
+    depth = 200 + 1300 * (xx / w) * (0.5 + 0.5 * yy / h)
+    depth += rng.normal(0, 5, size=(h, w))
+    depth[rng.random((h, w)) < 0.08] = 0
+    return depth.astype(np.uint16)
+
+
+def _time(fn, iters):
+    fn()   # ウォームアップ
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - t0) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='深度カラーマップのベンチマーク')
+    parser.add_argument('--iters', type=int, default=200, help='計測回数')
+    parser.add_argument('--update-every', type=int, default=1, dest='update_every',
+                        help='相対モードの範囲更新間隔（DepthColormapper.update_every）')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'解像度':<10} {'モード':<14} {'従来 (ms)':>10} {'LUT (ms)':>10} "
+          f"{'LUT+out (ms)':>13} {'倍率':>6}  一致")
+    for w, h in RESOLUTIONS:
+        depth = _synthetic_depth(w, h, rng)
+        out   = np.empty((h, w, 3), dtype=np.uint8)
+        for label, alpha in (('alpha=0.4', 0.4), ('relative', None)):
+            mapper = DepthColormapper(alpha, update_every=args.update_every)
+            same = np.array_equal(make_depth_colormap(depth, alpha), mapper.apply(depth))
+
+            t_ref = _time(lambda: make_depth_colormap(depth, alpha), args.iters)
+            t_lut = _time(lambda: mapper.apply(depth), args.iters)
+            t_out = _time(lambda: mapper.apply(depth, out=out), args.iters)
+            print(f"{w}x{h:<6} {label:<14} {t_ref:>10.3f} {t_lut:>10.3f} "
+                  f"{t_out:>13.3f} {t_ref / t_out:>5.1f}x  {'OK' if same else 'NG'}")
+
+
+if __name__ == '__main__':
+    main()
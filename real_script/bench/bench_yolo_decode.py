@@ -0,0 +1,95 @@
+"""
+YOLO 後処理のベンチマーク
+
+vino_yolo_detection_D435.py の旧実装（アンカーごとの Python ループ、NMS なし）と
+yolo_postprocess.decode_yolo_output（NumPy 一括処理 + クラスごとの NMS）を比較する。
+
+使い方:
+  # 実機で記録した生出力を使う（推奨）
+  python3 detect/vino_yolo_detection_D435.py --dump-outputs /tmp/yolo_outputs
+  python3 bench/bench_yolo_decode.py /tmp/yolo_outputs
+
+  # 記録が無い場合は合成出力（1 クラス / 8400 アンカー）
+  python3 bench/bench_yolo_decode.py
+  python3 bench/bench_yolo_decode.py --classes 80
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from yolo_postprocess import decode_yolo_output
+
+
+def legacy_decode(output, threshold=0.3):
+    """旧実装（比較用にそのまま残す）。"""
+    boxes = []
+    if output.ndim == 3:
+        output = output[0]
+    output = output.T
+
+    for row in output:
+        x1, y1, x2, y2, conf = row[:5]   # 多クラス出力でも動くよう先頭 5 要素だけ読む
+        if conf < threshold:
+            continue
+        boxes.append((int(x1), int(y1), int(x2), int(y2), float(conf)))
+    return boxes
+
+
+def _synthetic_outputs(n, classes, anchors, rng):
+    outs = []
+    for _ in range(n):
+        out = np.empty((1, 4 + classes, anchors), dtype=np.float32)
+        out[0, 0:2] = rng.uniform(0, 640, size=(2, anchors))
+        out[0, 2:4] = rng.uniform(8, 120, size=(2, anchors))
+        out[0, 4:]  = rng.beta(0.3, 30, size=(classes, anchors))  # ほとんどが低スコア
+        hit = rng.random(anchors) < 0.02                             # 2% のアンカーに物体
+        out[0, 4 + rng.integers(0, classes, size=hit.sum()), np.flatnonzero(hit)] = \
+            rng.uniform(0.2, 0.95, size=hit.sum())
+        outs.append(out)
+    return outs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YOLO 後処理のベンチマーク')
+    parser.add_argument('outputs', nargs='?', default=None,
+                        help='--dump-outputs で保存した .npy のディレクトリ（省略時は合成出力）')
+    parser.add_argument('--conf', type=float, default=0.3)
+    parser.add_argument('--iou', type=float, default=0.45)
+    parser.add_argument('--classes', type=int, default=1, help='合成出力のクラス数')
+    parser.add_argument('--anchors', type=int, default=8400, help='合成出力のアンカー数')
+    parser.add_argument('--frames', type=int, default=50, help='合成出力のフレーム数')
+    args = parser.parse_args()
+
+    if args.outputs:
+        files = sorted(Path(args.outputs).expanduser().glob('*.npy'))
+        if not files:
+            print(f".npy が見つかりません: {args.outputs}")
+            sys.exit(1)
+        outs = [np.load(f) for f in files]
+        src = f"{args.outputs}（{len(outs)} フレーム）"
+    else:
+        outs = _synthetic_outputs(args.frames, args.classes, args.anchors,
+                                  np.random.default_rng(0))
+        src = f"合成（{args.frames} フレーム, {args.classes} クラス, {args.anchors} アンカー）"
+    print(f"入力: {src}  shape={outs[0].shape}")
+
+    for name, fn in (
+        ('旧実装（Python ループ）', lambda o: legacy_decode(o, args.conf)),
+        ('NumPy + NMS',            lambda o: decode_yolo_output(o, args.conf, args.iou)),
+    ):
+        fn(outs[0])
+        n_boxes = 0
+        t0 = time.perf_counter()
+        for o in outs:
+            n_boxes += len(fn(o))
+        ms = (time.perf_counter() - t0) / len(outs) * 1000
+        print(f"  {name:<24} {ms:8.3f} ms/frame  検出 {n_boxes / len(outs):7.1f} 個/frame")
+
+
+if __name__ == '__main__':
+    main()
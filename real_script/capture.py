@@ -0,0 +1,499 @@
+"""取得スレッドと処理段（consumer）を分離したキャプチャエンジン。
+
+各スクリプトが持っていた wait_for_frames → align.process → get_data → imshow の
+1 スレッドループを、次の 2 層に分ける。
+
+    取得スレッド   : pipeline.wait_for_frames() → FramePacket を各段へ配る
+    consumer 段    : 1 段 = 1 スレッド + 有界キュー。遅い段が取得を止めない
+
+GUI（cv2.imshow / waitKey）はメインスレッドでしか安定しないため、プレビューは
+consumer にせず engine.latest() で最新パケットを取り出して描画する。
+
+    engine = CaptureEngine(pipeline)
+    engine.add(ShotWriter(session, make_shot))
+    engine.start()
+    while True:
+        packet = engine.latest()
+        ...imshow / waitKey...
+    engine.stop()
+    print(engine.report())
+
+位置合わせ（rs.align）は librealsense の処理ブロックの中でも特に重いので、既定の
+align='lazy' では packet.aligned に最初にアクセスしたときだけ実行する。color だけを
+使う推論や、保存しないプレビューのフレームでは一度も align が走らない。
+
+    align='lazy'   : 必要になったフレームだけ位置合わせする（既定）
+    align='always' : 取得スレッドで毎フレーム位置合わせする
+    align='none'   : 位置合わせしない（packet.aligned は frames と同じもの）
+
+filters に DepthFilterChain（config.yaml の depth_filters）を渡すと、取得スレッドで
+align より前に後処理フィルタ（decimation / spatial / temporal / hole_filling など）をかける。
+temporal は連続したフレームを見るので、段ではなく取得スレッドで毎フレームかける。
+decimation で深度の画素数が減る分、その後の align・点群書き出しも軽くなる。
+
+保存系の段（ShotWriter / PointCloudExporter）は engine.recording が立っている間の
+パケットだけを処理する。ショット連番は取得スレッドが packet.shot に振るので、
+同じショットの画像と点群は段が違っても必ず同じ番号になる。
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+import pyrealsense2 as rs
+
+from pointcloud_io import save_points
+from utils import playback_finished
+
+
+class DepthFilterChain:
+    """librealsense の後処理フィルタを順にかける。フィルタごとの処理時間を測る。
+
+    steps は [(名前, 処理ブロック), ...]。process() には frameset を渡してよく、
+    各フィルタは frameset 内の depth だけを処理して frameset を返す（color / IR はそのまま）。
+    """
+
+    def __init__(self, steps):
+        self.steps  = steps
+        self.frames = 0
+        self._sec   = [0.0] * len(steps)
+        self._max   = [0.0] * len(steps)
+
+    def __bool__(self):
+        return bool(self.steps)
+
+    @property
+    def names(self):
+        return [name for name, _ in self.steps]
+
+    def process(self, frames):
+        for i, (_, block) in enumerate(self.steps):
+            t0 = time.perf_counter()
+            frames = block.process(frames)
+            dt = time.perf_counter() - t0
+            self._sec[i] += dt
+            self._max[i]  = max(self._max[i], dt)
+        self.frames += 1
+        return frames.as_frameset() if frames.is_frameset() else frames
+
+    def stats(self):
+        n = max(self.frames, 1)
+        per = {}
+        for (name, _), sec, mx in zip(self.steps, self._sec, self._max):
+            key, k = name, 2
+            while key in per:          # 同じフィルタを 2 回使う場合（disparity など）
+                key, k = f'{name}_{k}', k + 1
+            per[key] = {'avg_ms': round(sec / n * 1000, 3), 'max_ms': round(mx * 1000, 3)}
+        return {'frames': self.frames, 'total_avg_ms': round(sum(self._sec) / n * 1000, 3),
+                'filters': per}
+
+    def report(self):
+        st = self.stats()
+        lines = [f"深度フィルタ: {' → '.join(self.names)}  合計 {st['total_avg_ms']} ms/フレーム"]
+        for name, s in st['filters'].items():
+            lines.append(f"  {name:<14} 平均 {s['avg_ms']:>7} ms  最大 {s['max_ms']:>7} ms")
+        return '\n'.join(lines)
+
+
+# depth_filters.chain の name → 処理ブロック
+_FILTERS = {
+    'decimation':   rs.decimation_filter,
+    'spatial':      rs.spatial_filter,
+    'temporal':     rs.temporal_filter,
+    'hole_filling': rs.hole_filling_filter,
+    'threshold':    rs.threshold_filter,
+    'disparity':    lambda: rs.disparity_transform(True),    # 深度 → 視差
+    'depth':        lambda: rs.disparity_transform(False),   # 視差 → 深度
+}
+
+
+def depth_filter_chain(cfg):
+    """config.yaml の depth_filters から DepthFilterChain を作る。無効なら None。
+
+    chain の各要素は {name: ..., <rs.option 名>: 値, ...}。
+    例: {name: spatial, filter_magnitude: 2, filter_smooth_alpha: 0.5}
+    """
+    fcfg = cfg.get('depth_filters') or {}
+    if not fcfg.get('enabled'):
+        return None
+    steps = []
+    for item in fcfg.get('chain') or []:
+        item = dict(item)
+        name = item.pop('name')
+        if name not in _FILTERS:
+            raise ValueError(f"depth_filters: 未知のフィルタ '{name}'（{', '.join(_FILTERS)}）")
+        block = _FILTERS[name]()
+        for opt, value in item.items():
+            block.set_option(getattr(rs.option, opt), value)
+        steps.append((name, block))
+    return DepthFilterChain(steps) if steps else None
+
+
+class FramePacket:
+    """取得スレッドが各段へ配る 1 フレーム分のデータ。
+
+    frames は keep() 済みなので、段のキューに滞留しても librealsense に回収されない。
+    同じパケットを複数の段が並行して読むため、派生データは memo() で 1 回だけ作る。
+
+    color に位置合わせしても変わるのは depth だけなので、color / IR は常に
+    align 前の frames から取る。位置合わせ済み depth が要るときだけ aligned を使う。
+    """
+
+    def __init__(self, index, frames, aligner=None, shot=None):
+        self.index     = index            # 取得通し番号（1 始まり）
+        self.shot      = shot             # 保存対象ならショット連番、そうでなければ None
+        self.frames    = frames           # align 前の frameset（IR は元解像度のまま）
+        self.timestamp = frames.get_timestamp()   # デバイスのタイムスタンプ (ms)
+        self.received  = time.perf_counter()
+        self._aligner  = aligner
+        self._aligned  = None
+        self._memo     = {}
+        self._lock     = threading.RLock()
+
+    @property
+    def aligned(self):
+        """color に位置合わせ済みの frameset（初回アクセス時に計算）。失敗時は None。"""
+        if self._aligner is None:
+            return self.frames
+        with self._lock:
+            if self._aligned is None:
+                self._aligned = self._aligner(self.frames) or False
+            return self._aligned or None
+
+    def color(self):
+        f = self.frames.get_color_frame()
+        return np.asanyarray(f.get_data()) if f else None
+
+    def depth(self, aligned=True):
+        """aligned=False なら位置合わせせずに生の depth を返す（プレビュー向け）。"""
+        fs = self.aligned if aligned else self.frames
+        f = fs.get_depth_frame() if fs else None
+        return np.asanyarray(f.get_data()) if f else None
+
+    def ir(self, index):
+        f = self.frames.get_infrared_frame(index)
+        return np.asanyarray(f.get_data()) if f else None
+
+    def memo(self, key, fn):
+        """fn(self) の結果をパケット単位でキャッシュする（段をまたいで共有）。"""
+        with self._lock:
+            if key not in self._memo:
+                self._memo[key] = fn(self)
+            return self._memo[key]
+
+
+class Consumer:
+    """CaptureEngine に登録する処理段。process() は段専用のスレッドで呼ばれる。
+
+    drop=True  : キューが満杯なら最も古いパケットを捨てる（プレビュー・推論向け）
+    drop=False : キューが空くまで取得スレッドを待たせる（保存向け。取りこぼしなし）
+    recording_only=True の段は、保存中に振られたパケット（packet.shot あり）だけを受け取る。
+    """
+
+    name           = 'consumer'
+    queue_size     = 2
+    drop           = True
+    recording_only = False
+
+    def process(self, packet):
+        raise NotImplementedError
+
+    def close(self):
+        """停止時に 1 回呼ばれる（ファイルのクローズなど）。"""
+
+
+class FunctionConsumer(Consumer):
+    """関数 1 つを段にする。fn(packet) を呼ぶだけ。"""
+
+    def __init__(self, name, fn, queue_size=2, drop=True, recording_only=False):
+        self.name           = name
+        self.fn             = fn
+        self.queue_size     = queue_size
+        self.drop           = drop
+        self.recording_only = recording_only
+
+    def process(self, packet):
+        self.fn(packet)
+
+
+class ShotWriter(Consumer):
+    """make_shot(packet) が返す {modality: image} を Session に保存する段。
+    Session.start_writer() 済みなら実際の imwrite はさらに FrameWriter のスレッドで行われる。"""
+
+    name           = 'writer'
+    drop           = False
+    recording_only = True
+
+    def __init__(self, session, make_shot, queue_size=8):
+        self.session    = session
+        self.make_shot  = make_shot
+        self.queue_size = queue_size
+        self.saved      = 0
+
+    def process(self, packet):
+        shot = self.make_shot(packet)
+        if shot is not None and self.session.save(packet.shot, shot):
+            self.saved += 1
+
+
+class PointCloudExporter(Consumer):
+    """color にテクスチャマップした点群を書き出す段（fmt: 'ply' / 'npz'。pointcloud_io 参照）。
+
+    点群は位置合わせ済みの depth から作るので、保存する深度画像・intrinsics と同じ color 座標系になる。
+    """
+
+    name           = 'pointcloud'
+    drop           = False
+    recording_only = True
+
+    def __init__(self, session, sub=True, depth_filter=None, queue_size=8, fmt='ply'):
+        self.session      = session
+        self.fmt          = fmt
+        self.sub          = sub
+        self.depth_filter = depth_filter
+        self.queue_size   = queue_size
+        self._pc          = rs.pointcloud()
+        self.saved        = 0
+
+    def process(self, packet):
+        frames = packet.aligned
+        if frames is None:
+            return
+        c_frame = frames.get_color_frame()
+        d_frame = frames.get_depth_frame()
+        if not c_frame or not d_frame:
+            return
+        if self.depth_filter is not None:
+            d_frame = self.depth_filter.process(d_frame)
+        self._pc.map_to(c_frame)
+        points = self._pc.calculate(d_frame)
+        save_points(self.session.path(packet.shot, 'pointcloud', ext=self.fmt, sub=self.sub),
+                    points, c_frame, self.fmt)
+        self.saved += 1
+
+
+class _Stage:
+    """Consumer 1 つ分のスレッドとキュー、計測値。"""
+
+    def __init__(self, consumer, lossless=False):
+        self.consumer  = consumer
+        self.drop      = consumer.drop and not lossless
+        self.queue     = queue.Queue(maxsize=max(1, consumer.queue_size))
+        self.thread    = None
+        self.processed = 0
+        self.dropped   = 0
+        self.waited    = 0
+        self.errors    = 0
+        self.busy_sec  = 0.0
+        self.max_ms    = 0.0
+        self.lag_ms    = 0.0   # 取得から処理完了までの遅れ（累計）
+
+    def offer(self, packet):
+        try:
+            self.queue.put_nowait(packet)
+            return
+        except queue.Full:
+            pass
+        if self.drop:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self.queue.put(packet)
+        else:
+            self.waited += 1
+            self.queue.put(packet)
+
+    def run(self):
+        while True:
+            packet = self.queue.get()
+            try:
+                if packet is None:
+                    return
+                t0 = time.perf_counter()
+                try:
+                    self.consumer.process(packet)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"\n[警告] {self.consumer.name}: {e}")
+                t1 = time.perf_counter()
+                self.processed += 1
+                self.busy_sec  += t1 - t0
+                self.max_ms     = max(self.max_ms, (t1 - t0) * 1000)
+                self.lag_ms    += (t1 - packet.received) * 1000
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        n = max(self.processed, 1)
+        return {
+            'processed': self.processed,
+            'dropped':   self.dropped,
+            'waited':    self.waited,
+            'errors':    self.errors,
+            'avg_ms':    round(self.busy_sec / n * 1000, 2),
+            'max_ms':    round(self.max_ms, 2),
+            'avg_lag_ms': round(self.lag_ms / n, 2),
+        }
+
+
+class CaptureEngine:
+    """専用スレッドでフレームを取得し、登録された段へ配る。
+
+    pipeline は呼び出し側で start() 済みのものを渡す（録画設定などはスクリプトごとに異なるため）。
+    align は 'lazy' / 'always' / 'none'（モジュール docstring 参照）。
+    lossless=True なら drop=True の段も捨てずに取得スレッドを待たせる。--replay fast の .bag 再生では
+    再生が処理を待つので、これで全フレームが全段を通り、結果が毎回同じになる（utils.lossless_replay）。
+    """
+
+    def __init__(self, pipeline, align='lazy', align_to=rs.stream.color, timeout_ms=5000,
+                 filters=None, lossless=False):
+        if align not in ('lazy', 'always', 'none'):
+            raise ValueError(f"align は 'lazy' / 'always' / 'none' のいずれか: {align}")
+        self.pipeline   = pipeline
+        self.filters    = filters
+        self.lossless   = lossless
+        self.timeout_ms = timeout_ms
+        self.align_mode = align
+        self._align     = rs.align(align_to) if align != 'none' else None
+        self._align_lock = threading.Lock()
+        self._stages    = []
+        self._stop      = threading.Event()
+        self._cond      = threading.Condition()
+        self._latest    = None
+        self._thread    = None
+        self.recording  = threading.Event()
+        self.error      = None
+        self.finished   = False   # --source の .bag を最後まで再生した
+        self.acquired   = 0
+        self.shots      = 0
+        self.aligned    = 0
+        self.align_sec  = 0.0
+        self._started   = None
+
+    def add(self, consumer):
+        self._stages.append(_Stage(consumer, self.lossless))
+        return consumer
+
+    def start(self):
+        self._started = time.perf_counter()
+        for stage in self._stages:
+            stage.thread = threading.Thread(target=stage.run, daemon=True,
+                                            name=f'stage-{stage.consumer.name}')
+            stage.thread.start()
+        self._thread = threading.Thread(target=self._acquire, name='acquire', daemon=True)
+        self._thread.start()
+        return self
+
+    def _acquire(self):
+        while not self._stop.is_set():
+            try:
+                frames = self.pipeline.wait_for_frames(self.timeout_ms)
+            except RuntimeError as e:
+                if playback_finished(self.pipeline):
+                    self.finished = True
+                elif not self._stop.is_set():
+                    self.error = e
+                break
+            if self.filters:
+                frames = self.filters.process(frames)
+            frames.keep()
+            aligner = self._align_frames if self._align is not None else None
+
+            self.acquired += 1
+            shot = None
+            if self.recording.is_set():
+                self.shots += 1
+                shot = self.shots
+            packet = FramePacket(self.acquired, frames, aligner, shot=shot)
+            if self.align_mode == 'always' and packet.aligned is None:
+                continue
+
+            with self._cond:
+                self._latest = packet
+                self._cond.notify_all()
+            for stage in self._stages:
+                if shot is None and stage.consumer.recording_only:
+                    continue
+                stage.offer(packet)
+
+        with self._cond:
+            self._cond.notify_all()
+
+    def _align_frames(self, frames):
+        # 処理ブロックは同時に複数スレッドから呼ばない
+        with self._align_lock:
+            t0 = time.perf_counter()
+            aligned = self._align.process(frames)
+            self.align_sec += time.perf_counter() - t0
+            self.aligned   += 1
+        if aligned:
+            aligned.keep()
+        return aligned
+
+    def latest(self, timeout=1.0, after=None):
+        """最新パケットを返す（メインスレッドのプレビュー用）。
+
+        after に前回のパケットを渡すと、それより新しいものが来るまで待つ。
+        取得が止まった（エラー・停止）場合やタイムアウト時は None。
+        """
+        last = after.index if after is not None else 0
+        with self._cond:
+            self._cond.wait_for(
+                lambda: (self._latest is not None and self._latest.index > last)
+                        or not self.running,
+                timeout=timeout)
+            if self._latest is None or self._latest.index <= last:
+                return None
+            return self._latest
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self):
+        """取得を止め、各段のキューを処理し切ってから段を閉じる。"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for stage in self._stages:
+            stage.queue.put(None)
+        for stage in self._stages:
+            if stage.thread is not None:
+                stage.thread.join()
+            stage.consumer.close()
+        if self.error is not None:
+            print(f"\n[警告] フレーム取得が停止しました: {self.error}")
+        elif self.finished:
+            print("\n.bag を最後まで再生しました")
+
+    def stats(self):
+        """metadata.json に記録する段ごとの計測値。"""
+        elapsed = (time.perf_counter() - self._started) if self._started else 0.0
+        return {
+            'acquired':     self.acquired,
+            'shots':        self.shots,
+            'elapsed_sec':  round(elapsed, 2),
+            'acquire_fps':  round(self.acquired / elapsed, 2) if elapsed else 0.0,
+            'align_mode':   self.align_mode,
+            'aligned':      self.aligned,
+            'align_avg_ms': round(self.align_sec / max(self.aligned, 1) * 1000, 2),
+            'depth_filters': self.filters.stats() if self.filters else None,
+            'stages':       {s.consumer.name: s.stats() for s in self._stages},
+        }
+
+    def report(self):
+        """段ごとの処理時間を人が読める形で返す。"""
+        st = self.stats()
+        lines = [f"取得: {st['acquired']} フレーム  {st['acquire_fps']} fps"
+                 f"  (align {st['aligned']} 回 / 平均 {st['align_avg_ms']} ms)"]
+        if self.filters:
+            lines.append(self.filters.report())
+        for name, s in st['stages'].items():
+            lines.append(f"  {name:<12} 処理 {s['processed']:>6}  平均 {s['avg_ms']:>7} ms"
+                         f"  最大 {s['max_ms']:>7} ms  遅れ {s['avg_lag_ms']:>7} ms"
+                         f"  破棄 {s['dropped']}  待機 {s['waited']}")
+        return '\n'.join(lines)
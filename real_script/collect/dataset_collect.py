@@ -1,14 +1,16 @@
 import pyrealsense2 as rs
-import numpy as np
 import cv2
 import gc
 import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils import (load_config, build_parser, apply_args, detect_camera, get_depth_alpha,
-                   make_depth_colormap, Session, cam_code)
+                   start_pipeline, has_stream, lossless_replay,
+                   depth_colormapper, Session, cam_code)
+from capture import CaptureEngine, ShotWriter, depth_filter_chain
+from preview import PreviewCompositor
 
-_args = build_parser().parse_args()
+_args = build_parser(include_preview=True, include_source=True).parse_args()
 _cfg  = apply_args(load_config(), _args)
 
 W   = _cfg['camera']['width']
@@ -17,17 +19,16 @@ FPS = _cfg['camera']['fps']
 
 # --- 1. カメラ検出 ---
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     exit(1)
 print(f"使用カメラ: {_cam['name']}  (シリアル: {_cam['serial']})")
 _has_ir     = (_cam['model'] != 'D405')
 _depth_alpha = get_depth_alpha(_cfg, _cam['model'])
+_depth_cmap  = depth_colormapper(_cfg, _depth_alpha)
 
 # --- 2. 保存ディレクトリの設定 ---
-i = 0
-
 _mods = ['color', 'depth_colormap']
 if _has_ir:
     _mods += ['ir_left', 'ir_right', 'ir_left_color', 'ir_right_color']
@@ -35,6 +36,7 @@ if _has_ir:
 session = Session(_cfg['output']['images_dir'], cam_code(_cam['model']),
                   tag=_args.tag, subdirs=_mods)
 print(f"画像を {session.dir} に保存します")
+writer = session.start_writer(**_cfg['writer'])
 
 
 # --- 3. RealSenseの初期化 ---
@@ -51,107 +53,110 @@ except RuntimeError as e:
     print(f"ストリームの設定に失敗しました: {e}")
     exit(1)
 
-pipeline.start(config)
-
-align_to = rs.stream.color
-align = rs.align(align_to)
+_profile = start_pipeline(pipeline, config, _cfg, color_format=rs.format.bgr8, ir=_has_ir)
+_has_ir  = _has_ir and has_stream(_profile, rs.stream.infrared)   # IR の無い .bag を再生する場合
 
 
-def _get_frames(aligned_frames):
-    color_frame = aligned_frames.get_color_frame()
-    depth_frame = aligned_frames.get_depth_frame()
-    if not color_frame or not depth_frame:
+def _get_frames(packet):
+    color_image = packet.color()
+    # 保存しない（プレビューだけの）フレームは位置合わせしない
+    depth_image = packet.depth(aligned=packet.shot is not None)
+    if color_image is None or depth_image is None:
         return None
-    color_image    = np.asanyarray(color_frame.get_data())
-    depth_image    = np.asanyarray(depth_frame.get_data())
-    depth_colormap = make_depth_colormap(depth_image, _depth_alpha)
+    depth_colormap = _depth_cmap.apply(depth_image)
     ir_image1 = ir_image2 = ir_colormap1 = ir_colormap2 = None
     if _has_ir:
-        ir_frame1 = aligned_frames.get_infrared_frame(1)
-        ir_frame2 = aligned_frames.get_infrared_frame(2)
-        if not ir_frame1 or not ir_frame2:
+        ir_image1 = packet.ir(1)
+        ir_image2 = packet.ir(2)
+        if ir_image1 is None or ir_image2 is None:
             return None
-        ir_image1    = np.asanyarray(ir_frame1.get_data())
-        ir_image2    = np.asanyarray(ir_frame2.get_data())
         ir_colormap1 = cv2.applyColorMap(cv2.convertScaleAbs(ir_image1), cv2.COLORMAP_JET)
         ir_colormap2 = cv2.applyColorMap(cv2.convertScaleAbs(ir_image2), cv2.COLORMAP_JET)
     return color_image, depth_colormap, ir_image1, ir_image2, ir_colormap1, ir_colormap2
 
 
-def _make_preview(color_image, depth_colormap, ir_colormap1, ir_colormap2):
+def _make_shot(packet):
+    # プレビューと同じパケットの変換結果を共有する（colormap を二重に計算しない）
+    result = packet.memo('images', _get_frames)
+    if result is None:
+        return None
+    color_image, depth_colormap, ir_image1, ir_image2, ir_colormap1, ir_colormap2 = result
+    shot = {'color': color_image, 'depth_colormap': depth_colormap}
     if _has_ir:
-        return np.vstack((
-            np.hstack((ir_colormap1, ir_colormap2)),
-            np.hstack((color_image,  depth_colormap))
-        ))
-    return np.hstack((color_image, depth_colormap))
+        shot.update(ir_left=ir_image1, ir_right=ir_image2,
+                    ir_left_color=ir_colormap1, ir_right_color=ir_colormap2)
+    return shot
+
+
+def _preview_sources(packet):
+    # 保存中は writer 段と同じ変換結果を使い、保存前は生画像からタイルへ直接描く
+    if packet.shot is not None:
+        result = packet.memo('images', _get_frames)
+        if result is None:
+            return None
+        color_image, depth_colormap, _, _, ir_colormap1, ir_colormap2 = result
+        return {'color': color_image, 'depth': depth_colormap,
+                'ir_left': ir_colormap1, 'ir_right': ir_colormap2}
+    return {'color': packet.color(), 'depth': packet.depth(aligned=False),
+            'ir_left': packet.ir(1) if _has_ir else None,
+            'ir_right': packet.ir(2) if _has_ir else None}
 
 
+_layout = [['ir_left', 'ir_right'], ['color', 'depth']] if _has_ir else [['color', 'depth']]
+compositor = PreviewCompositor(W, H, _layout, depth_mapper=_depth_cmap,
+                               every=_cfg['preview']['every'])
+
+
+# 取得は専用スレッド、保存は writer 段で行い、メインスレッドはプレビューとキー入力のみ
+engine = CaptureEngine(pipeline, filters=depth_filter_chain(_cfg),
+                       lossless=lossless_replay(_cfg))
+shot_writer = engine.add(ShotWriter(session, _make_shot))
+engine.start()
+
 # --- 4. メインループ (Enterで開始) ---
 try:
     print("\nストリーミング準備完了。")
     print("プレビューウィンドウで [Enter] キーを押すと保存を開始します。")
     print("（[q] キーで保存せずに終了します）")
 
-    is_running = True
-    while True:
-        frames = pipeline.wait_for_frames()
-        aligned_frames = align.process(frames)
-        if not aligned_frames:
-            continue
-
-        result = _get_frames(aligned_frames)
-        if result is None:
+    packet = None
+    while engine.running:
+        packet = engine.latest(after=packet)
+        if packet is None:
             continue
-        color_image, depth_colormap, ir_image1, ir_image2, ir_colormap1, ir_colormap2 = result
 
-        cv2.imshow('RealSense', _make_preview(color_image, depth_colormap, ir_colormap1, ir_colormap2))
+        if compositor.due():
+            sources = _preview_sources(packet)
+            if sources is not None:
+                cv2.imshow('RealSense', compositor.render(sources))
+        if engine.recording.is_set():
+            print(f"\rsaved: {shot_writer.saved} frames  ({writer.status()})", end="", flush=True)
 
         key = cv2.waitKey(1) & 0xFF
-        if key == 13:
+        if key == 13 and not engine.recording.is_set():
             print("保存を開始します... ([q]で停止)")
-            break
+            engine.recording.set()
         elif key == ord('q'):
-            print("保存せずに終了します。")
-            is_running = False
-            break
-
-    while is_running:
-        frames = pipeline.wait_for_frames()
-        aligned_frames = align.process(frames)
-        if not aligned_frames:
-            continue
-
-        result = _get_frames(aligned_frames)
-        if result is None:
-            continue
-        color_image, depth_colormap, ir_image1, ir_image2, ir_colormap1, ir_colormap2 = result
-
-        cv2.imshow('RealSense', _make_preview(color_image, depth_colormap, ir_colormap1, ir_colormap2))
-
-        i += 1
-        cv2.imwrite(session.path(i, 'color'),          color_image)
-        cv2.imwrite(session.path(i, 'depth_colormap'), depth_colormap)
-        if _has_ir:
-            cv2.imwrite(session.path(i, 'ir_left'),        ir_image1)
-            cv2.imwrite(session.path(i, 'ir_right'),       ir_image2)
-            cv2.imwrite(session.path(i, 'ir_left_color'),  ir_colormap1)
-            cv2.imwrite(session.path(i, 'ir_right_color'), ir_colormap2)
-
-        print(f"\rsaved: {i} frames", end="", flush=True)
-
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
-            print("\n保存を停止します。")
+            if engine.recording.is_set():
+                print("\n保存を停止します。")
+            else:
+                print("保存せずに終了します。")
             break
 
 finally:
     print("ストリーミングを停止し、リソースを解放します。")
+    engine.recording.clear()
+    engine.stop()
+    if writer.depth:
+        print(f"未書き出しの {writer.depth} ショットを書き出しています...")
+    session.close_writer()
+    print(engine.report())
     session.write_metadata(
         camera={'name': _cam['name'], 'model': _cam['model'], 'serial': _cam['serial'],
                 'resolution': [W, H], 'fps': FPS},
         modalities=_mods,
-        shot_count=i,
+        shot_count=shot_writer.saved,
+        pipeline=engine.stats(),
     )
     pipeline.stop()
     cv2.destroyAllWindows()
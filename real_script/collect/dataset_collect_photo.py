@@ -6,9 +6,10 @@ import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils import (load_config, build_parser, apply_args, detect_camera, get_depth_alpha,
-                   make_depth_colormap, Session, cam_code)
+                   start_pipeline, has_stream, playback_finished, make_depth_colormap, Session,
+                   cam_code)
 
-_args = build_parser().parse_args()
+_args = build_parser(include_source=True).parse_args()
 _cfg  = apply_args(load_config(), _args)
 
 W   = _cfg['camera']['width']
@@ -19,7 +20,7 @@ print("\nストリーミング準備中...")
 
 # --- 2. RealSenseの初期化 ---
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     exit(1)
@@ -48,7 +49,8 @@ except RuntimeError as e:
     print(f"ストリームの設定に失敗しました: {e}")
     exit(1)
 
-pipeline.start(config)
+_profile = start_pipeline(pipeline, config, _cfg, color_format=rs.format.bgr8, ir=_has_ir)
+_has_ir  = _has_ir and has_stream(_profile, rs.stream.infrared)   # IR の無い .bag を再生する場合
 
 align_to = rs.stream.color
 align = rs.align(align_to)
@@ -116,6 +118,11 @@ try:
             print(f"\n終了します。合計 {shot_count} 枚保存しました。")
             break
 
+except RuntimeError:
+    if not playback_finished(pipeline):
+        raise
+    print(f"\n.bag を最後まで再生しました。合計 {shot_count} 枚保存しました。")
+
 finally:
     print("ストリーミングを停止し、リソースを解放します。")
     session.write_metadata(
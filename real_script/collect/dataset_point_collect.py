@@ -1,14 +1,16 @@
 import pyrealsense2 as rs
-import numpy as np
 import cv2
 import gc
 import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils import (load_config, build_parser, apply_args, detect_camera, get_depth_alpha,
-                   make_depth_colormap, Session, cam_code)
+                   start_pipeline, has_stream, lossless_replay,
+                   depth_colormapper, Session, cam_code)
+from capture import CaptureEngine, ShotWriter, PointCloudExporter, depth_filter_chain
+from preview import PreviewCompositor
 
-_args = build_parser().parse_args()
+_args = build_parser(include_preview=True, include_pc_format=True, include_source=True).parse_args()
 _cfg  = apply_args(load_config(), _args)
 
 W   = _cfg['camera']['width']
@@ -17,15 +19,14 @@ FPS = _cfg['camera']['fps']
 
 # --- カメラ検出 ---
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     exit(1)
 print(f"使用カメラ: {_cam['name']}  (シリアル: {_cam['serial']})")
 _has_ir      = (_cam['model'] != 'D405')
 _depth_alpha = get_depth_alpha(_cfg, _cam['model'])
-
-i = 0
+_depth_cmap  = depth_colormapper(_cfg, _depth_alpha)
 
 _mods = ['color', 'depth_colormap', 'pointcloud']
 if _has_ir:
@@ -34,6 +35,7 @@ if _has_ir:
 session = Session(_cfg['output']['images_dir'], cam_code(_cam['model']),
                   tag=_args.tag, subdirs=_mods)
 print("Save directory:", session.dir)
+writer = session.start_writer(**_cfg['writer'])
 
 pipeline = rs.pipeline()
 config   = rs.config()
@@ -43,63 +45,71 @@ if _has_ir:
     config.enable_stream(rs.stream.infrared, 1, W, H, rs.format.y8, FPS)
     config.enable_stream(rs.stream.infrared, 2, W, H, rs.format.y8, FPS)
 
-pipeline.start(config)
-align = rs.align(rs.stream.color)
-pc    = rs.pointcloud()
+_profile = start_pipeline(pipeline, config, _cfg, color_format=rs.format.bgr8, ir=_has_ir)
+_has_ir  = _has_ir and has_stream(_profile, rs.stream.infrared)   # IR の無い .bag を再生する場合
+
+
+def _images(packet):
+    color = packet.color()
+    depth = packet.depth()
+    if color is None or depth is None:
+        return None
+    dm = _depth_cmap.apply(depth)
+    if not _has_ir:
+        return {'color': color, 'depth_colormap': dm}
+    ir_l = packet.ir(1)
+    ir_r = packet.ir(2)
+    if ir_l is None or ir_r is None:
+        return None
+    ir_lc = cv2.applyColorMap(cv2.convertScaleAbs(ir_l), cv2.COLORMAP_JET)
+    ir_rc = cv2.applyColorMap(cv2.convertScaleAbs(ir_r), cv2.COLORMAP_JET)
+    return {'color': color, 'depth_colormap': dm,
+            'ir_left': ir_l, 'ir_right': ir_r, 'ir_left_color': ir_lc, 'ir_right_color': ir_rc}
+
+
+_layout = [['ir_left_color', 'ir_right_color'], ['color', 'depth_colormap']] if _has_ir \
+    else [['color', 'depth_colormap']]
+compositor = PreviewCompositor(W, H, _layout, every=_cfg['preview']['every'])
+
+# 取得・画像保存・点群書き出しをそれぞれ別スレッドで回す（点群書き出しが最も重い）
+# depth_filters があれば取得スレッドで位置合わせの前にかける。点群は位置合わせ済みの深度から作る
+filters = depth_filter_chain(_cfg)
+engine = CaptureEngine(pipeline, filters=filters, lossless=lossless_replay(_cfg))
+shot_writer = engine.add(ShotWriter(session, lambda p: p.memo('images', _images)))
+exporter    = engine.add(PointCloudExporter(session, fmt=_cfg['pointcloud'].get('format', 'ply')))
+engine.recording.set()
+engine.start()
 
 try:
-    while True:
-        frames  = pipeline.wait_for_frames()
-        aligned = align.process(frames)
-
-        c_frame = aligned.get_color_frame()
-        d_frame = aligned.get_depth_frame()
-        if not c_frame or not d_frame:
+    packet = None
+    while engine.running:
+        packet = engine.latest(after=packet)
+        if packet is None:
             continue
-
-        color = np.asanyarray(c_frame.get_data())
-        depth = np.asanyarray(d_frame.get_data())
-        dm    = make_depth_colormap(depth, _depth_alpha)
-
-        if _has_ir:
-            ir1 = aligned.get_infrared_frame(1)
-            ir2 = aligned.get_infrared_frame(2)
-            if not ir1 or not ir2:
-                continue
-            ir_l  = np.asanyarray(ir1.get_data())
-            ir_r  = np.asanyarray(ir2.get_data())
-            ir_lc = cv2.applyColorMap(cv2.convertScaleAbs(ir_l), cv2.COLORMAP_JET)
-            ir_rc = cv2.applyColorMap(cv2.convertScaleAbs(ir_r), cv2.COLORMAP_JET)
-            preview = np.vstack((np.hstack((ir_lc, ir_rc)), np.hstack((color, dm))))
-        else:
-            preview = np.hstack((color, dm))
-
-        cv2.imshow('RealSense', preview)
-
-        i += 1
-        cv2.imwrite(session.path(i, 'color'),          color)
-        cv2.imwrite(session.path(i, 'depth_colormap'), dm)
-        if _has_ir:
-            cv2.imwrite(session.path(i, 'ir_left'),        ir_l)
-            cv2.imwrite(session.path(i, 'ir_right'),       ir_r)
-            cv2.imwrite(session.path(i, 'ir_left_color'),  ir_lc)
-            cv2.imwrite(session.path(i, 'ir_right_color'), ir_rc)
-
-        pc.map_to(c_frame)
-        points = pc.calculate(d_frame)
-        points.export_to_ply(session.path(i, 'pointcloud', ext='ply'), c_frame)
-
-        print(f"\rsaved: {i} frames", end="", flush=True)
+        if compositor.due():
+            imgs = packet.memo('images', _images)
+            if imgs is not None:
+                # 保存用に計算済みのカラーマップを確保済みモザイクへコピーするだけ
+                cv2.imshow('RealSense', compositor.render(
+                    {name: imgs[name] for name in compositor.tiles}))
+        print(f"\rsaved: {shot_writer.saved} frames  pc: {exporter.saved}  ({writer.status()})",
+              end="", flush=True)
 
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
 finally:
+    engine.recording.clear()
+    engine.stop()
+    session.close_writer()
+    print()
+    print(engine.report())
     session.write_metadata(
         camera={'name': _cam['name'], 'model': _cam['model'], 'serial': _cam['serial'],
                 'resolution': [W, H], 'fps': FPS},
         modalities=_mods,
-        shot_count=i,
+        shot_count=shot_writer.saved,
+        pipeline=engine.stats(),
     )
     pipeline.stop()
     cv2.destroyAllWindows()
@@ -7,10 +7,14 @@ import json
 import gc
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from utils import load_config, build_parser, apply_args, detect_camera, Session, cam_code
+from utils import (load_config, build_parser, apply_args, detect_camera, start_pipeline,
+                   playback_finished, Session, cam_code)
+from pointcloud_io import save_points
+from capture import depth_filter_chain
+from preview import PointCloudPreview
 
 # --- 設定読み込み ---
-_parser = build_parser()
+_parser = build_parser(include_pc_format=True, include_source=True)
 _parser.add_argument('--frames', type=int, default=None, metavar='N',
                      help='autoモードのフレーム数（config.yaml の値を上書き）')
 _parser.add_argument('--mode', choices=['auto', 'manual'], default='auto',
@@ -21,6 +25,11 @@ _parser.add_argument('--max-depth', type=float, default=None, dest='max_depth',
                      help='深度フィルタの最大距離 (m)（config.yaml の値を上書き）')
 _parser.add_argument('--no-filter', action='store_true',
                      help='深度フィルタを無効にして生データをそのまま取得')
+_parser.add_argument('--defer-pc', action='store_true', dest='defer_pc',
+                     help='取得時に点群を作らず color / depth / intrinsics だけ保存する'
+                          '（後で process/depth_to_points.py で生成。取得 fps が上がる）')
+_parser.add_argument('--preview-3d', action='store_true', dest='preview_3d',
+                     help='深度フィルタ適用後の点群を間引いて 3D 表示する（open3d。別スレッドで描画）')
 _args = _parser.parse_args()
 _cfg  = apply_args(load_config(), _args)
 
@@ -33,10 +42,13 @@ mode = _args.mode
 min_d = _args.min_depth if _args.min_depth is not None else _cfg['pointcloud']['min_depth']
 max_d = _args.max_depth if _args.max_depth is not None else _cfg['pointcloud']['max_depth']
 use_filter = not _args.no_filter
+pc_format  = _cfg['pointcloud'].get('format', 'ply')
+defer_pc   = _args.defer_pc
+preview_3d_cfg = _cfg['pointcloud'].get('preview_3d') or {}
 
 # --- カメラ検出 ---
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     exit(1)
@@ -52,10 +64,13 @@ print(f"保存先: {save_dir}")
 mode_label = f"auto ({capture_frames} frames)" if mode == 'auto' else "manual"
 print(f"モード: {mode_label}")
 print(f"解像度: {W}x{H} @ {FPS}fps")
+print(f"点群形式: {'後で生成（--defer-pc）' if defer_pc else pc_format}")
 if use_filter:
     print(f"深度フィルタ: {min_d}m 〜 {max_d}m  (生データは --no-filter で取得可)")
 else:
     print(f"深度フィルタ: 無効（生データ）")
+if _args.preview_3d:
+    print(f"3D プレビュー: decimation={preview_3d_cfg.get('decimation', 4)}")
 print()
 
 # --- RealSense セットアップ（color + depth のみ） ---
@@ -65,7 +80,8 @@ rs_config = rs.config()
 rs_config.enable_stream(rs.stream.color, W, H, rs.format.rgb8, FPS)
 rs_config.enable_stream(rs.stream.depth, W, H, rs.format.z16,  FPS)
 
-profile = pipeline.start(rs_config)
+# リポジトリの録画スクリプトは color を bgr8 で .bag に書くので、--source ではどちらも受け付ける
+profile = start_pipeline(pipeline, rs_config, _cfg, color_format=(rs.format.rgb8, rs.format.bgr8))
 align   = rs.align(rs.stream.color)
 pc_obj  = rs.pointcloud()
 
@@ -76,6 +92,18 @@ if use_filter:
     depth_filter.set_option(rs.option.min_distance, min_d)
     depth_filter.set_option(rs.option.max_distance, max_d)
 
+# --- 後処理フィルタ（config.yaml の depth_filters）---
+# decimation などは位置合わせの前にかける（align する画素が減る）。
+# 保存する深度 PNG・点群はどちらもフィルタ後・位置合わせ後（color 座標系）の深度から作る
+depth_filters = depth_filter_chain(_cfg)
+if depth_filters:
+    print(f"後処理フィルタ: {' → '.join(depth_filters.names)}")
+
+
+def filtered(frames):
+    return depth_filters.process(frames) if depth_filters else frames
+
+
 # --- カメラ内部パラメータ保存 ---
 color_stream = profile.get_stream(rs.stream.color).as_video_stream_profile()
 intr = color_stream.get_intrinsics()
@@ -88,23 +116,44 @@ intrinsics_data = {
     'ppy':    intr.ppy,
     'model':  str(intr.model),
     'coeffs': list(intr.coeffs),
+    'depth_scale': profile.get_device().first_depth_sensor().get_depth_scale(),  # 深度 PNG の 1 単位 (m)
 }
 with open(os.path.join(save_dir, 'intrinsics.json'), 'w') as f:
     json.dump(intrinsics_data, f, indent=2)
 
+# --- 3D プレビュー（取得ループは frameset を渡すだけ。点群化・描画は別スレッド）---
+pc_preview = None
+if _args.preview_3d:
+    pc_preview = PointCloudPreview(decimation=preview_3d_cfg.get('decimation', 4),
+                                   depth_range=(min_d, max_d) if use_filter else None,
+                                   width=W, height=H).start()
+
+def to_bgr(c_frame):
+    """color フレーム → BGR 画像（新しい配列。描き込んでよい）。
+    カメラからは rgb8、リポジトリの録画スクリプトで作った .bag の再生では bgr8 で来る。"""
+    color = np.asanyarray(c_frame.get_data())
+    if c_frame.get_profile().format() == rs.format.bgr8:
+        return color.copy()
+    return cv2.cvtColor(color, cv2.COLOR_RGB2BGR)
+
+
 def save_frame(idx, c_frame, d_frame):
-    color     = np.asanyarray(c_frame.get_data())   # RGB
     depth_raw = np.asanyarray(d_frame.get_data())   # uint16 生深度
-    cv2.imwrite(session.path(idx, 'color', sub=False),
-                cv2.cvtColor(color, cv2.COLOR_RGB2BGR))
+    cv2.imwrite(session.path(idx, 'color', sub=False), to_bgr(c_frame))
     cv2.imwrite(session.path(idx, 'depth', ext='png', sub=False),
-                depth_raw)                          # フィルタなし・16-bit PNG
+                depth_raw)                          # color に位置合わせ済み・16-bit PNG
+
+    if defer_pc:
+        return
 
-    # PLY はフィルタ適用後の深度で生成（--no-filter 時は生のまま）
-    depth_for_pc = depth_filter.process(d_frame) if depth_filter else d_frame
+    # 点群は位置合わせ済みの深度から作る（intrinsics.json・深度 PNG と同じ color 座標系）。
+    # min_depth / max_depth のフィルタは点群だけにかける（--no-filter 時は生のまま）
+    depth_for_pc = d_frame
+    if depth_filter:
+        depth_for_pc = depth_filter.process(depth_for_pc)
     pc_obj.map_to(c_frame)
     pts = pc_obj.calculate(depth_for_pc)
-    pts.export_to_ply(session.path(idx, 'pointcloud', ext='ply', sub=False), c_frame)
+    save_points(session.path(idx, 'pointcloud', ext=pc_format, sub=False), pts, c_frame, pc_format)
 
 
 def write_metadata(actual_frames):
@@ -112,6 +161,8 @@ def write_metadata(actual_frames):
         camera={'name': _cam['name'], 'model': _cam['model'], 'serial': _cam['serial'],
                 'resolution': [W, H], 'fps': FPS},
         mode=mode,
+        pointcloud_format=None if defer_pc else pc_format,
+        pointcloud_deferred=defer_pc,
         capture_frames=capture_frames if mode == 'auto' else None,
         actual_frames=actual_frames,
         depth_filter={
@@ -119,6 +170,9 @@ def write_metadata(actual_frames):
             'min_depth': min_d if use_filter else None,
             'max_depth': max_d if use_filter else None,
         },
+        preview_3d=pc_preview.stats() if pc_preview else None,
+        depth_filters=({'chain': depth_filters.names, **depth_filters.stats()}
+                       if depth_filters else None),
     )
 
 
@@ -129,12 +183,14 @@ try:
         # プレビューループ（Enter で開始）
         print("[Enter] で取得開始  [q] で中止")
         while True:
+            # プレビューは color のみなので位置合わせしない
             frames  = pipeline.wait_for_frames()
-            aligned = align.process(frames)
-            c_frame = aligned.get_color_frame()
+            c_frame = frames.get_color_frame()
             if not c_frame:
                 continue
-            preview = cv2.cvtColor(np.asanyarray(c_frame.get_data()), cv2.COLOR_RGB2BGR)
+            if pc_preview:
+                pc_preview.submit(frames)
+            preview = to_bgr(c_frame)
             cv2.putText(preview, "[Enter] Start  [q] Quit",
                         (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
             cv2.imshow('pointcloud_capture', preview)
@@ -150,6 +206,9 @@ try:
         print("取得中...")
         while frame_count < capture_frames:
             frames  = pipeline.wait_for_frames()
+            if pc_preview:
+                pc_preview.submit(frames)
+            frames  = filtered(frames)
             aligned = align.process(frames)
             c_frame = aligned.get_color_frame()
             d_frame = aligned.get_depth_frame()
@@ -165,28 +224,46 @@ try:
         print("[s] で1フレーム取得  [q] で終了")
         while True:
             frames  = pipeline.wait_for_frames()
-            aligned = align.process(frames)
-            c_frame = aligned.get_color_frame()
-            d_frame = aligned.get_depth_frame()
-            if not c_frame or not d_frame:
+            c_frame = frames.get_color_frame()
+            if not c_frame:
                 continue
+            if pc_preview:
+                pc_preview.submit(frames)
+            # temporal フィルタが前フレームを参照できるよう、保存しないフレームにもかける
+            frames = filtered(frames)
 
-            preview = cv2.cvtColor(np.asanyarray(c_frame.get_data()), cv2.COLOR_RGB2BGR)
+            preview = to_bgr(c_frame)
             cv2.putText(preview, f"[s] Save ({frame_count} saved)  [q] Quit",
                         (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
             cv2.imshow('pointcloud_capture', preview)
 
             key = cv2.waitKey(1) & 0xFF
             if key == ord('s'):
+                # 位置合わせは保存するフレームにだけ行う
+                aligned = align.process(frames)
+                c_frame = aligned.get_color_frame()
+                d_frame = aligned.get_depth_frame()
+                if not c_frame or not d_frame:
+                    print("フレーム欠落。もう一度 [s] を押してください。")
+                    continue
                 frame_count += 1
                 save_frame(frame_count, c_frame, d_frame)
                 print(f"saved: {frame_count} frames")
             elif key == ord('q'):
                 break
 
+except RuntimeError:
+    if not playback_finished(pipeline):
+        raise
+    print("\n.bag を最後まで再生しました")
+
 finally:
+    if pc_preview:
+        pc_preview.close()
     pipeline.stop()
     cv2.destroyAllWindows()
     write_metadata(frame_count)
+    if depth_filters:
+        print(depth_filters.report())
     print(f"完了: {frame_count} フレーム保存 → {save_dir}")
     gc.collect()
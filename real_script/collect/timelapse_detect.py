@@ -9,13 +9,15 @@ from pathlib import Path
 from datetime import datetime
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils import (load_config, build_parser, apply_args, detect_camera, get_depth_alpha,
+                   start_pipeline, has_stream, lossless_replay,
                    make_depth_colormap, Session, cam_code)
+from capture import CaptureEngine, depth_filter_chain
 
 WARMUP_SECS = 2.0  # AE安定待ち（フレーム数でなく秒数で管理）
 
 
 def _build_parser():
-    parser = build_parser(include_conf=True)
+    parser = build_parser(include_conf=True, include_source=True)
     parser.add_argument('--interval', type=int, default=300,
                         help='撮影間隔（秒）デフォルト: 300（5分）')
     parser.add_argument('--duration', type=float, default=12.0,
@@ -41,7 +43,7 @@ TOTAL_SHOTS = TOTAL_SEC // INTERVAL
 
 # ── カメラ検出 ───────────────────────────────────────────────────────────────
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     sys.exit(1)
@@ -104,14 +106,17 @@ rs_cfg.enable_stream(rs.stream.depth, W, H, rs.format.z16,  FPS)
 if _has_ir:
     rs_cfg.enable_stream(rs.stream.infrared, 1, W, H, rs.format.y8, FPS)
     rs_cfg.enable_stream(rs.stream.infrared, 2, W, H, rs.format.y8, FPS)
-pipeline.start(rs_cfg)
+_profile = start_pipeline(pipeline, rs_cfg, _cfg, color_format=rs.format.bgr8, ir=_has_ir)
+_has_ir  = _has_ir and has_stream(_profile, rs.stream.infrared)   # IR の無い .bag を再生する場合
 
 print(f"オートエクスポージャ安定待ち（{WARMUP_SECS}秒）...")
 _warmup_end = time.time() + WARMUP_SECS
 while time.time() < _warmup_end:
     pipeline.wait_for_frames()
 
-align = rs.align(rs.stream.color)
+# 取得スレッドが常にフレームを受け続けるので、撮影間隔中の空読みは不要
+engine = CaptureEngine(pipeline, filters=depth_filter_chain(_cfg),
+                       lossless=lossless_replay(_cfg)).start()
 
 # ── CSV ヘッダー（--detect 時のみ）───────────────────────────────────────────
 if log_path:
@@ -127,16 +132,15 @@ print(f"YOLO検出  : {'有効（信頼度閾値 ' + str(CONF) + '）' if _args.
 
 
 def _capture(shot_idx: int, start: float) -> bool:
-    frames  = pipeline.wait_for_frames()
-    aligned = align.process(frames)
-    cf = aligned.get_color_frame()
-    df = aligned.get_depth_frame()
-    if not cf or not df:
+    packet = engine.latest(timeout=5.0)
+    if packet is None:
+        raise RuntimeError(str(engine.error or 'フレームが届きません'))
+    color_img = packet.color()
+    depth_img = packet.depth()
+    if color_img is None or depth_img is None:
         print(f"[警告] フレーム欠落（shot {shot_idx}）- スキップ")
         return False
 
-    color_img = np.asanyarray(cf.get_data())
-    depth_img = np.asanyarray(df.get_data())
     # --relative-depth または D405（_depth_alpha=None）は相対正規化
     depth_vis = make_depth_colormap(depth_img, None if _args.relative_depth else _depth_alpha)
 
@@ -148,8 +152,8 @@ def _capture(shot_idx: int, start: float) -> bool:
 
     if _has_ir:
         # IRはalign前のフレームから取得（元解像度・純粋なIR画像）
-        ir1 = frames.get_infrared_frame(1)
-        ir2 = frames.get_infrared_frame(2)
+        ir1 = packet.frames.get_infrared_frame(1)
+        ir2 = packet.frames.get_infrared_frame(2)
         if ir1 and ir2:
             writes[session.path(shot_idx, 'ir_left')]  = np.asanyarray(ir1.get_data())
             writes[session.path(shot_idx, 'ir_right')] = np.asanyarray(ir2.get_data())
@@ -215,10 +219,7 @@ try:
                 print(f"\n予定 {TOTAL_SHOTS} 枚完了。終了します。")
                 break
         else:
-            try:
-                pipeline.wait_for_frames(timeout_ms=200)
-            except RuntimeError:
-                time.sleep(0.05)
+            time.sleep(min(0.2, next_time - now))
 
 finally:
     session.write_metadata(
@@ -231,5 +232,6 @@ finally:
         detect={'enabled': bool(_args.detect), 'model': _model_path if _args.detect else None,
                 'conf': CONF} if _args.detect else None,
     )
+    engine.stop()
     pipeline.stop()
     print(f"\n完了。試行 {shot_count} 枚 / 保存成功 {save_count} 枚。ログ: {log_path or 'なし'}")
@@ -0,0 +1,114 @@
+"""深度画像 → XYZ の逆投影（NumPy のみ。カメラ・librealsense 不要）。
+
+intrinsics.json（pointcloud_capture.py が保存する color の内部パラメータ）と
+uint16 の深度画像から、rs.pointcloud / rs2_deproject_pixel_to_point と同じ計算を
+全画素まとめて行う。
+
+画素 (u, v) の視線方向 (x, y) = 正規化座標（歪み補正込み）は深度によらないので、
+解像度と内部パラメータごとに 1 回だけ計算して ray_grid() にキャッシュする。
+以降の逆投影は z 倍するだけになる。
+
+    intr = json.load(open('intrinsics.json'))
+    points, colors = deproject_points(depth, intr, color=color_rgb, max_depth=1.0)
+
+歪みモデルは librealsense の rsutil.h に合わせている。
+    brown_conrady / inverse_brown_conrady : coeffs = [k1, k2, p1, p2, k3]（10 回の反復で補正）
+    none（その他）                         : ピンホール
+modified_brown_conrady（順方向の歪み）は逆投影できないので ValueError。
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+_UNDISTORT_ITERS = 10
+
+
+def distortion_model(intr):
+    """intrinsics.json の model（'distortion.inverse_brown_conrady' など）→ 'inverse_brown_conrady'。"""
+    return str(intr.get('model', 'none')).split('.')[-1].lower()
+
+
+def _undistort(x, y, model, coeffs):
+    """正規化座標を歪み補正する（rs2_deproject_pixel_to_point と同じ反復）。"""
+    k1, k2, p1, p2, k3 = (list(coeffs) + [0.0] * 5)[:5]
+    if not any((k1, k2, p1, p2, k3)):
+        return x, y
+    xo, yo = x, y
+    for _ in range(_UNDISTORT_ITERS):
+        r2 = x * x + y * y
+        icdist = 1 / (1 + ((k3 * r2 + k2) * r2 + k1) * r2)
+        if model == 'inverse_brown_conrady':
+            xq, yq = x / icdist, y / icdist
+        else:
+            xq, yq = x, y
+        dx = 2 * p1 * xq * yq + p2 * (r2 + 2 * xq * xq)
+        dy = 2 * p2 * xq * yq + p1 * (r2 + 2 * yq * yq)
+        x = (xo - dx) * icdist
+        y = (yo - dy) * icdist
+    return x, y
+
+
+@lru_cache(maxsize=8)
+def _ray_grid(width, height, fx, fy, ppx, ppy, model, coeffs):
+    u = (np.arange(width,  dtype=np.float64) - ppx) / fx
+    v = (np.arange(height, dtype=np.float64) - ppy) / fy
+    x, y = np.meshgrid(u, v)
+    if model in ('brown_conrady', 'inverse_brown_conrady'):
+        x, y = _undistort(x, y, model, coeffs)
+    elif model == 'modified_brown_conrady' and any(coeffs):
+        raise ValueError("modified_brown_conrady（順方向の歪み）の画像は逆投影できません")
+    grid = np.stack([x, y], axis=-1).astype(np.float32)
+    grid.setflags(write=False)
+    return grid
+
+
+def ray_grid(intr):
+    """画素ごとの視線 (H, W, 2) float32 [x/z, y/z]。解像度・内部パラメータごとにキャッシュする。"""
+    return _ray_grid(int(intr['width']), int(intr['height']),
+                     float(intr['fx']), float(intr['fy']), float(intr['ppx']), float(intr['ppy']),
+                     distortion_model(intr), tuple(float(c) for c in intr.get('coeffs', ())))
+
+
+def depth_to_meters(depth, intr, depth_scale=None):
+    """uint16 深度 → float32 [m]。depth_scale 省略時は intr['depth_scale']（無ければ 0.001）。"""
+    scale = depth_scale if depth_scale is not None else intr.get('depth_scale', 0.001)
+    return depth.astype(np.float32) * np.float32(scale)
+
+
+def deproject_image(depth, intr, depth_scale=None):
+    """深度 (H, W) → 画素ごとの XYZ (H, W, 3) float32 [m]。深度 0 の画素は (0, 0, 0)。"""
+    z = depth_to_meters(depth, intr, depth_scale)
+    grid = ray_grid(intr)
+    xyz = np.empty(depth.shape + (3,), dtype=np.float32)
+    np.multiply(grid, z[..., None], out=xyz[..., :2])
+    xyz[..., 2] = z
+    return xyz
+
+
+def deproject_points(depth, intr, color=None, min_depth=None, max_depth=None, depth_scale=None):
+    """深度 (H, W) → 有効画素の XYZ (N, 3) float32 [m] と色 (N, 3)（color 指定時。無ければ None）。
+
+    深度 0 と min_depth〜max_depth の外は捨てる（rs.threshold_filter と同じ扱い）。
+    color は深度と同じ解像度（color に位置合わせ済みの深度を想定）で、チャンネル順はそのまま返す。
+    """
+    z = depth_to_meters(depth, intr, depth_scale).ravel()
+    valid = z > 0
+    if min_depth is not None:
+        valid &= z >= min_depth
+    if max_depth is not None:
+        valid &= z <= max_depth
+    idx = np.flatnonzero(valid)
+    z = z[idx]
+    rays = ray_grid(intr).reshape(-1, 2)
+    points = np.empty((len(z), 3), dtype=np.float32)
+    np.multiply(np.take(rays, idx, axis=0), z[:, None], out=points[:, :2])
+    points[:, 2] = z
+    colors = color.reshape(-1, color.shape[-1])[idx] if color is not None else None
+    return points, colors
+
+
+def deproject_pixel(u, v, depth_m, intr):
+    """1 画素（クリック座標など）の XYZ [m]。depth_m はその画素の深度 [m]。"""
+    x, y = ray_grid(intr)[int(v), int(u)]
+    return np.array([x * depth_m, y * depth_m, depth_m], dtype=np.float32)
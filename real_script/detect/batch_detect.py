@@ -0,0 +1,226 @@
+"""
+保存済みセッションに YOLO をまとめてかけるオフライン推論スクリプト
+
+使い方:
+  python3 detect/batch_detect.py                          # images_dir 以下の全セッション
+  python3 detect/batch_detect.py <session_dir>            # セッション1つ
+  python3 detect/batch_detect.py data/timelapse_data      # ディレクトリ以下を再帰的に探索
+  python3 detect/batch_detect.py <dir> --model model/new.pt --batch 16 --workers 8
+
+入力:
+  セッションディレクトリ（metadata.json または color/ を持つディレクトリ）の color 画像
+    color/<prefix>_<NNNNN>_c.jpg   （collect / timelapse）
+    <prefix>_<NNNNN>_c.jpg         （pointcloud などのフラット配置）
+
+出力（セッションごと。モデル名 <model> ごとに分かれるので再スコアしても上書きしない）:
+  pred_labels_<model>/<画像stem>.txt   YOLO 形式ラベル（class xc yc w h conf）
+  detection_<model>.csv               1画像1行の検出サマリー
+                                      （timelapse_detect の detection_log.csv と同じ列 + file）
+
+画像のデコードはスレッドプールで先読みし、推論は --batch 枚ずつまとめて行う。
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import cv2
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils import load_config
+
+_COLOR_PATTERNS = ('color/*_c.jpg', '*_c.jpg', 'color/*.jpg')
+
+
+def find_sessions(root):
+    """root がセッションならそれ自体を、そうでなければ配下のセッションを列挙する。"""
+    root = Path(root).expanduser()
+    if _is_session(root):
+        return [root]
+    found = {p.parent for p in root.rglob('metadata.json')}
+    found |= {p.parent for p in root.rglob('color') if p.is_dir()}
+    return sorted(found)
+
+
+def _is_session(d):
+    return (d / 'metadata.json').exists() or (d / 'color').is_dir()
+
+
+def collect_color_images(session_dir):
+    """セッション内の color 画像を連番順に返す。"""
+    for pattern in _COLOR_PATTERNS:
+        files = sorted(session_dir.glob(pattern))
+        if files:
+            return files
+    return []
+
+
+def _shot_times(session_dir, images):
+    """画像ごとの撮影時刻。タイムラプスは開始時刻 + 連番 × 撮影間隔、
+    それ以外はファイルの更新時刻を使う。"""
+    meta = {}
+    try:
+        with open(session_dir / 'metadata.json') as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        pass
+    interval = (meta.get('timelapse') or {}).get('interval_sec')
+    started  = meta.get('started_at')
+    if interval and started:
+        t0 = datetime.fromisoformat(started)
+        times = []
+        for i, p in enumerate(images):
+            try:
+                shot = int(p.stem.split('_')[-2])
+            except (IndexError, ValueError):
+                shot = i + 1
+            times.append(t0 + timedelta(seconds=(shot - 1) * interval))
+        return times
+    return [datetime.fromtimestamp(p.stat().st_mtime) for p in images]
+
+
+def prefetch(paths, workers, depth):
+    """画像を先読みしながら (path, image) を順に返す。image が読めなければ None。"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        it = iter(paths)
+        for p in it:
+            pending.append((p, pool.submit(cv2.imread, str(p))))
+            if len(pending) >= depth:
+                break
+        while pending:
+            p, fut = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, pool.submit(cv2.imread, str(nxt))))
+            yield p, fut.result()
+
+
+def batched(items, n):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_labels(path, result):
+    boxes = result.boxes
+    with open(path, 'w') as f:
+        if len(boxes) == 0:
+            return
+        for (xc, yc, w, h), c, cls in zip(boxes.xywhn.cpu().numpy(),
+                                          boxes.conf.cpu().numpy(),
+                                          boxes.cls.cpu().numpy()):
+            f.write(f"{int(cls)} {xc:.6f} {yc:.6f} {w:.6f} {h:.6f} {c:.4f}\n")
+
+
+def run_session(model, session_dir, args, model_stem):
+    images = collect_color_images(session_dir)
+    if not images:
+        print(f"  color 画像なし: {session_dir}")
+        return 0, 0.0
+
+    label_dir = session_dir / f'pred_labels_{model_stem}'
+    if not args.no_labels:
+        label_dir.mkdir(exist_ok=True)
+    csv_path = session_dir / f'detection_{model_stem}.csv'
+    times = dict(zip(images, _shot_times(session_dir, images)))
+    t_first = times[images[0]]
+
+    t0 = time.perf_counter()
+    done = 0
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'timestamp', 'elapsed_min', 'num_detections',
+                         'avg_conf', 'max_conf', 'classes'])
+        for batch in batched(prefetch(images, args.workers, args.batch * 2), args.batch):
+            batch = [(p, img) for p, img in batch if img is not None]
+            if not batch:
+                continue
+            results = model.predict([img for _, img in batch], conf=args.conf, imgsz=args.imgsz,
+                                    device=args.device, verbose=False)
+            for (path, _), res in zip(batch, results):
+                n     = len(res.boxes)
+                confs = res.boxes.conf.cpu().numpy() if n > 0 else []
+                avg_c = float(confs.mean()) if n > 0 else 0.0
+                max_c = float(confs.max())  if n > 0 else 0.0
+                classes = ','.join(res.names[int(c)] for c in res.boxes.cls.cpu().numpy()) if n > 0 else ''
+                ts = times[path]
+                writer.writerow([path.name, ts.isoformat(timespec='seconds'),
+                                 f'{(ts - t_first).total_seconds() / 60:.1f}', n,
+                                 f'{avg_c:.4f}', f'{max_c:.4f}', classes])
+                if not args.no_labels:
+                    write_labels(label_dir / f'{path.stem}.txt', res)
+            done += len(batch)
+            print(f"\r  [{done}/{len(images)}]", end="", flush=True)
+    elapsed = time.perf_counter() - t0
+    print(f"\r  {done} 枚  {elapsed:.1f} 秒  ({done / elapsed if elapsed else 0:.1f} 枚/秒)  → {csv_path.name}")
+    return done, elapsed
+
+
+def main():
+    cfg = load_config()
+    parser = argparse.ArgumentParser(
+        description='保存済みセッションへの YOLO バッチ推論',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('paths', nargs='*',
+                        help='セッションディレクトリ、またはそれを含むディレクトリ'
+                             '（省略時は config.yaml の images_dir）')
+    parser.add_argument('--model', type=str, default=None, metavar='PATH',
+                        help='モデルパス（config.yaml の yolo_path を上書き）')
+    parser.add_argument('--conf', type=float, default=None, metavar='F',
+                        help=f'信頼度閾値  [default: {cfg["model"]["confidence_threshold"]}]')
+    parser.add_argument('--batch', type=int, default=8, metavar='N', help='推論バッチサイズ')
+    parser.add_argument('--workers', type=int, default=4, metavar='N',
+                        help='画像デコードのスレッド数')
+    parser.add_argument('--imgsz', type=int, default=640, metavar='N', help='推論解像度')
+    parser.add_argument('--device', type=str, default=None, metavar='DEV',
+                        help='推論デバイス（例: cpu / 0）。省略時は ultralytics の自動選択')
+    parser.add_argument('--no-labels', action='store_true', dest='no_labels',
+                        help='YOLO 形式ラベルを書き出さず CSV のみ出力')
+    args = parser.parse_args()
+
+    root = Path(__file__).parent.parent
+    model_path = Path(args.model) if args.model else root / cfg['model']['yolo_path']
+    if args.conf is None:
+        args.conf = cfg['model']['confidence_threshold']
+    if not model_path.exists():
+        print(f"モデルファイルが見つかりません: {model_path}")
+        sys.exit(1)
+
+    paths = args.paths or [cfg['output']['images_dir']]
+    sessions = []
+    for p in paths:
+        sessions += find_sessions(p)
+    if not sessions:
+        print(f"セッションが見つかりません: {', '.join(map(str, paths))}")
+        sys.exit(1)
+
+    from ultralytics import YOLO
+    model = YOLO(str(model_path))
+    print(f"モデル    : {model_path}")
+    print(f"セッション: {len(sessions)} 件  (batch={args.batch}, workers={args.workers}, conf={args.conf})")
+
+    total, total_sec = 0, 0.0
+    for i, session_dir in enumerate(sessions, 1):
+        print(f"[{i}/{len(sessions)}] {session_dir}")
+        n, sec = run_session(model, session_dir, args, model_path.stem)
+        total += n
+        total_sec += sec
+    if total_sec:
+        print(f"\n完了: {total} 枚 / {total_sec:.1f} 秒  ({total / total_sec:.1f} 枚/秒)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,39 @@
 # ノートPC内蔵GPU(Intel Arc/Iris Xe)をOpenVINOで利用するスクリプト
 
-from openvino.runtime import Core, Tensor
+#
+# 推論は AsyncInferQueue で最大 --jobs 個を同時に投げる。結果は投げたときのフレームに
+# 描画して表示するので、後から届いた古い検出枠が新しいフレームに乗ることはない。
+# 表示は推論が終わった順ではなくフレーム番号の順。
+#
+# --preprocess device では resize / BGR→RGB / 0〜1 正規化 / NHWC→NCHW を
+# PrePostProcessor でモデルに組み込み、RealSense の color バッファ（u8 NHWC BGR）を
+# コピーせずそのまま入力にする。host（従来）は CPU で blobFromImage してから渡す。
+
+from openvino.runtime import Core, Tensor, AsyncInferQueue, Layout, Type
+from openvino.preprocess import PrePostProcessor, ResizeAlgorithm, ColorFormat
 import pyrealsense2 as rs
 import numpy as np
 import cv2
 import gc
 import sys
+import threading
+import time
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from utils import load_config, build_parser, apply_args, detect_camera
+from utils import (load_config, build_parser, apply_args, detect_camera, start_pipeline,
+                   playback_finished)
+from yolo_postprocess import decode_yolo_output, load_class_names
 
-_args = build_parser(include_model=True, include_conf=True).parse_args()
+_parser = build_parser(include_model=True, include_conf=True, include_source=True)
+_parser.add_argument('--dump-outputs', type=str, default=None, dest='dump_outputs', metavar='DIR',
+                     help='推論の生出力を .npy で保存する（bench/bench_yolo_decode.py 用。最大 200 フレーム）')
+_parser.add_argument('--jobs', type=int, default=None, metavar='N',
+                     help='同時に投げる推論リクエスト数（0 で OpenVINO の推奨値）'
+                          '  [config.yaml: model.openvino_jobs]')
+_parser.add_argument('--preprocess', choices=['host', 'device'], default=None,
+                     help='前処理を CPU で行う（host）か、モデルに組み込んでデバイスで行う（device）'
+                          '  [config.yaml: model.openvino_preprocess]')
+_args = _parser.parse_args()
 _cfg  = apply_args(load_config(), _args, model_key='openvino_path')
 
 W   = _cfg['camera']['width']
@@ -20,39 +43,144 @@ FPS = _cfg['camera']['fps']
 _root = Path(__file__).parent.parent
 _model_xml = str(_root / _cfg['model']['openvino_path'])
 _conf_thresh = _cfg['model']['confidence_threshold']
+_iou_thresh  = _cfg['model'].get('iou_threshold', 0.45)
+_names       = load_class_names(_model_xml)
+_jobs        = _args.jobs if _args.jobs is not None else _cfg['model'].get('openvino_jobs', 4)
+_preprocess  = _args.preprocess or _cfg['model'].get('openvino_preprocess', 'host')
 
+_DUMP_MAX = 200
+_dump_dir = Path(_args.dump_outputs).expanduser() if _args.dump_outputs else None
+if _dump_dir:
+    _dump_dir.mkdir(parents=True, exist_ok=True)
 
-def decode_yolo_output(output, threshold=0.3):
-    boxes = []
-    if output.ndim == 3:
-        output = output[0]
-    output = output.T  # shape: (N, 5)
-
-    for row in output:
-        x1, y1, x2, y2, conf = row
-        if conf < threshold:
-            continue
-        boxes.append((int(x1), int(y1), int(x2), int(y2), float(conf)))
-    return boxes
 
 def draw_boxes(image, boxes, color=(0, 255, 0), thickness=2):
-    for (x1, y1, x2, y2, conf) in boxes:
-        label = f"{conf:.2f}"
+    """boxes: decode_yolo_output の結果 (N, 6) [x1, y1, x2, y2, conf, cls]"""
+    for x1, y1, x2, y2, conf, cls in boxes:
+        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+        name  = _names.get(int(cls), int(cls)) if _names else int(cls)
+        label = f"{name} {conf:.2f}"
         cv2.rectangle(image, (x1, y1), (x2, y2), color, thickness)
         cv2.putText(image, label, (x1, max(y1 - 10, 0)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
     return image
 
-def get_realsense_color_frame(pipeline, align):
+def read_model_with_preprocess(ie, model_xml, width, height):
+    """カメラ画像（u8, NHWC, BGR, width x height）を直接受け取るモデルを作る。
+
+    モデル本来の入力（f32, NCHW, RGB, 0〜1, iW x iH）への変換は OpenVINO が
+    デバイス上で行う。戻り値は (model, (iW, iH))。
+    """
+    model = ie.read_model(model_xml)
+    _, _, in_h, in_w = model.input(0).shape
+    ppp = PrePostProcessor(model)
+    ppp.input().tensor() \
+        .set_element_type(Type.u8) \
+        .set_layout(Layout('NHWC')) \
+        .set_color_format(ColorFormat.BGR) \
+        .set_spatial_static_shape(height, width)
+    ppp.input().preprocess() \
+        .convert_element_type(Type.f32) \
+        .convert_color(ColorFormat.RGB) \
+        .resize(ResizeAlgorithm.RESIZE_LINEAR) \
+        .scale(255.0)
+    ppp.input().model().set_layout(Layout('NCHW'))
+    return ppp.build(), (in_w, in_h)
+
+
+def get_realsense_color_frame(pipeline):
+    # color しか使わないので位置合わせ（rs.align）は不要
     frames = pipeline.wait_for_frames()
-    aligned_frames = align.process(frames)
-    color_frame = aligned_frames.get_color_frame()
+    color_frame = frames.get_color_frame()
     if not color_frame:
         return None
-    return np.asanyarray(color_frame.get_data())
+    return color_frame
+
+
+class _Results:
+    """推論完了コールバック（OpenVINO のスレッド）と表示ループの受け渡し。
+
+    完了した結果をフレーム番号で保持し、表示側は番号の連続している分だけ取り出す。
+    レイテンシはフレーム到着（wait_for_frames が返った時刻）から後処理完了までを測り、
+    推論そのものの時間（InferRequest.latency）とは分けて記録する。
+    後処理で例外が出たフレームも検出なしとして番号を埋める（埋めないと表示側が次の番号を待ち続ける）。
+    """
+
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._done    = {}
+        self.next     = 0
+        self.latency  = []   # フレーム到着 → 後処理完了 (ms)
+        self.infer    = []   # デバイス上の推論時間 (ms)
+        self.dumped   = 0
+        self.errors   = 0
+        self.error    = None   # 最初に起きた例外（report で表示）
+        self.t_first  = None
+        self.t_last   = None
+
+    def callback(self, request, userdata):
+        idx, frame, t_arrive = userdata
+        try:
+            boxes = self._postprocess(request)
+        except Exception as e:
+            now = time.perf_counter()
+            with self._lock:
+                self._done[idx] = (frame, [], t_arrive, now)
+                self.errors += 1
+                if self.error is None:
+                    self.error = e
+                    print(f"\n後処理でエラーが発生しました（#{idx}）: {e!r}")
+            return
+        now = time.perf_counter()
+        with self._lock:
+            self._done[idx] = (frame, boxes, t_arrive, now)
+            self.latency.append((now - t_arrive) * 1000)
+            self.infer.append(request.latency)
+            if self.t_first is None:
+                self.t_first = now
+            self.t_last = now
+
+    def _postprocess(self, request):
+        out = request.get_output_tensor(0).data
+        with self._lock:
+            dump = _dump_dir is not None and self.dumped < _DUMP_MAX
+            if dump:
+                self.dumped += 1
+                n = self.dumped
+        if dump:
+            np.save(_dump_dir / f'out_{n:05d}.npy', out)
+        return decode_yolo_output(out, _conf_thresh, _iou_thresh,
+                                  input_size=(iW, iH), orig_size=(W, H))
+
+    def pop_ready(self):
+        """表示できる（番号が連続した）結果のうち最新のものを返す。無ければ None。"""
+        latest = None
+        with self._lock:
+            while self.next in self._done:
+                latest = (self.next,) + self._done.pop(self.next)
+                self.next += 1
+        return latest
+
+    def report(self, submitted, elapsed):
+        if self.errors:
+            print(f"後処理エラー {self.errors} フレーム（検出なしとして表示）: {self.error!r}")
+        n = len(self.latency)
+        if n == 0:
+            print("推論結果なし")
+            return
+        lat   = np.asarray(self.latency)
+        infer = np.asarray(self.infer)
+        span  = (self.t_last - self.t_first) if n > 1 else 0.0
+        print(f"投入 {submitted} フレーム / 完了 {n}  ({elapsed:.1f} 秒, jobs={_n_jobs})")
+        print(f"  スループット : {(n - 1) / span if span else 0:.1f} FPS（推論完了の間隔）"
+              f"  カメラ {submitted / elapsed if elapsed else 0:.1f} FPS")
+        print(f"  レイテンシ   : 平均 {lat.mean():.1f} ms  p50 {np.percentile(lat, 50):.1f}"
+              f"  p95 {np.percentile(lat, 95):.1f}  （フレーム到着 → 後処理完了）")
+        print(f"  推論時間     : 平均 {infer.mean():.1f} ms  p95 {np.percentile(infer, 95):.1f}"
+              f"  （デバイス上の 1 リクエスト）")
 
 # RealSenseの初期化
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     exit(1)
@@ -62,47 +190,69 @@ pipeline = rs.pipeline()
 config = rs.config()
 config.enable_stream(rs.stream.color, W, H, rs.format.bgr8, FPS)
 
-pipeline.start(config)
-align = rs.align(rs.stream.color)
+start_pipeline(pipeline, config, _cfg, color_format=rs.format.bgr8)
 
 # OpenVINOモデルのロードとコンパイル
+# 複数リクエストを同時に流すときは THROUGHPUT ヒントでデバイス側のストリームを増やす
 ie = Core()
-model = ie.read_model(_model_xml)
-compiled = ie.compile_model(model=model, device_name="GPU")
-
-# 非同期推論の設定
-num_requests = 2
-infer_requests = [compiled.create_infer_request() for _ in range(num_requests)]
-req_idx = 0
+if _preprocess == 'device':
+    model, (iW, iH) = read_model_with_preprocess(ie, _model_xml, W, H)
+else:
+    model = ie.read_model(_model_xml)
+    _, _, iH, iW = model.input(0).shape
+_hint = 'LATENCY' if _jobs == 1 else 'THROUGHPUT'
+compiled = ie.compile_model(model=model, device_name="GPU", config={'PERFORMANCE_HINT': _hint})
 
-# 入力サイズ取得
-_, _, iH, iW = compiled.input(0).shape
+# 非同期推論キュー（空きリクエストが無いと start_async が待つ = 投入側のバックプレッシャー）
+results = _Results()
+infer_queue = AsyncInferQueue(compiled, _jobs)
+infer_queue.set_callback(results.callback)
+_n_jobs = len(infer_queue)
+print(f"推論リクエスト: {_n_jobs} 並列  (hint={_hint}, 前処理={_preprocess}, 入力 {iW}x{iH})")
 
+submitted = 0
+t_start = time.perf_counter()
 try:
     while True:
-        color = get_realsense_color_frame(pipeline, align)
-        if color is None:
+        color_frame = get_realsense_color_frame(pipeline)
+        if color_frame is None:
             continue
+        t_arrive = time.perf_counter()
+        color = np.asanyarray(color_frame.get_data())
 
-        img = cv2.resize(color, (iW, iH))
-        img_input = img.transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+        if _preprocess == 'device':
+            # フレームのバッファをそのまま共有（コピーなし）
+            tensor = Tensor(color[None], shared_memory=True)
+        else:
+            # resize + BGR→RGB + 0〜1 + NCHW を 1 回で（float32 の (1, 3, iH, iW)）
+            tensor = Tensor(cv2.dnn.blobFromImage(color, 1 / 255.0, (iW, iH), swapRB=True))
 
-        r = infer_requests[req_idx]
-        r.set_input_tensor(0, Tensor(img_input))
-        r.start_async()
+        # color_frame を userdata に持たせて、結果が返るまでフレームのバッファを保持する
+        infer_queue.start_async({0: tensor}, (submitted, color_frame, t_arrive))
+        submitted += 1
 
-        prev = infer_requests[(req_idx - 1) % num_requests]
-        if prev.wait() == 0:
-            out = prev.get_output_tensor(0).data.squeeze()
-            boxes = decode_yolo_output(out, threshold=_conf_thresh)
-            draw_boxes(color, boxes)
-
-        cv2.imshow('OpenVINO GPU', color)
+        ready = results.pop_ready()
+        if ready is None:
+            continue
+        idx, frame, boxes, t_arrive, t_done = ready
+        shown = np.asanyarray(frame.get_data())
+        draw_boxes(shown, boxes)
+        cv2.putText(shown, f"#{idx}  {(t_done - t_arrive) * 1000:.0f} ms  "
+                           f"ts {frame.get_timestamp():.0f}",
+                    (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+        cv2.imshow('OpenVINO GPU', shown)
 
-        req_idx = (req_idx + 1) % num_requests
-        if cv2.waitKey(1) == ord('q'):
+        if cv2.waitKey(1) & 0xFF == ord('q'):
             break
+except KeyboardInterrupt:
+    pass
+except RuntimeError:
+    if not playback_finished(pipeline):
+        raise
+    print("\n.bag を最後まで再生しました")
 finally:
+    infer_queue.wait_all()
+    results.report(submitted, time.perf_counter() - t_start)
     pipeline.stop()
     cv2.destroyAllWindows()
     gc.collect()
@@ -1,14 +1,15 @@
 import pyrealsense2 as rs
-import numpy as np
 import cv2
 from ultralytics import YOLO
 import gc
 import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from utils import load_config, build_parser, apply_args, detect_camera
+from utils import (load_config, build_parser, apply_args, detect_camera, start_pipeline,
+                   lossless_replay)
+from capture import CaptureEngine, FunctionConsumer
 
-_args = build_parser(include_model=True).parse_args()
+_args = build_parser(include_model=True, include_source=True).parse_args()
 _cfg  = apply_args(load_config(), _args)
 
 W   = _cfg['camera']['width']
@@ -19,7 +20,7 @@ _root = Path(__file__).parent.parent
 YOLO_MODEL_PATH = str(_root / _cfg['model']['yolo_path'])
 
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     exit(1)
@@ -28,25 +29,24 @@ print(f"使用カメラ: {_cam['name']}  (シリアル: {_cam['serial']})")
 pipeline = rs.pipeline()
 config = rs.config()
 
-pipeline_wrapper = rs.pipeline_wrapper(pipeline)
-pipeline_profile = config.resolve(pipeline_wrapper)
-device = pipeline_profile.get_device()
-
-found_rgb = False
-for s in device.sensors:
-    if s.get_info(rs.camera_info.name) == 'RGB Camera':
-        found_rgb = True
-        break
-if not found_rgb:
-    print("The demo requires Depth camera with Color sensor")
-    exit(0)
+# --source（.bag 再生）のときは接続中のカメラを調べない
+if not _cfg['camera'].get('source'):
+    pipeline_wrapper = rs.pipeline_wrapper(pipeline)
+    pipeline_profile = config.resolve(pipeline_wrapper)
+    device = pipeline_profile.get_device()
+
+    found_rgb = False
+    for s in device.sensors:
+        if s.get_info(rs.camera_info.name) == 'RGB Camera':
+            found_rgb = True
+            break
+    if not found_rgb:
+        print("The demo requires Depth camera with Color sensor")
+        exit(0)
 
 config.enable_stream(rs.stream.color, W, H, rs.format.bgr8, FPS)
 
-pipeline.start(config)
-
-align_to = rs.stream.color
-align = rs.align(align_to)
+start_pipeline(pipeline, config, _cfg, color_format=rs.format.bgr8)
 
 
 if __name__ == '__main__':
@@ -54,26 +54,36 @@ if __name__ == '__main__':
     model = YOLO(YOLO_MODEL_PATH)
     # model.to("cuda")  # GPU使用時はコメントを外す
 
-    try:
-        while True:
-            frames = pipeline.wait_for_frames()
-            aligned_frames = align.process(frames)
-            color_frame = aligned_frames.get_color_frame()
-            if not color_frame:
-                continue
+    # color しか使わないので位置合わせはしない。推論は段のスレッドで行い、遅いときは古いフレームを捨てる
+    # （--replay fast では捨てずに全フレームを推論する。lossless_replay 参照）
+    annotated = {'image': None}
 
-            color_image = np.asanyarray(color_frame.get_data())
+    def _detect(packet):
+        color_image = packet.color()
+        if color_image is None:
+            return
+        results = model(color_image, show=False, save=False)
+        annotated['image'] = results[0].plot()
 
-            results = model(color_image, show=False, save=False)
-            anotated_image = results[0].plot()
+    engine = CaptureEngine(pipeline, align='none', lossless=lossless_replay(_cfg))
+    engine.add(FunctionConsumer('detector', _detect))
+    engine.start()
+
+    try:
+        packet = None
+        while engine.running:
+            packet = engine.latest(after=packet)
+            if packet is None or annotated['image'] is None:
+                continue
 
-            cv2.imshow('RealSense', anotated_image)
+            cv2.imshow('RealSense', annotated['image'])
 
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
     finally:
+        engine.stop()
         pipeline.stop()
         cv2.destroyAllWindows()
-        del color_frame, color_image
+        del packet
         gc.collect()
@@ -0,0 +1,141 @@
+"""画像書き出しをキャプチャループから切り離す非同期ライタ。
+
+cv2.imwrite は JPEG/PNG のエンコードとディスク I/O を含むため、
+wait_for_frames と同じスレッドで呼ぶとディスクが詰まった瞬間にフレームが落ちる。
+FrameWriter は 1 ショット分の {path: image} をまとめて有界キューに積み、
+ワーカースレッド群が書き出す（cv2.imwrite は GIL を解放するので並列化が効く）。
+
+キューが満杯のときの挙動:
+    policy='block' : 空きが出るまで待つ（backpressured としてカウント。取りこぼしなし）
+    policy='drop'  : そのショットを捨てる（dropped としてカウント。キャプチャ優先）
+
+使い方（通常は Session.start_writer() 経由）:
+    writer = session.start_writer(workers=4)
+    writer.submit({session.path(i, 'color'): color_image, ...})
+    ...
+    session.close_writer()      # finally 内で write_metadata より前に呼ぶ
+"""
+
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class FrameWriter:
+    """有界キュー + ライタスレッドプール。"""
+
+    def __init__(self, workers=2, queue_size=32, policy='block'):
+        if policy not in ('block', 'drop'):
+            raise ValueError(f"policy は 'block' / 'drop' のいずれか: {policy}")
+        self.policy  = policy
+        self._queue  = queue.Queue(maxsize=max(1, queue_size))
+        self._lock   = threading.Lock()
+        self._closed = False
+
+        # 統計（stats() で参照）
+        self.submitted     = 0
+        self.written       = 0     # 書き出したファイル数
+        self.dropped       = 0     # キュー満杯で捨てたショット数
+        self.backpressured = 0     # キュー満杯で待たされたショット数
+        self.blocked_sec   = 0.0   # 待たされた合計時間
+        self.errors        = []    # 書き込みに失敗したパス
+        self.max_depth     = 0
+
+        self._threads = [threading.Thread(target=self._run, name=f'frame-writer-{n}', daemon=True)
+                         for n in range(max(1, workers))]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def depth(self):
+        """現在キューに積まれているショット数。"""
+        return self._queue.qsize()
+
+    def submit(self, writes):
+        """1 ショット分の {path: image} を積む。捨てた場合は False を返す。
+
+        pyrealsense2 のバッファを指す配列（asanyarray の結果）はフレームが
+        再利用されると中身が変わるため、自前のメモリを持たない配列はここでコピーする。
+        """
+        if self._closed:
+            raise RuntimeError("FrameWriter は既に close されています")
+        item = {path: (img if img.flags.owndata else img.copy()) for path, img in writes.items()}
+
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == 'drop':
+                with self._lock:
+                    self.dropped += 1
+                return False
+            t0 = time.perf_counter()
+            self._queue.put(item)
+            with self._lock:
+                self.backpressured += 1
+                self.blocked_sec   += time.perf_counter() - t0
+
+        with self._lock:
+            self.submitted += 1
+            self.max_depth  = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def _run(self):
+        import cv2
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                for path, img in item.items():
+                    # 例外でワーカーが死ぬと submit / close が永久に待つので、失敗として数えて続ける
+                    try:
+                        ok = cv2.imwrite(path, img)
+                    except Exception as e:
+                        ok = False
+                        if not self.errors:
+                            print(f"\n[警告] 画像を書き出せません: {path}: {e}")
+                    with self._lock:
+                        if ok:
+                            self.written += 1
+                        else:
+                            self.errors.append(path)
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """キューに残ったショットをすべて書き出してからスレッドを止める。"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for t in self._threads:
+            t.join()
+
+    def status(self):
+        """プログレス表示用の短い文字列。"""
+        s = f"queue={self.depth}"
+        if self.dropped:
+            s += f" dropped={self.dropped}"
+        if self.backpressured:
+            s += f" waited={self.backpressured}"
+        return s
+
+    def stats(self):
+        """metadata.json に記録する統計。"""
+        with self._lock:
+            return {
+                'workers':       len(self._threads),
+                'queue_size':    self._queue.maxsize,
+                'policy':        self.policy,
+                'submitted':     self.submitted,
+                'files_written': self.written,
+                'dropped':       self.dropped,
+                'backpressured': self.backpressured,
+                'blocked_sec':   round(self.blocked_sec, 3),
+                'max_depth':     self.max_depth,
+                'errors':        len(self.errors),
+            }
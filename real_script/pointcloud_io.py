@@ -0,0 +1,84 @@
+"""点群のコンパクト保存（.npz）と読み込み。
+
+rs.points.export_to_ply はテクスチャ座標の参照や ASCII 混じりのヘッダ書き出しを含み、
+1 フレームあたりのファイルも大きいので、キャプチャループの中では重い。
+.npz 形式では有効な点（z > 0）だけを残し、
+
+    points : (N, 3) float32  カメラ座標 (m)
+    colors : (N, 3) uint8    RGB（テクスチャ座標から color 画像を引いた値）
+
+の 2 配列をそのまま書く。PLY が必要になったら process/npz_to_ply.py で後から作れる。
+読み込み側（point_merge.py など）は pyrealsense2 なしで使える。
+"""
+
+import numpy as np
+
+FORMATS = ('ply', 'npz')
+
+
+def points_to_arrays(points, color_frame):
+    """rs.points と color フレームから有効点の (points, colors) を返す。"""
+    import pyrealsense2 as rs
+
+    verts = np.asanyarray(points.get_vertices()).view(np.float32).reshape(-1, 3)
+    tex   = np.asanyarray(points.get_texture_coordinates()).view(np.float32).reshape(-1, 2)
+    valid = verts[:, 2] > 0
+    verts = verts[valid]
+    tex   = tex[valid]
+
+    color = np.asanyarray(color_frame.get_data())
+    h, w  = color.shape[:2]
+    u = np.clip((tex[:, 0] * w).astype(np.int32), 0, w - 1)
+    v = np.clip((tex[:, 1] * h).astype(np.int32), 0, h - 1)
+    colors = color[v, u]
+    if color_frame.get_profile().format() == rs.format.bgr8:
+        colors = colors[:, ::-1]
+    return verts, np.ascontiguousarray(colors, dtype=np.uint8)
+
+
+def save_points(path, points, color_frame, fmt='ply'):
+    """点群を fmt（'ply' / 'npz'）で保存する。path の拡張子は呼び出し側で fmt に揃える。"""
+    import pyrealsense2 as rs
+    if fmt == 'npz':
+        verts, colors = points_to_arrays(points, color_frame)
+        np.savez(path, points=verts, colors=colors)
+    elif color_frame.get_profile().format() == rs.format.bgr8:
+        # export_to_ply はテクスチャのバイトをそのまま RGB として書くので、BGR は並べ替えてから書く
+        write_ply(path, *points_to_arrays(points, color_frame))
+    else:
+        points.export_to_ply(str(path), color_frame)
+
+
+def load_npz(path):
+    """.npz を (points (N, 3) float32, colors (N, 3) uint8 または None) で読む。"""
+    with np.load(path) as data:
+        colors = data['colors'] if 'colors' in data.files else None
+        return data['points'], colors
+
+
+def npz_to_o3d(o3d, path):
+    """.npz を open3d.geometry.PointCloud として読む（色は 0〜1 に正規化）。"""
+    points, colors = load_npz(path)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points.astype(np.float64))
+    if colors is not None:
+        pcd.colors = o3d.utility.Vector3dVector(colors.astype(np.float64) / 255.0)
+    return pcd
+
+
+def write_ply(path, points, colors=None):
+    """points / colors をバイナリ PLY（float32 xyz + uchar rgb）で書く。open3d 不要。"""
+    dtype = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        dtype += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertex = np.empty(len(points), dtype=dtype)
+    vertex['x'], vertex['y'], vertex['z'] = points.T
+    header = ['ply', 'format binary_little_endian 1.0', f'element vertex {len(points)}',
+              'property float x', 'property float y', 'property float z']
+    if colors is not None:
+        vertex['red'], vertex['green'], vertex['blue'] = colors.T
+        header += ['property uchar red', 'property uchar green', 'property uchar blue']
+    header.append('end_header')
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        vertex.tofile(f)
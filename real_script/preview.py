@@ -0,0 +1,280 @@
+"""プレビュー表示まわりの部品。
+
+PreviewCompositor
+    color / depth / IR のタイルを、起動時に 1 回だけ確保したモザイク画像へ直接書き込む。
+    np.vstack / np.hstack や applyColorMap が毎フレーム新しい配列を作るのを避けるため、
+    OpenCV の dst= 出力にモザイクのスライス（ビュー）を渡している。
+    every=N を指定すると N フレームに 1 回だけ描画し、キャプチャ周期とは独立に
+    プレビューの負荷を下げられる。
+
+RecordingPreview
+    録画スクリプト用の color + 深度プレビュー。rs.colorizer とウィンドウを起動時に
+    1 回だけ作って使い回す。mode で深度プレビューや表示そのものを止められるので、
+    .bag 録画中に CPU を録画へ回したいときに使う。
+
+PointCloudPreview
+    点群取得中の 3D プレビュー（open3d のウィンドウ）。深度を rs.decimation_filter で
+    間引いてから点群にし、専用スレッドで描画する。取得ループは最新の frameset を
+    渡すだけで、点群の計算・描画を待たない。
+"""
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class PreviewCompositor:
+    """確保済みのモザイクにタイルを書き込むプレビュー合成器。
+
+    layout はタイル名の行のリスト。例: [['ir_left', 'ir_right'], ['color', 'depth']]
+    render() に渡す画像は dtype / 次元でタイルへの書き込み方を切り替える。
+
+        (H, W, 3) uint8 : そのままコピー（color・計算済みカラーマップ）
+        (H, W)    uint8 : JET カラーマップ（IR）
+        (H, W)    uint16: 深度カラーマップ（depth_mapper = utils.DepthColormapper）
+    """
+
+    def __init__(self, width, height, layout, depth_mapper=None, every=1):
+        self.width        = width
+        self.height       = height
+        self.depth_mapper = depth_mapper
+        self.every        = max(1, int(every))
+        self.frames       = 0
+        self.rendered     = 0
+
+        rows = len(layout)
+        cols = max(len(r) for r in layout)
+        self.mosaic = np.zeros((rows * height, cols * width, 3), dtype=np.uint8)
+        self.tiles  = {}
+        for r, row in enumerate(layout):
+            for c, name in enumerate(row):
+                self.tiles[name] = self.mosaic[r * height:(r + 1) * height,
+                                               c * width:(c + 1) * width]
+
+    def due(self):
+        """このフレームを描画するか。呼ぶたびにフレームを 1 つ進める。"""
+        self.frames += 1
+        return (self.frames - 1) % self.every == 0
+
+    def render(self, images):
+        """{タイル名: 画像} をモザイクへ書き込み、モザイクを返す（毎回同じ配列）。"""
+        for name, img in images.items():
+            if img is None:
+                continue
+            tile = self.tiles[name]
+            if img.shape[:2] != tile.shape[:2]:
+                # depth_filters の decimation で深度だけ解像度が下がっている場合
+                img = cv2.resize(img, (self.width, self.height), interpolation=cv2.INTER_NEAREST)
+            if img.ndim == 3:
+                np.copyto(tile, img)
+            elif img.dtype == np.uint16:
+                self.depth_mapper.apply(img, out=tile)
+            else:
+                cv2.applyColorMap(img, cv2.COLORMAP_JET, dst=tile)
+        self.rendered += 1
+        return self.mosaic
+
+
+class RecordingPreview:
+    """録画スクリプト用のプレビュー。処理ブロックとウィンドウを使い回す。
+
+    mode='full'  : color + 深度（rs.colorizer）を並べて表示
+    mode='color' : color のみ（深度の colorize を行わない）
+    mode='none'  : ウィンドウを出さない（Ctrl+C で停止）
+    """
+
+    MODES = ('full', 'color', 'none')
+
+    def __init__(self, window, mode='full'):
+        if mode not in self.MODES:
+            raise ValueError(f"mode は {self.MODES} のいずれか: {mode}")
+        self.window     = window
+        self.mode       = mode
+        self._colorizer = None
+        self._mosaic    = None
+        if mode == 'full':
+            import pyrealsense2 as rs
+            self._colorizer = rs.colorizer()
+        if mode != 'none':
+            cv2.namedWindow(window, cv2.WINDOW_AUTOSIZE)
+
+    @property
+    def enabled(self):
+        return self.mode != 'none'
+
+    def show(self, color_image, depth_frame=None):
+        """1 フレーム表示してキーコードを返す（mode='none' では何もせず -1）。"""
+        if self.mode == 'none':
+            return -1
+        image = color_image
+        if self._colorizer is not None and depth_frame:
+            depth_image = np.asanyarray(self._colorizer.colorize(depth_frame).get_data())
+            ch, cw = color_image.shape[:2]
+            dh, dw = depth_image.shape[:2]
+            if self._mosaic is None or self._mosaic.shape != (max(ch, dh), cw + dw, 3):
+                self._mosaic = np.zeros((max(ch, dh), cw + dw, 3), dtype=np.uint8)
+            np.copyto(self._mosaic[:ch, :cw], color_image)
+            np.copyto(self._mosaic[:dh, cw:], depth_image)
+            image = self._mosaic
+        cv2.imshow(self.window, image)
+        return cv2.waitKey(1) & 0xFF
+
+
+class PointCloudPreview:
+    """取得ループと別スレッドで動く、間引き点群の 3D プレビュー。
+
+    submit(frames) は最新の frameset を 1 つだけ預けて即座に戻る（描画が追いつかない
+    フレームは上書きされて捨てられる）。プレビュースレッドは
+
+        depth → decimation_filter → threshold_filter（depth_range 指定時）
+              → rs.pointcloud（color にテクスチャマップ）→ 点群バッファを上書き → 再描画
+
+    を行う。点群バッファ（open3d の PointCloud）は起動後最初のフレームで 1 回だけ
+    確保し、以降は np.asarray() のビューへ書き込むので毎フレームの確保がない。
+    間引き後の画素数は一定なので点数も一定で、深度 0（範囲外）の点は原点に重なる。
+
+    depth は位置合わせ前のものを使う（rs.pointcloud が外部パラメータで color へ
+    マップする）ので、プレビューのために rs.align を走らせない。color は rgb8 / bgr8 のどちらでもよい。
+    open3d が無い・ウィンドウを開けない場合は警告を出して無効になる（取得は続けられる）。
+    """
+
+    def __init__(self, window='pointcloud_preview', decimation=4, depth_range=None,
+                 width=640, height=480):
+        import pyrealsense2 as rs
+        self.window      = window
+        self.width       = width
+        self.height      = height
+        self.enabled     = True
+        self.submitted   = 0
+        self.rendered    = 0
+        self.busy_sec    = 0.0
+        self._rs         = rs
+        self._decimate   = rs.decimation_filter()
+        self._decimate.set_option(rs.option.filter_magnitude, decimation)
+        self._threshold  = None
+        if depth_range is not None:
+            self._threshold = rs.threshold_filter()
+            self._threshold.set_option(rs.option.min_distance, depth_range[0])
+            self._threshold.set_option(rs.option.max_distance, depth_range[1])
+        self._pc         = rs.pointcloud()
+        self._pcd        = None
+        self._points     = None   # self._pcd の点・色のビュー（上書きして使い回す）
+        self._colors     = None
+        self._pending    = None
+        self._cond       = threading.Condition()
+        self._stop       = False
+        self._thread     = None
+
+    def start(self):
+        try:
+            import open3d   # noqa: F401
+        except ImportError:
+            print("[警告] open3d が無いため 3D プレビューを無効にします（pip install open3d）")
+            self.enabled = False
+            return self
+        self._thread = threading.Thread(target=self._run, name='pc-preview', daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, frames):
+        """frameset を預ける。前に預けた未処理の frameset は捨てる。"""
+        if not self.enabled:
+            return
+        frames.keep()
+        with self._cond:
+            self._pending = frames
+            self.submitted += 1
+            self._cond.notify()
+
+    def _take(self, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending is not None or self._stop, timeout)
+            frames, self._pending = self._pending, None
+            return frames
+
+    def _update(self, frames):
+        """frameset → 点群バッファ。バッファの点数が変わったら True（ジオメトリの再登録が要る）。"""
+        import open3d as o3d
+        import pyrealsense2 as rs
+        d_frame = frames.get_depth_frame()
+        c_frame = frames.get_color_frame()
+        if not d_frame or not c_frame:
+            return False
+        d_frame = self._decimate.process(d_frame)
+        if self._threshold is not None:
+            d_frame = self._threshold.process(d_frame)
+        self._pc.map_to(c_frame)
+        points = self._pc.calculate(d_frame)
+        xyz = np.asanyarray(points.get_vertices()).view(np.float32).reshape(-1, 3)
+        uv  = np.asanyarray(points.get_texture_coordinates()).view(np.float32).reshape(-1, 2)
+        color = np.asanyarray(c_frame.get_data())
+        ch, cw = color.shape[:2]
+
+        resized = self._pcd is None or len(self._points) != len(xyz)
+        if resized:
+            self._pcd = o3d.geometry.PointCloud()
+            self._pcd.points = o3d.utility.Vector3dVector(np.zeros((len(xyz), 3)))
+            self._pcd.colors = o3d.utility.Vector3dVector(np.zeros((len(xyz), 3)))
+            self._points = np.asarray(self._pcd.points)
+            self._colors = np.asarray(self._pcd.colors)
+        # 表示の向きを画像に合わせる（y 下・z 奥 → y 上・z 手前）
+        np.multiply(xyz, (1, -1, -1), out=self._points)
+        u = np.clip((uv[:, 0] * cw).astype(np.int32), 0, cw - 1)
+        v = np.clip((uv[:, 1] * ch).astype(np.int32), 0, ch - 1)
+        rgb = color[v, u]
+        if c_frame.get_profile().format() == rs.format.bgr8:
+            rgb = rgb[:, ::-1]
+        np.multiply(rgb, 1 / 255, out=self._colors)
+        return resized
+
+    def _run(self):
+        import open3d as o3d
+        vis = o3d.visualization.Visualizer()
+        if not vis.create_window(self.window, width=self.width, height=self.height):
+            print("\n[警告] 3D プレビューのウィンドウを開けませんでした")
+            self.enabled = False
+            return
+        added = False
+        try:
+            while not self._stop:
+                frames = self._take(timeout=0.03)
+                if frames is not None:
+                    t0 = time.perf_counter()
+                    old = self._pcd
+                    if self._update(frames) and added:
+                        vis.remove_geometry(old, reset_bounding_box=False)
+                        added = False
+                    if self._pcd is not None:
+                        if added:
+                            vis.update_geometry(self._pcd)
+                        else:
+                            vis.add_geometry(self._pcd, reset_bounding_box=not self.rendered)
+                            added = True
+                        self.rendered += 1
+                    self.busy_sec += time.perf_counter() - t0
+                if not vis.poll_events():
+                    break   # ウィンドウが閉じられた（取得は続ける）
+                vis.update_renderer()
+        finally:
+            # ウィンドウを閉じた後は submit() で frameset を keep() し続けないようにする
+            with self._cond:
+                self.enabled  = False
+                self._pending = None
+            vis.destroy_window()
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'rendered':  self.rendered,
+            'skipped':   self.submitted - self.rendered,
+            'avg_ms':    round(self.busy_sec / max(self.rendered, 1) * 1000, 2),
+        }
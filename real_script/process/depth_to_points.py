@@ -0,0 +1,141 @@
+"""
+保存済みの深度 PNG + intrinsics.json から点群を作り直すスクリプト
+
+使い方:
+  python3 process/depth_to_points.py                       # 最新の点群セッション
+  python3 process/depth_to_points.py <session_dir>
+  python3 process/depth_to_points.py <session_dir> --min-depth 0.2 --max-depth 0.6
+  python3 process/depth_to_points.py <session_dir> --format ply --workers 8
+
+pointcloud_capture.py --defer-pc で取得したセッション（点群なし）の点群を生成する。
+取得時の深度フィルタとは別の min/max で作り直すこともできる（深度 PNG はフィルタ前の生データ）。
+
+入力（セッション直下）:
+  <prefix>_00042_d.png   color に位置合わせ済みの 16-bit 深度
+  <prefix>_00042_c.jpg   color（点の色に使う。無ければ色なし）
+  intrinsics.json        color の内部パラメータと depth_scale
+出力:
+  <prefix>_00042_pc.npz（--format npz）/ <prefix>_00042_pc.ply（--format ply）
+
+深度 → XYZ は deproject.py（歪み補正込み・視線グリッドをキャッシュ）で全画素まとめて計算し、
+フレームはプロセスプールで並列に処理する。
+"""
+
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils import load_config
+from pointcloud_io import write_ply
+from deproject import deproject_points
+from point_merge import find_latest_session, load_intrinsics, _resolve_session_dir
+
+
+def depth_files(session_dir):
+    """セッション直下の深度 PNG と、対応する color / 出力のパス。"""
+    items = []
+    for d in sorted(session_dir.glob('*_d.png')):
+        stem = d.name[:-len('_d.png')]
+        items.append((d, d.with_name(f'{stem}_c.jpg'), d.with_name(f'{stem}_pc')))
+    for d in sorted(session_dir.glob('*_depth.png')):          # 旧命名
+        stem = d.name[:-len('_depth.png')]
+        items.append((d, d.with_name(f'{stem}_color.jpg'), d.with_name(f'{stem}_pointcloud')))
+    return items
+
+
+def convert(depth_path, color_path, out_base, intr, min_depth, max_depth, fmt):
+    """1 フレーム分。プロセスプールから呼ぶのでトップレベルに置く。戻り値は点数。"""
+    depth = cv2.imread(str(depth_path), cv2.IMREAD_UNCHANGED)
+    if depth is None or depth.dtype != np.uint16:
+        return -1
+    color = cv2.imread(str(color_path)) if color_path.exists() else None
+    if color is not None and color.shape[:2] != depth.shape:
+        color = None
+    points, colors = deproject_points(depth, intr, color, min_depth, max_depth)
+    if colors is not None:
+        colors = np.ascontiguousarray(colors[:, ::-1])   # BGR → RGB
+
+    out = out_base.with_name(f'{out_base.name}.{fmt}')
+    if fmt == 'npz':
+        if colors is None:
+            np.savez(out, points=points)
+        else:
+            np.savez(out, points=points, colors=colors)
+    else:
+        write_ply(out, points, colors)
+    return len(points)
+
+
+def main():
+    cfg    = load_config()
+    pc_cfg = cfg['pointcloud']
+    parser = argparse.ArgumentParser(
+        description='深度 PNG + intrinsics.json から点群を生成',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('session_dir', nargs='?', default=None,
+                        help='点群セッションのディレクトリ（省略時は最新セッション）')
+    parser.add_argument('--min-depth', type=float, default=None, dest='min_depth', metavar='F',
+                        help=f'深度フィルタの最小距離 (m)  [default: {pc_cfg["min_depth"]}]')
+    parser.add_argument('--max-depth', type=float, default=None, dest='max_depth', metavar='F',
+                        help=f'深度フィルタの最大距離 (m)  [default: {pc_cfg["max_depth"]}]')
+    parser.add_argument('--format', choices=['npz', 'ply'], default='npz',
+                        help='出力形式（point_merge.py はどちらも読める）')
+    parser.add_argument('--workers', type=int, default=None, metavar='N',
+                        help=f'並列プロセス数  [default: {pc_cfg.get("workers", 1)}]')
+    args = parser.parse_args()
+
+    min_d   = args.min_depth if args.min_depth is not None else pc_cfg['min_depth']
+    max_d   = args.max_depth if args.max_depth is not None else pc_cfg['max_depth']
+    workers = args.workers   if args.workers   is not None else pc_cfg.get('workers', 1)
+
+    if args.session_dir is None:
+        session_dir = find_latest_session(pc_cfg['output_dir'])
+        if session_dir is None:
+            print(f"セッションが見つかりません: {pc_cfg['output_dir']}")
+            sys.exit(1)
+    else:
+        session_dir = _resolve_session_dir(args.session_dir)
+    if not (session_dir / 'intrinsics.json').exists():
+        print(f"intrinsics.json が見つかりません: {session_dir}")
+        sys.exit(1)
+    intr = load_intrinsics(session_dir)
+
+    items = depth_files(session_dir)
+    if not items:
+        print(f"深度 PNG（*_d.png）が見つかりません: {session_dir}")
+        sys.exit(1)
+
+    print(f"セッション : {session_dir}")
+    print(f"フレーム数 : {len(items)}  /  深度 {min_d}〜{max_d} m  /  {args.format}  /  {workers} プロセス")
+
+    t0 = time.perf_counter()
+    jobs = list(zip(*[(d, c, o, intr, min_d, max_d, args.format) for d, c, o in items]))
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    total, failed = 0, []
+    try:
+        results = pool.map(convert, *jobs) if pool else map(convert, *jobs)
+        for i, ((d, _, _), n) in enumerate(zip(items, results), 1):
+            if n < 0:
+                failed.append(d.name)
+            else:
+                total += n
+            print(f"\r  [{i}/{len(items)}] {d.name}  ({max(n, 0)} 点)", end="", flush=True)
+    finally:
+        if pool:
+            pool.shutdown()
+    elapsed = time.perf_counter() - t0
+    print(f"\n完了: {len(items) - len(failed)} フレーム / {total:,} 点  "
+          f"({elapsed:.1f} 秒, {len(items) / elapsed:.1f} フレーム/秒)")
+    if failed:
+        print(f"  警告: 16-bit 深度として読めなかったファイル: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""point_merge.py の途中結果をセッションディレクトリにキャッシュする。
+
+<session_dir>/.merge_cache/
+    files.json          点群ファイルのハッシュ（サイズ・更新時刻が同じなら再計算しない）
+    pre_<key>.npz       前処理済み点群（ダウンサンプリング + 法線）
+    pyr_<key>.npz       --multiscale のピラミッド（粗い段 + FPFH）
+    registration.json   ペアごとの位置合わせ結果 {key: {T, fitness, rmse}}
+
+キーはファイル内容のハッシュと、その結果に効くパラメータだけから作る。
+voxel_size を変えれば前処理から、icp_threshold を変えれば位置合わせからやり直しになり、
+新しく追加されたフレームだけが計算される。
+"""
+
+import hashlib
+import json
+import threading
+
+import numpy as np
+
+CACHE_DIR = '.merge_cache'
+_VERSION  = 1
+
+
+def make_key(*parts):
+    """JSON にできる値の並びから短いハッシュキーを作る。"""
+    text = json.dumps([_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:20]
+
+
+class MergeCache:
+    """.merge_cache/ の読み書き。enabled=False なら何も読まず何も書かない。"""
+
+    def __init__(self, session_dir, enabled=True):
+        self.dir      = session_dir / CACHE_DIR
+        self.enabled  = enabled
+        self.hits     = 0
+        self.misses   = 0
+        self._lock    = threading.Lock()
+        self._files   = {}
+        self._reg     = {}
+        self._dirty   = False
+        if enabled:
+            self.dir.mkdir(exist_ok=True)
+            self._files = self._read_json('files.json')
+            self._reg   = self._read_json('registration.json')
+
+    def _read_json(self, name):
+        try:
+            with open(self.dir / name) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # --- ファイルのハッシュ ---
+
+    def file_hash(self, path):
+        """ファイル内容の SHA-1。サイズと更新時刻が前回と同じなら記録済みの値を返す。
+        キャッシュ無効時は None（ハッシュ計算もしない）。"""
+        if not self.enabled:
+            return None
+        st  = path.stat()
+        sig = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            known = self._files.get(path.name)
+        if known and known['sig'] == sig:
+            return known['sha1']
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self._lock:
+            self._files[path.name] = {'sig': sig, 'sha1': digest}
+            self._dirty = True
+        return digest
+
+    # --- 点群（前処理済み / ピラミッド）---
+
+    def load_cloud(self, o3d, key):
+        """(元の点数, 前処理済み点群) を返す。無ければ None。"""
+        if not self.enabled:
+            return None
+        path = self.dir / f'pre_{key}.npz'
+        if not path.exists():
+            self._count(False)
+            return None
+        with np.load(path) as data:
+            n_points = int(data['n_points'])
+            pcd = _arrays_to_cloud(o3d, data, '')
+        self._count(True)
+        return n_points, pcd
+
+    def save_cloud(self, key, n_points, pcd):
+        if self.enabled:
+            np.savez(self.dir / f'pre_{key}.npz', n_points=n_points, **_cloud_to_arrays(pcd, ''))
+
+    def load_pyramid(self, o3d, key, finest):
+        """(levels, fpfh) を返す。levels の最後（最も細かい段）は finest をそのまま使う。"""
+        if not self.enabled:
+            return None
+        path = self.dir / f'pyr_{key}.npz'
+        if not path.exists():
+            self._count(False)
+            return None
+        with np.load(path) as data:
+            voxels = data['voxels']
+            levels = [(float(v), _arrays_to_cloud(o3d, data, f'l{i}_'))
+                      for i, v in enumerate(voxels[:-1])]
+            levels.append((float(voxels[-1]), finest))
+            fpfh = o3d.pipelines.registration.Feature()
+            fpfh.data = data['fpfh']
+        self._count(True)
+        return levels, fpfh
+
+    def save_pyramid(self, key, levels, fpfh):
+        if not self.enabled:
+            return
+        arrays = {'voxels': np.array([v for v, _ in levels]), 'fpfh': np.asarray(fpfh.data)}
+        for i, (_, pcd) in enumerate(levels[:-1]):
+            arrays.update(_cloud_to_arrays(pcd, f'l{i}_'))
+        np.savez(self.dir / f'pyr_{key}.npz', **arrays)
+
+    # --- 位置合わせの結果 ---
+
+    def get_registration(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            hit = self._reg.get(key)
+        self._count(hit is not None)
+        if hit is None:
+            return None
+        return np.array(hit['T']), hit['fitness'], hit['rmse']
+
+    def put_registration(self, key, T, fitness, rmse):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._reg[key] = {'T': np.asarray(T).tolist(), 'fitness': fitness, 'rmse': rmse}
+            self._dirty = True
+
+    def flush(self):
+        """ハッシュと位置合わせ結果を書き出す（点群は save_* の時点で書き出し済み）。"""
+        if not (self.enabled and self._dirty):
+            return
+        with self._lock:
+            for name, data in (('files.json', self._files), ('registration.json', self._reg)):
+                with open(self.dir / name, 'w') as f:
+                    json.dump(data, f)
+            self._dirty = False
+
+
+def _cloud_to_arrays(pcd, prefix):
+    arrays = {f'{prefix}points': np.asarray(pcd.points)}
+    if pcd.has_normals():
+        arrays[f'{prefix}normals'] = np.asarray(pcd.normals)
+    if pcd.has_colors():
+        arrays[f'{prefix}colors'] = np.asarray(pcd.colors)
+    return arrays
+
+
+def _arrays_to_cloud(o3d, data, prefix):
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(data[f'{prefix}points'])
+    if f'{prefix}normals' in data.files:
+        pcd.normals = o3d.utility.Vector3dVector(data[f'{prefix}normals'])
+    if f'{prefix}colors' in data.files:
+        pcd.colors = o3d.utility.Vector3dVector(data[f'{prefix}colors'])
+    return pcd
@@ -0,0 +1,58 @@
+"""
+.npz 点群（--pc-format npz で取得）から PLY を後から作るスクリプト
+
+使い方:
+  python3 process/npz_to_ply.py                 # 最新の点群セッション
+  python3 process/npz_to_ply.py <session_dir>
+  python3 process/npz_to_ply.py <session_dir> --overwrite
+
+<prefix>_00042_pc.npz → <prefix>_00042_pc.ply（バイナリ PLY, xyz + RGB）を同じディレクトリに書く。
+対象は point_merge.collect_ply_files と同じ（旧命名 0042_pointcloud.npz も含む）。
+point_merge.py は .npz をそのまま読めるので、PLY が要るのは外部ツールで見るときだけ。
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils import load_config
+from pointcloud_io import load_npz, write_ply
+from point_merge import find_latest_session, collect_ply_files, _resolve_session_dir
+
+
+def main():
+    cfg = load_config()
+    parser = argparse.ArgumentParser(description='.npz 点群 → PLY 変換')
+    parser.add_argument('session_dir', nargs='?', default=None,
+                        help='点群セッションのディレクトリ（省略時は最新セッション）')
+    parser.add_argument('--overwrite', action='store_true', help='既存の PLY も作り直す')
+    args = parser.parse_args()
+
+    if args.session_dir is None:
+        session_dir = find_latest_session(cfg['pointcloud']['output_dir'])
+        if session_dir is None:
+            print(f"セッションが見つかりません: {cfg['pointcloud']['output_dir']}")
+            sys.exit(1)
+    else:
+        session_dir = _resolve_session_dir(args.session_dir)
+
+    files = [f for f in collect_ply_files(session_dir) if f.suffix == '.npz']
+    if not files:
+        print(f".npz 点群が見つかりません: {session_dir}")
+        sys.exit(1)
+
+    written = 0
+    for i, f in enumerate(files, 1):
+        out = f.with_suffix('.ply')
+        if out.exists() and not args.overwrite:
+            continue
+        points, colors = load_npz(f)
+        write_ply(out, points, colors)
+        written += 1
+        print(f"\r  [{i}/{len(files)}] {out.name}  ({len(points)} 点)", end="", flush=True)
+    print(f"\n完了: {written} / {len(files)} ファイル → {session_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,11 @@
   python3 process/point_merge.py <session_dir>
   python3 process/point_merge.py <session_dir> --sequential
   python3 process/point_merge.py <session_dir> --voxel-size 0.003 --icp-threshold 0.01
+  python3 process/point_merge.py <session_dir> --workers 8
+  python3 process/point_merge.py <session_dir> --sequential --multiscale
+  python3 process/point_merge.py <session_dir> --pose-graph --loop-every 10
+  python3 process/point_merge.py <session_dir> --fusion tsdf --tsdf-mesh
+  python3 process/point_merge.py <session_dir> --no-cache
 
 引数:
   session_dir   pointcloud_capture.py が出力したセッションディレクトリ
@@ -12,21 +17,42 @@
 モード:
   デフォルト    全フレームをフレーム0に位置合わせ（カメラ固定・物体静止向け）
   --sequential  各フレームを前フレームに位置合わせ（物体回転・大きな変位向け）
+  --multiscale  FPFH + RANSAC/FGR で初期変換を求め、粗 → 細の ICP で詰める。
+                --sequential と併用すると前ペアの変換を次ペアの初期値にし、
+                fitness が低いときだけ大域位置合わせをやり直す
+  --pose-graph  --sequential の結果をオドメトリとし、k フレームおき + 最終→先頭の
+                ループ閉じ込みエッジを加えて姿勢グラフを大域最適化（累積ドリフト対策）
+
+マージ方式:
+  --fusion points  位置合わせ済み点群をボクセル平均で統合（デフォルト）
+  --fusion tsdf    位置合わせの変換で color / depth 画像を TSDF ボリュームへ統合し、
+                   点群（--tsdf-mesh でメッシュ）を取り出す。センサノイズが平均化される
+
+キャッシュ（<session_dir>/.merge_cache/、merge_cache.py）:
+  前処理済み点群・ピラミッドとペアごとの位置合わせ結果を、ファイル内容のハッシュと
+  パラメータをキーに保存し、フレームを追加したときは新しい分だけ計算する。
+  入力と位置合わせのパラメータが前回と同じなら merge_result.json の変換を再利用し、
+  読み込み・ICP を省く（--fusion / --no-downsample だけ変えた場合）。--no-cache で無効
 
 依存:
   pip install open3d
 """
 
-import copy
 import sys
 import json
 import argparse
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils import load_config
+from pointcloud_io import npz_to_o3d
+from merge_cache import MergeCache, make_key
 
 
 def _import_open3d():
@@ -47,6 +73,220 @@ def preprocess(o3d, pcd, voxel_size, skip_downsample=False):
     return pcd_proc
 
 
+def read_point_cloud(o3d, path):
+    """PLY / .npz（pointcloud_io）のどちらでも open3d の PointCloud として読む。"""
+    if Path(path).suffix == '.npz':
+        return npz_to_o3d(o3d, path)
+    return o3d.io.read_point_cloud(str(path))
+
+
+def load_and_preprocess(o3d, path, voxel_size, full_resolution, cache=None):
+    """点群を 1 つ読み、(点数, 前処理済み点群) を返す。空なら前処理済みは None。
+
+    元の解像度の点群は保持しない（マージ時に stream_frames で読み直す）。
+    cache（MergeCache）があれば、同じ内容・同じパラメータの前処理結果を使い回す。
+    """
+    if cache is not None:
+        key = make_key('pre', cache.file_hash(path), voxel_size, full_resolution)
+        hit = cache.load_cloud(o3d, key)
+        if hit is not None:
+            return hit
+    pcd = read_point_cloud(o3d, path)
+    if len(pcd.points) == 0:
+        return 0, None
+    n_points, pcd_down = len(pcd.points), preprocess(o3d, pcd, voxel_size,
+                                                     skip_downsample=full_resolution)
+    if cache is not None:
+        cache.save_cloud(key, n_points, pcd_down)
+    return n_points, pcd_down
+
+
+def load_frames(o3d, paths, voxel_size, full_resolution, workers=1, cache=None):
+    """全フレームの読み込み + 前処理。結果は paths の順で [(点数, 前処理済み点群), ...]。
+
+    Open3D の読み込み・ダウンサンプリング・法線推定は C++ 側で GIL を離すので、
+    スレッドプールで並列化できる。各フレームの処理は独立で、workers の値によらず
+    直列処理と同じ結果になる。
+    """
+    n = len(paths)
+    load = partial(load_and_preprocess, o3d, voxel_size=voxel_size,
+                   full_resolution=full_resolution, cache=cache)
+    results = [None] * n
+    if workers <= 1:
+        for i, f in enumerate(paths):
+            results[i] = load(f)
+            print(f"\r  [{i+1}/{n}] {f.name}  ({results[i][0]} 点)", end="", flush=True)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(load, f): i for i, f in enumerate(paths)}
+            for done, fut in enumerate(as_completed(futures), 1):
+                i = futures[fut]
+                results[i] = fut.result()
+                print(f"\r  [{done}/{n}] {paths[i].name}  ({results[i][0]} 点)",
+                      end="", flush=True)
+    print()
+    return results
+
+
+def _prefetch(fn, items, workers=1):
+    """fn(item) の結果を items の順に 1 つずつ返す。先読みは最大 workers 個までなので、
+    同時にメモリに載るフレーム数はフレーム総数によらず一定。"""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def stream_frames(o3d, paths, workers=1):
+    """点群を paths の順に 1 つずつ読んで返す。"""
+    return _prefetch(lambda f: read_point_cloud(o3d, f), paths, workers)
+
+
+def rgbd_paths(ply_path):
+    """点群 PLY と同じショットの (color, depth) 画像のパス。
+
+    新命名 <prefix>_00042_pc.ply（.npz）→ <prefix>_00042_c.jpg / <prefix>_00042_d.png
+    旧命名 0042_pointcloud.ply          → 0042_color.jpg / 0042_depth.png
+    """
+    name = ply_path.name
+    if name.endswith(('_pc.ply', '_pc.npz')):
+        stem = name[:-len('_pc.ply')]
+        return ply_path.with_name(f'{stem}_c.jpg'), ply_path.with_name(f'{stem}_d.png')
+    stem = name[:-len('_pointcloud.ply')]
+    return ply_path.with_name(f'{stem}_color.jpg'), ply_path.with_name(f'{stem}_depth.png')
+
+
+def load_intrinsics(session_dir):
+    """pointcloud_capture.py が保存した intrinsics.json を読む。
+
+    depth_scale（深度 PNG の 1 単位 [m]）が無い古いセッションは、metadata.json の
+    カメラが D405 なら 0.0001、それ以外は 0.001 とみなす。max_depth には metadata.json の
+    取得時の深度フィルタ上限（無効なら None）を入れる。
+    """
+    with open(session_dir / 'intrinsics.json') as f:
+        intr = json.load(f)
+    meta = {}
+    try:
+        with open(session_dir / 'metadata.json') as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        pass
+    if 'depth_scale' not in intr:
+        model = (meta.get('camera') or {}).get('model')
+        intr['depth_scale'] = 0.0001 if model == 'D405' else 0.001
+    # 取得時の深度フィルタ上限（TSDF の depth_trunc に使う）
+    intr['max_depth'] = (meta.get('depth_filter') or {}).get('max_depth')
+    return intr
+
+
+def tsdf_fuse(o3d, frame_files, transforms, intr, voxel_length, sdf_trunc, depth_trunc,
+              mesh=False, workers=1):
+    """各フレームの color / depth（color に位置合わせ済み）を ScalableTSDFVolume へ統合する。
+
+    transforms はフレーム → frame0 の変換（ICP の結果）。TSDF にはその逆
+    （frame0 → カメラ）を外部パラメータとして渡す。画像は 1 フレームずつ読んで捨てる。
+    """
+    integration = o3d.pipelines.integration
+    volume = integration.ScalableTSDFVolume(
+        voxel_length=voxel_length, sdf_trunc=sdf_trunc,
+        color_type=integration.TSDFVolumeColorType.RGB8)
+    pinhole = o3d.camera.PinholeCameraIntrinsic(
+        intr['width'], intr['height'], intr['fx'], intr['fy'], intr['ppx'], intr['ppy'])
+
+    def read(f):
+        color_path, depth_path = rgbd_paths(f)
+        if not color_path.exists() or not depth_path.exists():
+            return None
+        return o3d.io.read_image(str(color_path)), o3d.io.read_image(str(depth_path))
+
+    n = len(frame_files)
+    skipped = []
+    for i, (images, T) in enumerate(zip(_prefetch(read, frame_files, workers), transforms)):
+        if images is None:
+            skipped.append(frame_files[i].name)
+            continue
+        rgbd = o3d.geometry.RGBDImage.create_from_color_and_depth(
+            images[0], images[1], depth_scale=1.0 / intr['depth_scale'],
+            depth_trunc=depth_trunc, convert_rgb_to_intensity=False)
+        volume.integrate(rgbd, pinhole, np.linalg.inv(T))
+        print(f"\r  [{i+1}/{n}]", end="", flush=True)
+    print()
+    if skipped:
+        print(f"  警告: color / depth 画像が無いためスキップ: {', '.join(skipped)}")
+    return volume.extract_triangle_mesh() if mesh else volume.extract_point_cloud()
+
+
+class VoxelAccumulator:
+    """点群を 1 フレームずつ畳み込むボクセルハッシュ。
+
+    ボクセルごとに点数と座標・色（・法線）の和だけを持ち、フレームを足したら元の点群は
+    捨ててよい。メモリはボクセル数（= 物体の表面積 / voxel_size²）で決まり、フレーム数に
+    よらない。出力はボクセル内の平均で、voxel_down_sample と同じ考え方。
+    """
+
+    _BITS   = 21                  # 1 軸あたりのビット数（±2^20 ボクセル）
+    _OFFSET = 1 << (_BITS - 1)
+
+    def __init__(self, voxel_size):
+        self.voxel_size  = voxel_size
+        self.keys        = np.zeros(0, dtype=np.int64)
+        self.sums        = None   # (ボクセル数, 1 + 3 + [3] + [3])  点数, xyz, [rgb], [normal]
+        self.has_colors  = None
+        self.has_normals = None
+        self.points_in   = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _key(self, points):
+        idx = np.floor(points / self.voxel_size).astype(np.int64) + self._OFFSET
+        return (idx[:, 0] << (2 * self._BITS)) | (idx[:, 1] << self._BITS) | idx[:, 2]
+
+    def add(self, points, colors=None, normals=None):
+        """変換済みの点（N, 3）と色・法線を畳み込む。色・法線は全フレームで揃っている分だけ使う。"""
+        if len(points) == 0:
+            return
+        if self.has_colors is None:
+            self.has_colors  = colors is not None
+            self.has_normals = normals is not None
+        cols = [np.ones((len(points), 1)), points]
+        if self.has_colors:
+            cols.append(colors)
+        if self.has_normals:
+            cols.append(normals)
+        values = np.hstack(cols)
+
+        # 既存のボクセルとこのフレームの点をまとめて、キーごとに和を取る
+        keys = np.concatenate([self.keys, self._key(points)])
+        if self.sums is not None:
+            values = np.vstack([self.sums, values])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.sums = np.zeros((len(self.keys), values.shape[1]))
+        for c in range(values.shape[1]):
+            self.sums[:, c] = np.bincount(inverse, weights=values[:, c], minlength=len(self.keys))
+        self.points_in += len(points)
+
+    def to_pointcloud(self, o3d):
+        pcd = o3d.geometry.PointCloud()
+        if self.sums is None:
+            return pcd
+        count = self.sums[:, :1]
+        pcd.points = o3d.utility.Vector3dVector(self.sums[:, 1:4] / count)
+        c = 4
+        if self.has_colors:
+            pcd.colors = o3d.utility.Vector3dVector(self.sums[:, c:c + 3] / count)
+            c += 3
+        if self.has_normals:
+            normals = self.sums[:, c:c + 3]
+            norm = np.linalg.norm(normals, axis=1, keepdims=True)
+            pcd.normals = o3d.utility.Vector3dVector(normals / np.maximum(norm, 1e-12))
+        return pcd
+
+
 def icp_register(o3d, source, target, threshold, init=None):
     if init is None:
         init = np.eye(4)
@@ -57,7 +297,214 @@ def icp_register(o3d, source, target, threshold, init=None):
     return result.transformation, result.fitness, result.inlier_rmse
 
 
+class Pyramid:
+    """1 フレームのマルチスケール表現（粗 → 細）と、最も粗い段の FPFH 特徴。
+
+    最も細かい段は前処理済み点群（voxel_size・法線推定済み）をそのまま使い、
+    それより粗い段はそこからさらにダウンサンプリングする。
+    """
+
+    def __init__(self, levels, fpfh):
+        self.levels = levels   # [(voxel, 点群), ...]  粗い順
+        self.fpfh   = fpfh
+
+    @classmethod
+    def build(cls, o3d, pcd_down, voxel_size, scales):
+        levels = []
+        for scale in sorted(scales, reverse=True):
+            v = voxel_size * scale
+            if scale == 1:
+                levels.append((v, pcd_down))
+                continue
+            pcd = pcd_down.voxel_down_sample(v)
+            pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=v * 2, max_nn=30))
+            levels.append((v, pcd))
+        coarse_v, coarse = levels[0]
+        fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+            coarse, o3d.geometry.KDTreeSearchParamHybrid(radius=coarse_v * 5, max_nn=100))
+        return cls(levels, fpfh)
+
+    @classmethod
+    def cached(cls, o3d, cache, key, pcd_down, voxel_size, scales):
+        """cache にあればそれを、無ければ build して cache へ保存する。"""
+        hit = cache.load_pyramid(o3d, key, pcd_down)
+        if hit is not None:
+            return cls(*hit)
+        pyramid = cls.build(o3d, pcd_down, voxel_size, scales)
+        cache.save_pyramid(key, pyramid.levels, pyramid.fpfh)
+        return pyramid
+
+
+def global_register(o3d, source, target, method='ransac'):
+    """粗い段の FPFH 対応から初期変換を求める（RANSAC または FGR）。"""
+    reg = o3d.pipelines.registration
+    voxel, src = source.levels[0]
+    _, tgt = target.levels[0]
+    if method == 'fgr':
+        result = reg.registration_fgr_based_on_feature_matching(
+            src, tgt, source.fpfh, target.fpfh,
+            reg.FastGlobalRegistrationOption(maximum_correspondence_distance=voxel * 0.5))
+    else:
+        dist = voxel * 1.5
+        result = reg.registration_ransac_based_on_feature_matching(
+            src, tgt, source.fpfh, target.fpfh, True, dist,
+            reg.TransformationEstimationPointToPoint(False), 3,
+            [reg.CorrespondenceCheckerBasedOnEdgeLength(0.9),
+             reg.CorrespondenceCheckerBasedOnDistance(dist)],
+            reg.RANSACConvergenceCriteria(100000, 0.999))
+    return result.transformation
+
+
+def multiscale_register(o3d, source, target, threshold, max_iter, init=None, method='ransac'):
+    """粗 → 細の ICP。init が無ければ global_register で初期変換を求める。
+
+    source / target は Pyramid。max_iter は段ごとの反復回数（levels と同じ粗い順・同じ長さ）。
+    各段の対応点距離は threshold を段の voxel 比で拡大する。
+    戻り値は最も細かい段の (T, fitness, rmse)。
+    """
+    reg = o3d.pipelines.registration
+    if not max_iter or len(max_iter) != len(source.levels):
+        raise ValueError(f"max_iter（{len(max_iter)} 段）がピラミッドの段数（{len(source.levels)}）と一致しません")
+    T = global_register(o3d, source, target, method) if init is None else init
+    base = source.levels[-1][0]
+    for (v, src), (_, tgt), it in zip(source.levels, target.levels, max_iter):
+        result = reg.registration_icp(
+            src, tgt, threshold * v / base, T,
+            reg.TransformationEstimationPointToPlane(),
+            reg.ICPConvergenceCriteria(max_iteration=it),
+        )
+        T = result.transformation
+    return T, result.fitness, result.inlier_rmse
+
+
+def cached_register(cache, register, hashes, params):
+    """register(i, j, init=None) -> (T, fitness, rmse) を cache で包む。
+
+    i, j はフレーム番号。キーは両フレームの内容ハッシュ・位置合わせのパラメータ・初期値で、
+    どれかが変わったペアだけ計算し直す。
+    """
+    def run(i, j, init=None):
+        seed = None if init is None else np.round(init, 9).tolist()
+        key = make_key('reg', hashes[i], hashes[j], params, seed)
+        hit = cache.get_registration(key)
+        if hit is not None:
+            return hit
+        T, fitness, rmse = register(i, j, init=init)
+        cache.put_registration(key, T, fitness, rmse)
+        return T, fitness, rmse
+    return run
+
+
+def _timed(register, source, target):
+    t0 = time.perf_counter()
+    T, fitness, rmse = register(source, target)
+    return T, fitness, rmse, time.perf_counter() - t0
+
+
+def register_to_target(register, sources, target, workers=1):
+    """sources の各フレームを target へ合わせる（to-frame0 モード）。
+
+    register(source, target) -> (T, fitness, rmse)。ペアごとに独立なのでスレッドプールで
+    並列に回す（Open3D の位置合わせは GIL を離す）。target は全ペアで共有し、読み取りのみ行う。
+    source / target は register が受け取るもの（点群・Pyramid・フレーム番号）なら何でもよい。
+    戻り値は sources の順で [(T, fitness, rmse, 秒), ...]。
+    """
+    n = len(sources)
+    results = [None] * n
+    if workers <= 1:
+        for i, src in enumerate(sources):
+            results[i] = _timed(register, src, target)
+            _, fitness, rmse, _ = results[i]
+            print(f"\r  [{i+1}/{n}]  fitness={fitness:.4f}  rmse={rmse:.5f}", end="", flush=True)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_timed, register, src, target): i
+                       for i, src in enumerate(sources)}
+            for done, fut in enumerate(as_completed(futures), 1):
+                results[futures[fut]] = fut.result()
+                _, fitness, rmse, _ = results[futures[fut]]
+                print(f"\r  [{done}/{n}]  fitness={fitness:.4f}  rmse={rmse:.5f}", end="", flush=True)
+    print()
+    return results
+
+
+def loop_pairs(n, every):
+    """ループ閉じ込み用の非隣接ペア (source, target)。every フレームおき + 最終 → 先頭。"""
+    pairs = []
+    if every and every > 1:
+        pairs += [(i + every, i) for i in range(0, n - every, every)]
+    if n > 2 and (n - 1, 0) not in pairs:
+        pairs.append((n - 1, 0))
+    return pairs
+
+
+def edge_errors(poses, edges):
+    """各エッジの変換と、ノード姿勢から求まる相対変換とのずれ。
+
+    edges は [(source, target, T), ...]（T は source → target）。
+    戻り値は (並進誤差 m の配列, 回転誤差 deg の配列)。
+    """
+    trans, rot = [], []
+    for s, t, T in edges:
+        D = np.linalg.inv(T) @ np.linalg.inv(poses[t]) @ poses[s]
+        trans.append(np.linalg.norm(D[:3, 3]))
+        cos = (np.trace(D[:3, :3]) - 1) / 2
+        rot.append(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0))))
+    return np.asarray(trans), np.asarray(rot)
+
+
+def _error_summary(poses, odometry, loops):
+    summary = {}
+    for name, edges in (('odometry', odometry), ('loop', loops)):
+        if not edges:
+            continue
+        t, r = edge_errors(poses, edges)
+        summary[name] = {'mean_trans_m': float(t.mean()), 'max_trans_m': float(t.max()),
+                         'mean_rot_deg': float(r.mean()), 'max_rot_deg': float(r.max())}
+    return summary
+
+
+def optimize_pose_graph(o3d, clouds, poses, odometry, loops, threshold):
+    """オドメトリ + ループ閉じ込みのエッジから姿勢グラフを作り、大域最適化する。
+
+    clouds   : 前処理済み点群（情報行列の計算に使う）
+    poses    : 各フレーム → frame0 の変換（オドメトリの累積。初期値）
+    odometry : [(i, i-1, T), ...]  隣接フレームのエッジ
+    loops    : [(i, j, T), ...]    非隣接フレームのエッジ（uncertain として扱い、外れは刈られる）
+    戻り値は (最適化後の姿勢のリスト, 誤差レポート)。
+    """
+    reg = o3d.pipelines.registration
+    graph = reg.PoseGraph()
+    for pose in poses:
+        graph.nodes.append(reg.PoseGraphNode(pose))
+    for edges, uncertain in ((odometry, False), (loops, True)):
+        for s, t, T in edges:
+            info = reg.get_information_matrix_from_point_clouds(clouds[s], clouds[t], threshold, T)
+            graph.edges.append(reg.PoseGraphEdge(s, t, T, info, uncertain=uncertain))
+
+    before = _error_summary(poses, odometry, loops)
+    reg.global_optimization(
+        graph,
+        reg.GlobalOptimizationLevenbergMarquardt(),
+        reg.GlobalOptimizationConvergenceCriteria(),
+        reg.GlobalOptimizationOption(max_correspondence_distance=threshold,
+                                     edge_prune_threshold=0.25,
+                                     reference_node=0),
+    )
+    optimized = [np.asarray(node.pose) for node in graph.nodes]
+    after = _error_summary(optimized, odometry, loops)
+    report = {
+        'odometry_edges': len(odometry),
+        'loop_edges':     len(loops),
+        'edges_kept':     len(graph.edges),   # 外れと判定されたループエッジは刈られる
+        'error_before':   before,
+        'error_after':    after,
+    }
+    return optimized, report
+
+
 MERGED_NAME = 'merged_pc.ply'          # 新命名での出力名
+MERGED_MESH_NAME = 'merged_mesh.ply'   # --fusion tsdf --tsdf-mesh の出力名
 _LEGACY_MERGED_NAME = 'merged_pointcloud.ply'
 
 
@@ -88,14 +535,18 @@ def session_prefix(session_dir):
 
 
 def collect_ply_files(session_dir):
-    """セッション直下の点群PLYを列挙する（マージ結果は除外）。
+    """セッション直下の点群ファイルを列挙する（マージ結果は除外）。
 
-    新命名 <prefix>_00042_pc.ply / 旧命名 0042_pointcloud.ply の両方に対応。
+    新命名 <prefix>_00042_pc.ply / .npz（--pc-format npz）と旧命名 0042_pointcloud.ply / .npz に対応。
+    同じショットに .ply と .npz の両方があれば読み込みの速い .npz を使う。
     """
     found = list(session_dir.glob('*_pc.ply')) + list(session_dir.glob('*_pointcloud.ply'))
-    return sorted(f for f in found
-                  if f.name not in (MERGED_NAME, _LEGACY_MERGED_NAME)
-                  and not f.name.endswith('_' + MERGED_NAME))
+    found = {f.with_suffix(''): f for f in found
+             if f.name not in (MERGED_NAME, _LEGACY_MERGED_NAME)
+             and not f.name.endswith('_' + MERGED_NAME)}
+    for f in list(session_dir.glob('*_pc.npz')) + list(session_dir.glob('*_pointcloud.npz')):
+        found[f.with_suffix('')] = f
+    return sorted(found.values())
 
 
 def _resolve_session_dir(given: str) -> Path:
@@ -121,6 +572,8 @@ def main():
     o3d = _import_open3d()
     cfg    = load_config()
     pc_cfg = cfg['pointcloud']
+    ms_cfg = pc_cfg.get('multiscale') or {}
+    pg_cfg = pc_cfg.get('pose_graph') or {}
 
     parser = argparse.ArgumentParser(
         description='点群の位置合わせ・マージ',
@@ -140,10 +593,51 @@ def main():
                         help='出力点群のダウンサンプリングをスキップ')
     parser.add_argument('--full-resolution', action='store_true', dest='full_resolution',
                         help='ICP前処理・出力ともにダウンサンプリングなし（低速・高品質）')
+    parser.add_argument('--multiscale', action='store_true',
+                        help='大域位置合わせ（FPFH）+ 粗→細の多段 ICP（大きな回転・低 fitness 対策）')
+    parser.add_argument('--global-method', choices=['ransac', 'fgr'], default=None,
+                        dest='global_method',
+                        help=f'--multiscale の大域位置合わせ手法'
+                             f'  [default: {ms_cfg.get("global_method", "ransac")}]')
+    parser.add_argument('--pose-graph', action='store_true', dest='pose_graph',
+                        help='姿勢グラフ最適化 + ループ閉じ込み（--sequential を含む）')
+    parser.add_argument('--loop-every', type=int, default=None, dest='loop_every', metavar='K',
+                        help=f'K フレームおきにループ閉じ込みエッジを張る'
+                             f'  [default: {pg_cfg.get("loop_every", 5)}]')
+    parser.add_argument('--fusion', choices=['points', 'tsdf'], default='points',
+                        help='マージ方式: points（点群のボクセル平均） / tsdf（RGB-D の TSDF 統合）')
+    parser.add_argument('--tsdf-mesh', action='store_true', dest='tsdf_mesh',
+                        help='--fusion tsdf でメッシュを出力（既定は点群）')
+    parser.add_argument('--workers', type=int, default=None, metavar='N',
+                        help=f'読み込み・前処理・ICP（to-frame0）の並列スレッド数'
+                             f'  [default: {pc_cfg.get("workers", 1)}]')
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+                        help='セッション内のキャッシュ（.merge_cache/）を読み書きしない')
     args = parser.parse_args()
 
     voxel_size    = args.voxel_size    if args.voxel_size    is not None else pc_cfg['voxel_size']
     icp_threshold = args.icp_threshold if args.icp_threshold is not None else pc_cfg['icp_threshold']
+    workers       = args.workers       if args.workers       is not None else pc_cfg.get('workers', 1)
+    global_method = args.global_method or ms_cfg.get('global_method', 'ransac')
+    ms_scales     = ms_cfg.get('scales', [4, 2, 1])
+    ms_max_iter   = ms_cfg.get('max_iter', [50, 30, 14])
+    if args.multiscale:
+        if not ms_scales or len(ms_scales) != len(ms_max_iter):
+            print(f"config.yaml の pointcloud.multiscale が不正です: scales={ms_scales}"
+                  f" と max_iter={ms_max_iter} は同じ長さ（1 段以上）にしてください")
+            sys.exit(1)
+        # 段と反復回数を組にしてから粗い順に並べる（Pyramid.levels と同じ順）
+        pairs       = sorted(zip(ms_scales, ms_max_iter), key=lambda p: p[0], reverse=True)
+        ms_scales   = [sc for sc, _ in pairs]
+        ms_max_iter = [it for _, it in pairs]
+    loop_every    = args.loop_every if args.loop_every is not None else pg_cfg.get('loop_every', 5)
+    if args.fusion == 'tsdf':
+        tsdf_cfg    = pc_cfg.get('tsdf') or {}
+        tsdf_voxel  = tsdf_cfg.get('voxel_length', voxel_size)
+        tsdf_trunc  = tsdf_cfg.get('sdf_trunc', tsdf_voxel * 5)
+        depth_trunc = pc_cfg['max_depth']   # 取得時の深度フィルタ上限があればそちらを使う
+    if args.pose_graph:
+        args.sequential = True   # オドメトリは frame→frame の位置合わせから作る
 
     if args.session_dir is None:
         session_dir = find_latest_session(pc_cfg['output_dir'])
@@ -162,112 +656,275 @@ def main():
     ply_files = collect_ply_files(session_dir)
     n = len(ply_files)
     if n == 0:
-        print(f"点群PLY（*_pc.ply / *_pointcloud.ply）が見つかりません: {session_dir}")
+        print(f"点群（*_pc.ply / *_pc.npz / *_pointcloud.ply）が見つかりません: {session_dir}")
         sys.exit(1)
 
+    if args.fusion == 'tsdf':
+        if not (session_dir / 'intrinsics.json').exists():
+            print(f"intrinsics.json が見つかりません（--fusion tsdf に必要）: {session_dir}")
+            sys.exit(1)
+        intr = load_intrinsics(session_dir)
+        depth_trunc = intr.get('max_depth') or depth_trunc
+
     full_resolution = args.full_resolution
     no_downsample   = args.no_downsample or full_resolution
 
     method_label = "sequential (frame→frame)" if args.sequential else "all→frame0"
+    if args.pose_graph:
+        method_label += f" + pose graph (loop every {loop_every})"
     res_label    = "フルレゾリューション（低速）" if full_resolution else f"voxel_size={voxel_size} m"
     print(f"セッション : {session_dir}")
     print(f"フレーム数 : {n}")
     print(f"ICP 方式   : {method_label}")
+    if args.multiscale:
+        print(f"多段 ICP   : scales={ms_scales}  max_iter={ms_max_iter}  大域={global_method}")
     print(f"解像度     : {res_label}  /  icp_threshold={icp_threshold} m")
+    print(f"並列数     : {workers}")
     if full_resolution:
         print("  ※ フルレゾリューションは処理時間が大幅に増加します")
     print()
 
-    # --- 読み込み ---
-    print("点群を読み込み中...")
-    pcds = []
-    for i, f in enumerate(ply_files):
-        pcd = o3d.io.read_point_cloud(str(f))
-        if len(pcd.points) == 0:
-            print(f"\n  警告: {f.name} は空です。スキップします。")
-            continue
-        pcds.append(pcd)
-        print(f"\r  [{i+1}/{n}] {f.name}  ({len(pcd.points)} 点)", end="", flush=True)
-    print()
-    n = len(pcds)
+    # --- 前回の位置合わせの再利用 ---
+    # 入力ファイルの内容と位置合わせのパラメータが前回（merge_result.json）と同じなら、
+    # 読み込み・ICP を飛ばして前回の変換を使う（--fusion / --no-downsample だけ変えた場合など）
+    cache = MergeCache(session_dir, enabled=not args.no_cache)
+    reg_params = {
+        'voxel_size':      voxel_size,
+        'full_resolution': full_resolution,
+        'icp_threshold':   icp_threshold,
+        'multiscale':      ({'scales': ms_scales, 'max_iter': ms_max_iter,
+                             'global_method': global_method} if args.multiscale else None),
+    }
+    method = 'pose_graph' if args.pose_graph else 'sequential' if args.sequential else 'to_frame0'
+    registration_key = None
+    previous = None
+    if cache.enabled:
+        registration_key = make_key('merge', [cache.file_hash(f) for f in ply_files], reg_params,
+                                    method, loop_every if args.pose_graph else None)
+        try:
+            with open(session_dir / 'merge_result.json') as f:
+                previous = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            pass
+        if previous is not None and previous.get('registration_key') != registration_key:
+            previous = None
+
+    if previous is not None:
+        print("入力と位置合わせのパラメータが前回と同じため、前回の変換を再利用します")
+        frame_stats = previous['frames']
+        frame_files = [session_dir / s['file'] for s in frame_stats]
+        transforms  = [np.asarray(T) for T in previous['transforms']]
+        pose_graph_report = previous.get('pose_graph')
+        n = len(frame_files)
+        timing = {'registration_reused': True}
+    else:
+        # --- 読み込み + 前処理（ダウンサンプリング + 法線推定）---
+        print("点群を読み込み・前処理中...")
+        t0 = time.perf_counter()
+        pcds_down, frame_files = [], []
+        for f, (_, pcd_down) in zip(ply_files, load_frames(o3d, ply_files, voxel_size,
+                                                           full_resolution, workers, cache)):
+            if pcd_down is None:
+                print(f"  警告: {f.name} は空です。スキップします。")
+                continue
+            pcds_down.append(pcd_down)
+            frame_files.append(f)
+        n = len(pcds_down)
+        timing = {'load_sec': round(time.perf_counter() - t0, 3)}
+
+        if n == 0:
+            print("有効な点群がありませんでした。")
+            sys.exit(1)
 
-    if n == 0:
-        print("有効な点群がありませんでした。")
-        sys.exit(1)
+        transforms = [np.eye(4)]   # フレーム0 は恒等変換
+        pose_graph_report = None
+        frame_stats = [{'file': frame_files[0].name, 'fitness': 1.0, 'rmse': 0.0, 'icp_sec': 0.0}]
+        hashes = [cache.file_hash(f) for f in frame_files]
+
+        if n > 1:
+            # --- ICP 位置合わせ ---
+            print("\nICP 位置合わせ中...")
+            t0 = time.perf_counter()
+            pair_results = []
+
+            if args.multiscale:
+                # 各フレームのピラミッド（粗い段 + FPFH）は 1 回だけ作る（キャッシュがあれば読む）
+                pyramids = [None] * n
+
+                def pyramid(i):
+                    if pyramids[i] is None:
+                        key = make_key('pyr', hashes[i], voxel_size, full_resolution, ms_scales)
+                        pyramids[i] = Pyramid.cached(o3d, cache, key, pcds_down[i],
+                                                     voxel_size, ms_scales)
+                    return pyramids[i]
+
+                register = cached_register(
+                    cache,
+                    lambda i, j, init=None: multiscale_register(
+                        o3d, pyramid(i), pyramid(j), icp_threshold, ms_max_iter,
+                        init=init, method=global_method),
+                    hashes, reg_params)
+            else:
+                register = cached_register(
+                    cache,
+                    lambda i, j, init=None: icp_register(o3d, pcds_down[i], pcds_down[j],
+                                                         icp_threshold, init=init),
+                    hashes, reg_params)
+
+            if args.multiscale and args.sequential:
+                # 前ペアの相対変換を次ペアの初期値にする（ターンテーブルの等速回転を想定）。
+                # 初期値から始めて fitness が低ければ大域位置合わせからやり直す
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                    list(pool.map(pyramid, range(n)))
+                cumulative = np.eye(4)
+                seed, n_global = None, 0
+                for i in range(1, n):
+                    T, fitness, rmse, sec = _timed(partial(register, init=seed), i, i - 1)
+                    if seed is None:
+                        n_global += 1
+                    elif fitness < 0.5:
+                        T, fitness, rmse, sec2 = _timed(register, i, i - 1)
+                        sec += sec2
+                        n_global += 1
+                    seed = T
+                    cumulative = cumulative @ T
+                    transforms.append(cumulative.copy())
+                    pair_results.append((T, fitness, rmse, sec))
+                    print(f"\r  [{i}/{n-1}]  fitness={fitness:.4f}  rmse={rmse:.5f}", end="", flush=True)
+                print()
+                print(f"  大域位置合わせ: {n_global} / {n - 1} ペア（残りは前ペアの変換から開始）")
+            elif args.sequential:
+                # 各フレームを前フレームへ合わせ、累積変換で frame0 座標系へ
+                cumulative = np.eye(4)
+                for i in range(1, n):
+                    T, fitness, rmse, sec = _timed(register, i, i - 1)
+                    cumulative = cumulative @ T
+                    transforms.append(cumulative.copy())
+                    pair_results.append((T, fitness, rmse, sec))
+                    print(f"\r  [{i}/{n-1}]  fitness={fitness:.4f}  rmse={rmse:.5f}", end="", flush=True)
+                print()
+            else:
+                # 全フレームを frame0 へ直接合わせ（ペアごとに独立なので並列）。
+                # --multiscale のピラミッドは各ペアの中で必要になった時点で作る
+                if args.multiscale:
+                    pyramid(0)   # 全ペアで共有する target は先に作っておく
+                pair_results = register_to_target(register, range(1, n), 0, workers)
+                transforms += [T for T, _, _, _ in pair_results]
+            timing['icp_sec'] = round(time.perf_counter() - t0, 3)
+
+            if args.pose_graph and n > 2:
+                # --- ループ閉じ込み + 姿勢グラフ最適化 ---
+                print("\n姿勢グラフ最適化中...")
+                t0 = time.perf_counter()
+
+                def register_loop(pair):
+                    # 初期値はオドメトリの累積から求めた相対変換
+                    i, j = pair
+                    return register(i, j, init=np.linalg.inv(transforms[j]) @ transforms[i])
+
+                pairs = loop_pairs(n, loop_every)
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                    loop_results = list(pool.map(register_loop, pairs))
+                odometry = [(i, i - 1, pair_results[i - 1][0]) for i in range(1, n)]
+                loops    = [(i, j, T) for (i, j), (T, _, _) in zip(pairs, loop_results)]
+                transforms, pose_graph_report = optimize_pose_graph(
+                    o3d, pcds_down, transforms, odometry, loops, icp_threshold)
+                timing['pose_graph_sec'] = round(time.perf_counter() - t0, 3)
+
+                print(f"  エッジ: オドメトリ {len(odometry)} / ループ {len(loops)}"
+                      f"  → 最適化後 {pose_graph_report['edges_kept']}")
+                for name in ('odometry', 'loop'):
+                    b = pose_graph_report['error_before'].get(name)
+                    a = pose_graph_report['error_after'].get(name)
+                    if b and a:
+                        print(f"  {name:<8} 誤差  並進 {b['mean_trans_m'] * 1000:.2f} → "
+                              f"{a['mean_trans_m'] * 1000:.2f} mm  回転 {b['mean_rot_deg']:.2f} → "
+                              f"{a['mean_rot_deg']:.2f} deg（平均）")
+
+            low_fitness_warn = []
+            for i, (_, fitness, rmse, sec) in enumerate(pair_results, 1):
+                frame_stats.append({'file': frame_files[i].name, 'fitness': fitness,
+                                    'rmse': rmse, 'icp_sec': round(sec, 4)})
+                if fitness < 0.5:
+                    low_fitness_warn.append((i, fitness))
+            icp_secs = [sec for _, _, _, sec in pair_results]
+            print(f"  ICP: {timing['icp_sec']:.1f} 秒"
+                  f"（1 フレーム平均 {np.mean(icp_secs):.2f} 秒 / 最大 {np.max(icp_secs):.2f} 秒）")
+
+            if low_fitness_warn:
+                print("\n  警告: 以下のフレームは位置合わせ精度が低い可能性があります（fitness < 0.5）")
+                for idx, fit in low_fitness_warn:
+                    print(f"    frame {idx:04d}: fitness={fit:.4f}")
 
-    transforms = [np.eye(4)]   # フレーム0 は恒等変換
+        cache.flush()
+        if cache.enabled:
+            timing['cache'] = {'hits': cache.hits, 'misses': cache.misses}
+            print(f"  キャッシュ: {cache.hits} ヒット / {cache.misses} ミス  ({cache.dir})")
 
-    if n > 1:
-        # --- 前処理（ダウンサンプリング + 法線推定）---
-        print("\n前処理中...")
-        pcds_down = []
-        for i, pcd in enumerate(pcds):
-            pcds_down.append(preprocess(o3d, pcd, voxel_size, skip_downsample=full_resolution))
+    # --- フルレゾリューション点群のマージ ---
+    # 1 フレームずつ読み直して変換し、ボクセルハッシュへ畳み込んだら捨てる（ストリーミング）
+    t0 = time.perf_counter()
+    if args.fusion == 'tsdf':
+        print(f"\nTSDF 統合中...  (voxel={tsdf_voxel} m, sdf_trunc={tsdf_trunc} m, "
+              f"depth_trunc={depth_trunc} m)")
+        merged = tsdf_fuse(o3d, frame_files, transforms, intr, tsdf_voxel, tsdf_trunc,
+                           depth_trunc, mesh=args.tsdf_mesh, workers=workers)
+    elif no_downsample:
+        print("\n点群をマージ中...")
+        merged = o3d.geometry.PointCloud()
+        for i, (pcd, T) in enumerate(zip(stream_frames(o3d, frame_files, workers), transforms)):
+            merged += pcd.transform(T)
             print(f"\r  [{i+1}/{n}]", end="", flush=True)
         print()
-
-        # --- ICP 位置合わせ ---
-        print("\nICP 位置合わせ中...")
-        low_fitness_warn = []
-
-        if args.sequential:
-            # 各フレームを前フレームへ合わせ、累積変換で frame0 座標系へ
-            cumulative = np.eye(4)
-            for i in range(1, n):
-                T, fitness, rmse = icp_register(
-                    o3d, pcds_down[i], pcds_down[i - 1], icp_threshold
-                )
-                cumulative = cumulative @ T
-                transforms.append(cumulative.copy())
-                if fitness < 0.5:
-                    low_fitness_warn.append((i, fitness))
-                print(f"\r  [{i}/{n-1}]  fitness={fitness:.4f}  rmse={rmse:.5f}", end="", flush=True)
-        else:
-            # 全フレームを frame0 へ直接合わせ
-            for i in range(1, n):
-                T, fitness, rmse = icp_register(
-                    o3d, pcds_down[i], pcds_down[0], icp_threshold
-                )
-                transforms.append(T)
-                if fitness < 0.5:
-                    low_fitness_warn.append((i, fitness))
-                print(f"\r  [{i}/{n-1}]  fitness={fitness:.4f}  rmse={rmse:.5f}", end="", flush=True)
+    else:
+        print("\n点群をマージ中...")
+        acc = VoxelAccumulator(voxel_size)
+        for i, (pcd, T) in enumerate(zip(stream_frames(o3d, frame_files, workers), transforms)):
+            pcd.transform(T)
+            acc.add(np.asarray(pcd.points),
+                    np.asarray(pcd.colors)  if pcd.has_colors()  else None,
+                    np.asarray(pcd.normals) if pcd.has_normals() else None)
+            print(f"\r  [{i+1}/{n}]  {len(acc):,} ボクセル", end="", flush=True)
         print()
+        merged = acc.to_pointcloud(o3d)
+        print(f"ダウンサンプリング: {acc.points_in:,} → {len(merged.points):,} 点")
 
-        if low_fitness_warn:
-            print("\n  警告: 以下のフレームは位置合わせ精度が低い可能性があります（fitness < 0.5）")
-            for idx, fit in low_fitness_warn:
-                print(f"    frame {idx:04d}: fitness={fit:.4f}")
-
-    # --- フルレゾリューション点群のマージ ---
-    print("\n点群をマージ中...")
-    merged = o3d.geometry.PointCloud()
-    for pcd, T in zip(pcds, transforms):
-        pcd_copy = copy.deepcopy(pcd)
-        merged += pcd_copy.transform(T)
-
-    # --- 最終ダウンサンプリング ---
-    if not no_downsample:
-        before = len(merged.points)
-        merged = merged.voxel_down_sample(voxel_size)
-        print(f"ダウンサンプリング: {before:,} → {len(merged.points):,} 点")
+    timing['merge_sec'] = round(time.perf_counter() - t0, 3)
 
     # --- 保存 ---
-    out_path = session_dir / f'{session_prefix(session_dir)}_{MERGED_NAME}'
+    is_mesh  = args.fusion == 'tsdf' and args.tsdf_mesh
+    out_path = session_dir / f'{session_prefix(session_dir)}_{MERGED_MESH_NAME if is_mesh else MERGED_NAME}'
     if out_path.exists():
         print(f"\n上書き: {out_path}")
-    o3d.io.write_point_cloud(str(out_path), merged)
-    print(f"完了: {len(merged.points):,} 点 → {out_path}")
+    if is_mesh:
+        merged.compute_vertex_normals()
+        o3d.io.write_triangle_mesh(str(out_path), merged)
+        n_out = len(merged.vertices)
+        print(f"完了: {n_out:,} 頂点 / {len(merged.triangles):,} 面 → {out_path}")
+    else:
+        o3d.io.write_point_cloud(str(out_path), merged)
+        n_out = len(merged.points)
+        print(f"完了: {n_out:,} 点 → {out_path}")
 
     # --- 結果メタデータ保存 ---
     result_meta = {
         'input_frames':  n,
-        'method':        'sequential' if args.sequential else 'to_frame0',
+        'method':        method,
         'voxel_size':    voxel_size,
         'icp_threshold': icp_threshold,
-        'output_points': len(merged.points),
+        'multiscale':    ({'scales': ms_scales, 'max_iter': ms_max_iter,
+                           'global_method': global_method} if args.multiscale else None),
+        'pose_graph':    pose_graph_report,   # エッジ数と最適化前後の誤差（--pose-graph 時）
+        'fusion':        ({'method': 'tsdf', 'voxel_length': tsdf_voxel, 'sdf_trunc': tsdf_trunc,
+                           'depth_trunc': depth_trunc, 'mesh': args.tsdf_mesh}
+                          if args.fusion == 'tsdf' else {'method': 'points'}),
+        'output_points': n_out,
         'output_file':   out_path.name,
-        'transforms':    [T.tolist() for T in transforms],
+        'workers':       workers,
+        'timing':        timing,
+        'frames':        frame_stats,   # フレームごとの fitness / rmse / ICP 所要時間
+        'transforms':    [np.asarray(T).tolist() for T in transforms],
+        'registration_key': registration_key,   # 次回、同じなら位置合わせを再利用する
     }
     with open(session_dir / 'merge_result.json', 'w') as f:
         json.dump(result_meta, f, indent=2)
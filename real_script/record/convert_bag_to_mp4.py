@@ -1,54 +1,202 @@
-# bagファイルをmp4に変換するスクリプト
-# 使い方: python3 convert_bag_to_mp4.py <bagファイルパス>
+# bagファイルをmp4に変換するスクリプト（複数ファイル・複数トラックのバッチ変換）
+# 使い方:
+#   python3 convert_bag_to_mp4.py <bagファイルパス>
+#   python3 convert_bag_to_mp4.py <bagファイルパス> --tracks color depth ir
+#   python3 convert_bag_to_mp4.py <bagを含むディレクトリ> --workers 4
+#   python3 convert_bag_to_mp4.py <bagファイルパス> --encoder ffmpeg --crf 26 --tracks color depth_raw
+#
+# 実時間再生をオフ（set_real_time(False)）にして .bag を読める最速で読み、トラックごとに
+# 別ファイルへ別スレッド（video_writer.VideoTrackWriter）で書き出す。30 分の録画でも
+# 変換は 30 分かからない。ディレクトリを渡すと中の .bag をプロセスプールで並列に変換する。
+# エンコーダは config.yaml の video セクション（--encoder / --codec / --crf / --preset で上書き）。
+#
+# 出力（.bag と同じディレクトリ。--out-dir で変更可）:
+#   <name>.mp4                    color
+#   <name>_dc.mp4                 深度カラーマップ（--tracks depth。config.yaml の depth_alpha）
+#   <name>_i1.mp4 / <name>_i2.mp4 IR 左 / 右（--tracks ir。.bag に IR がある場合）
+#   <name>_d.mkv                  16bit 深度の生データ（--tracks depth_raw。FFV1 で可逆。要 ffmpeg）
+# 解像度・FPS は .bag に記録されたストリームのものを使う。
 
 import pyrealsense2 as rs
 import numpy as np
 import cv2
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from utils import load_config, build_parser, apply_args
-
-_args = build_parser(bag_input=True).parse_args()
-_cfg  = apply_args(load_config(), _args)
-
-W   = _cfg['camera']['width']
-H   = _cfg['camera']['height']
-FPS = _cfg['camera']['fps']
-
-bag_path = os.path.expanduser(_args.bag_path)
-
-if not os.path.exists(bag_path):
-    print(f"指定された.bagファイルが見つかりません: {bag_path}")
-    sys.exit(1)
-
-filename = os.path.splitext(os.path.basename(bag_path))[0]
-mp4_path = os.path.join(os.path.dirname(bag_path), f"{filename}.mp4")
-
-pipeline = rs.pipeline()
-config = rs.config()
-rs.config.enable_device_from_file(config, bag_path, repeat_playback=False)
-config.enable_stream(rs.stream.color, W, H, rs.format.bgr8, FPS)
-profile = pipeline.start(config)
-
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-video_writer = cv2.VideoWriter(mp4_path, fourcc, FPS, (W, H))
-
-print(f"変換開始: {bag_path} → {filename}.mp4")
-
-try:
-    while True:
-        frames = pipeline.wait_for_frames()
-        color_frame = frames.get_color_frame()
-        if not color_frame:
-            continue
-        color_image = np.asanyarray(color_frame.get_data())
-        video_writer.write(color_image)
-except RuntimeError:
-    print("最後まで再生されました。")
-finally:
-    pipeline.stop()
-    video_writer.release()
-    cv2.destroyAllWindows()
-    print(f"MP4出力完了: {mp4_path}")
+from utils import (load_config, build_parser, apply_args, bag_info, get_depth_alpha,
+                   depth_colormapper, mod_code)
+from video_writer import VideoTrackWriter, video_encoder, describe_encoder
+
+TRACKS = ['color', 'depth', 'ir', 'depth_raw']
+_MAX_TIMEOUTS = 10   # 再生中なのにフレームが来ない状態がこれだけ続いたら打ち切る
+
+
+def _stream_fps(profile):
+    """{(stream, index): fps}。"""
+    return {(s.stream_type(), s.stream_index()): s.fps() for s in profile.get_streams()}
+
+
+def transcode(bag_path, out_dir, tracks, cfg):
+    """.bag 1 本を変換する。プロセスプールから呼ぶのでトップレベルに置く。戻り値は集計 dict。"""
+    bag_path = Path(bag_path)
+    stem     = bag_path.stem
+    info     = bag_info(bag_path)
+    depth_mapper = (depth_colormapper(cfg, get_depth_alpha(cfg, info['model']))
+                    if 'depth' in tracks else None)
+    enc       = video_encoder(cfg)
+    depth_enc = video_encoder(cfg, kind='depth') if 'depth_raw' in tracks else None
+
+    pipeline = rs.pipeline()
+    config   = rs.config()
+    config.enable_device_from_file(str(bag_path), repeat_playback=False)
+    profile  = pipeline.start(config)
+    playback = profile.get_device().as_playback()
+    playback.set_real_time(False)   # 書き出しが終わるまで次のフレームを待つ（最速・取りこぼしなし）
+    duration = playback.get_duration().total_seconds()
+    fps      = _stream_fps(profile)
+
+    writers = {}
+    last    = {}
+
+    def put(track, name, frame, image, encoder=enc):
+        # 同じフレームが複数の frameset に入ってくる場合があるので frame_number で重複を除く
+        n = frame.get_frame_number()
+        if last.get(track) == n:
+            return
+        last[track] = n
+        if track not in writers:
+            key = (frame.get_profile().stream_type(), frame.get_profile().stream_index())
+            writers[track] = VideoTrackWriter(Path(out_dir) / (name + encoder['ext']),
+                                              fps.get(key, 30), encoder=encoder)
+        writers[track].submit(image)
+
+    t0 = time.perf_counter()
+    timeouts = 0
+    try:
+        while timeouts < _MAX_TIMEOUTS:
+            ok, frames = pipeline.try_wait_for_frames(1000)
+            if not ok:
+                if playback.current_status() == rs.playback_status.stopped:
+                    break
+                timeouts += 1
+                continue
+            timeouts = 0
+
+            color = frames.get_color_frame()
+            if 'color' in tracks and color:
+                image = np.asanyarray(color.get_data())
+                if color.get_profile().format() == rs.format.rgb8:
+                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+                put('color', stem, color, image)
+
+            depth = frames.get_depth_frame()
+            if depth_mapper is not None and depth:
+                put('depth', f"{stem}_{mod_code('depth_colormap')}", depth,
+                    depth_mapper.apply(np.asanyarray(depth.get_data())))
+            if depth_enc is not None and depth:
+                put('depth_raw', f"{stem}_{mod_code('depth')}", depth,
+                    np.asanyarray(depth.get_data()), encoder=depth_enc)
+
+            if 'ir' in tracks:
+                for idx, modality in ((1, 'ir_left'), (2, 'ir_right')):
+                    ir = frames.get_infrared_frame(idx)
+                    if ir:
+                        put(modality, f'{stem}_{mod_code(modality)}', ir,
+                            np.asanyarray(ir.get_data()))
+    finally:
+        pipeline.stop()
+        for w in writers.values():
+            w.close()
+    elapsed = time.perf_counter() - t0
+
+    track_stats = {t: w.stats() for t, w in writers.items()}
+    frames_max  = max((s['frames'] for s in track_stats.values()), default=0)
+    return {
+        'file':        str(bag_path),
+        'duration':    duration,
+        'elapsed':     elapsed,
+        'fps':         frames_max / elapsed if elapsed else 0.0,
+        'speed':       duration / elapsed if elapsed else 0.0,
+        'tracks':      track_stats,
+        'truncated':   timeouts >= _MAX_TIMEOUTS,
+    }
+
+
+def _print_summary(result):
+    print(f"{Path(result['file']).name}: 録画 {result['duration']:.1f} 秒 → 変換 {result['elapsed']:.1f} 秒"
+          f"  ({result['fps']:.1f} フレーム/秒, {result['speed']:.1f} 倍速)")
+    for track, s in result['tracks'].items():
+        line = f"  {track:<9} {s['frames']:>6} フレーム  エンコード {s['encode_sec']:.1f} 秒  → {s['path']}"
+        if s['error']:
+            line += f"  [エラー: {s['error']}]"
+        print(line)
+    if result['truncated']:
+        print("  警告: フレームが来なくなったため途中で打ち切りました")
+
+
+def main():
+    parser = build_parser(bag_input=True, include_encoder=True)
+    parser.add_argument('--tracks', nargs='+', choices=TRACKS, default=['color'],
+                        help='書き出すトラック（color / depth: 深度カラーマップ / ir: IR 左右'
+                             ' / depth_raw: 16bit 深度を可逆圧縮）')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='ディレクトリ指定時に並列で変換する .bag の数（プロセス数）')
+    parser.add_argument('--out-dir', type=str, default=None, dest='out_dir', metavar='DIR',
+                        help='出力先（省略時は .bag と同じディレクトリ）')
+    args = parser.parse_args()
+    cfg  = apply_args(load_config(), args)
+    try:
+        enc = video_encoder(cfg)
+        if 'depth_raw' in args.tracks:
+            video_encoder(cfg, kind='depth')
+    except (RuntimeError, ValueError) as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+
+    src = Path(os.path.expanduser(args.bag_path))
+    if src.is_dir():
+        bags = sorted(src.glob('*.bag'))
+    elif src.exists():
+        bags = [src]
+    else:
+        print(f"指定された.bagファイルが見つかりません: {src}")
+        sys.exit(1)
+    if not bags:
+        print(f".bag ファイルがありません: {src}")
+        sys.exit(1)
+    if args.out_dir:
+        Path(os.path.expanduser(args.out_dir)).mkdir(parents=True, exist_ok=True)
+
+    def out_dir(bag):
+        return os.path.expanduser(args.out_dir) if args.out_dir else str(bag.parent)
+
+    print(f"変換開始: {len(bags)} ファイル  トラック: {', '.join(args.tracks)}"
+          f"  並列数: {min(args.workers, len(bags))}  エンコーダ: {describe_encoder(enc)}")
+    t0 = time.perf_counter()
+    failed = []
+    if args.workers <= 1 or len(bags) == 1:
+        for bag in bags:
+            try:
+                _print_summary(transcode(bag, out_dir(bag), args.tracks, cfg))
+            except RuntimeError as e:
+                failed.append((bag, e))
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(transcode, bag, out_dir(bag), args.tracks, cfg): bag
+                       for bag in bags}
+            for fut in as_completed(futures):
+                try:
+                    _print_summary(fut.result())
+                except RuntimeError as e:
+                    failed.append((futures[fut], e))
+
+    print(f"\n完了: {len(bags) - len(failed)} / {len(bags)} ファイル  ({time.perf_counter() - t0:.1f} 秒)")
+    for bag, e in failed:
+        print(f"  失敗: {bag.name}: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,9 @@ import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils import load_config, build_parser, apply_args, detect_camera, make_prefix, cam_code
+from preview import RecordingPreview
 
-_args = build_parser().parse_args()
+_args = build_parser(record_preview=True).parse_args()
 _cfg  = apply_args(load_config(), _args)
 
 W   = _cfg['camera']['width']
@@ -40,33 +41,33 @@ config.enable_record_to_file(bag_path)
 
 pipeline = rs.pipeline()
 profile = pipeline.start(config)
-print("録画中... 'q' を押すと終了します")
+preview = RecordingPreview('RealSense', mode=_args.preview)
+if preview.enabled:
+    print("録画中... 'q' を押すと終了します")
+else:
+    print("録画中（プレビューなし）... Ctrl+C で終了します")
 
-align_to = rs.stream.color
-align = rs.align(align_to)
 
 try:
     while True:
+        # depth はプレビューの表示にしか使わないので位置合わせしない
         frames = pipeline.wait_for_frames()
-        aligned_frames = align.process(frames)
-        color_frame = aligned_frames.get_color_frame()
-        depth_frame = aligned_frames.get_depth_frame()
+        if not preview.enabled:
+            continue   # 録画はデバイス側で行われるので、フレームは受け取るだけ
+        color_frame = frames.get_color_frame()
+        depth_frame = frames.get_depth_frame()
         if not depth_frame or not color_frame:
             continue
 
         color_image = np.asanyarray(color_frame.get_data())
-        depth_color_frame = rs.colorizer().colorize(depth_frame)
-        depth_color_image = np.asanyarray(depth_color_frame.get_data())
-
-        images = np.hstack((color_image, depth_color_image))
-        cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
-        cv2.imshow('RealSense', images)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if preview.show(color_image, depth_frame) == ord('q'):
             break
 
+except KeyboardInterrupt:
+    pass
+
 finally:
-    print("録画停止... 'q' が押されました。")
+    print("録画停止...")
     pipeline.stop()
     cv2.destroyAllWindows()
     print("ファイルの最終処理（インデックス書き込み）を実行中...")
@@ -6,8 +6,10 @@ import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils import load_config, build_parser, apply_args, detect_camera, make_prefix, cam_code
+from preview import RecordingPreview
+from video_writer import VideoTrackWriter, video_encoder, describe_encoder
 
-_args = build_parser().parse_args()
+_args = build_parser(record_preview=True, include_encoder=True).parse_args()
 _cfg  = apply_args(load_config(), _args)
 
 W   = _cfg['camera']['width']
@@ -21,71 +23,76 @@ except RuntimeError as e:
     exit(1)
 print(f"使用カメラ: {_cam['name']}  (シリアル: {_cam['serial']})")
 
+try:
+    _enc = video_encoder(_cfg)
+except (RuntimeError, ValueError) as e:
+    print(f"エラー: {e}")
+    exit(1)
+
 # 動画はショット連番を持たないため {cam}_{YYMMDD}_{HHMMSS}_{種別}.{ext} で命名する
 save_dir = os.path.expanduser(_cfg['output']['mp4_dir'])
 os.makedirs(save_dir, exist_ok=True)
 prefix   = make_prefix(cam_code(_cam['model']))
 
 bag_path = os.path.join(save_dir, f'{prefix}_stream.bag')
-mp4_path = os.path.join(save_dir, f'{prefix}_c.mp4')
+mp4_path = os.path.join(save_dir, f'{prefix}_c{_enc["ext"]}')
 
 config = rs.config()
 config.enable_stream(rs.stream.color, W, H, rs.format.bgr8, FPS)
 config.enable_stream(rs.stream.depth, W, H, rs.format.z16,  FPS)
 config.enable_record_to_file(bag_path)
 
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-video_writer = cv2.VideoWriter(mp4_path, fourcc, FPS, (W, H))
-if not video_writer.isOpened():
-    print(f"Failed to open VideoWriter for {mp4_path}")
-    exit(1)
-
 pipeline = rs.pipeline()
-align_to = rs.stream.color
-align = rs.align(align_to)
 
 print("--------------------------------------------------")
 print(f"  生データ (BAG)  -> {bag_path}")
 print(f"  カラー動画 (MP4) -> {mp4_path}")
 print(f"  ターゲットFPS: {FPS}")
+print(f"  エンコーダ: {describe_encoder(_enc)}")
 print("--------------------------------------------------")
 try:
     input(">>> 準備完了。Enterキーを押すと録画を開始します...")
 except KeyboardInterrupt:
     print("\nキャンセルされました。")
-    video_writer.release()
     sys.exit(0)
 
+# エンコードは書き出しスレッドで行い、このループはフレームを積むだけにする
+# block=False: エンコードが追いつかないときは動画のフレームを捨てる（取得側を止めない）
+video_writer = VideoTrackWriter(mp4_path, FPS, encoder=_enc, queue_size=FPS * 2, block=False)
 profile = pipeline.start(config)
-print("録画中... 'q' を押すと終了します")
+preview = RecordingPreview('RealSense', mode=_args.preview)
+if preview.enabled:
+    print("録画中... 'q' を押すと終了します")
+else:
+    print("録画中（プレビューなし）... Ctrl+C で終了します")
 
 try:
     while True:
+        # depth はプレビューの表示にしか使わないので位置合わせしない
         frames = pipeline.wait_for_frames()
-        aligned_frames = align.process(frames)
-        color_frame = aligned_frames.get_color_frame()
-        depth_frame = aligned_frames.get_depth_frame()
+        color_frame = frames.get_color_frame()
+        depth_frame = frames.get_depth_frame()
         if not depth_frame or not color_frame:
             continue
 
         color_image = np.asanyarray(color_frame.get_data())
-        video_writer.write(color_image)
-
-        depth_color_frame = rs.colorizer().colorize(depth_frame)
-        depth_color_image = np.asanyarray(depth_color_frame.get_data())
-
-        images = np.hstack((color_image, depth_color_image))
-        cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
-        cv2.imshow('RealSense', images)
+        video_writer.submit(color_image)
 
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if preview.show(color_image, depth_frame) == ord('q'):
             print("録画停止... 'q' が押されました。")
             break
 
+except KeyboardInterrupt:
+    print("録画停止... Ctrl+C が押されました。")
+
 finally:
     pipeline.stop()
-    video_writer.release()
-    print(f"MP4ファイルの書き込み完了: {mp4_path}")
+    video_writer.close()
+    _st = video_writer.stats()
+    if _st['error']:
+        print(f"動画の書き出しでエラーが発生しました: {_st['error']}")
+    print(f"MP4ファイルの書き込み完了: {mp4_path}  ({_st['frames']} フレーム,"
+          f" エンコード {_st['encode_sec']:.1f} 秒, エンコード待ちで破棄 {_st['dropped']} フレーム)")
     cv2.destroyAllWindows()
     print("生データ(.bag)の最終処理（インデックス書き込み）を実行中...")
     del pipeline
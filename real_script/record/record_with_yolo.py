@@ -1,14 +1,19 @@
 import pyrealsense2 as rs
-import numpy as np
 import cv2
 import os
 import sys
+import threading
 from pathlib import Path
 from ultralytics import YOLO
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from utils import load_config, build_parser, apply_args, detect_camera, make_prefix, cam_code
-
-_args = build_parser(include_model=True).parse_args()
+from utils import (load_config, build_parser, apply_args, detect_camera, start_pipeline,
+                   lossless_replay, make_prefix, cam_code)
+from capture import CaptureEngine, Consumer
+from preview import RecordingPreview
+from video_writer import VideoTrackWriter, video_encoder, describe_encoder
+
+_args = build_parser(include_model=True, record_preview=True, include_source=True,
+                     include_encoder=True).parse_args()
 _cfg  = apply_args(load_config(), _args)
 
 W   = _cfg['camera']['width']
@@ -31,20 +36,27 @@ except Exception as e:
     exit(1)
 
 try:
-    _cam = detect_camera()
+    _cam = detect_camera(_cfg)
 except RuntimeError as e:
     print(f"エラー: {e}")
     exit(1)
 print(f"使用カメラ: {_cam['name']}  (シリアル: {_cam['serial']})")
 _has_ir = (_cam['model'] != 'D405')
 
+try:
+    _enc = video_encoder(_cfg)
+except (RuntimeError, ValueError) as e:
+    print(f"エラー: {e}")
+    exit(1)
+
 # 動画はショット連番を持たないため {cam}_{YYMMDD}_{HHMMSS}_{種別}.{ext} で命名する
 save_dir = os.path.expanduser(_cfg['output']['mp4_dir'])
 os.makedirs(save_dir, exist_ok=True)
 prefix   = make_prefix(cam_code(_cam['model']))
 
-bag_path = os.path.join(save_dir, f'{prefix}_stream.bag')
-mp4_path = os.path.join(save_dir, f'{prefix}_det.mp4')
+# --source で .bag を再生するときは、入力がすでに生データなので .bag を書かない
+bag_path = None if _cfg['camera'].get('source') else os.path.join(save_dir, f'{prefix}_stream.bag')
+mp4_path = os.path.join(save_dir, f'{prefix}_det{_enc["ext"]}')
 
 config = rs.config()
 config.enable_stream(rs.stream.color, W, H, rs.format.bgr8, FPS)
@@ -52,65 +64,99 @@ config.enable_stream(rs.stream.depth, W, H, rs.format.z16,  FPS)
 if _has_ir:
     config.enable_stream(rs.stream.infrared, 1, W, H, rs.format.y8, FPS)
     config.enable_stream(rs.stream.infrared, 2, W, H, rs.format.y8, FPS)
-config.enable_record_to_file(bag_path)
-
-fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-video_writer = cv2.VideoWriter(mp4_path, fourcc, FPS, (W, H))
-if not video_writer.isOpened():
-    print(f"Failed to open VideoWriter for {mp4_path}")
-    exit(1)
+if bag_path:
+    config.enable_record_to_file(bag_path)
 
 pipeline = rs.pipeline()
-align_to = rs.stream.color
-align = rs.align(align_to)
+
+
+class _Detector(Consumer):
+    """YOLO 推論を行い検出動画に積む段。取得・プレビューとは別スレッドで動く。
+    推論はカメラの FPS に追いつかないので、待たせると取得スレッドが止まって librealsense 側で
+    フレームが落ちる（プレビューも止まる）。追いつかない分はここで捨て、破棄数は engine.report() に出す。
+    検出動画は推論できたフレームだけになる（全フレームは .bag に残る）。
+    エンコードは video_writer の書き出しスレッドで行うので、推論の時間には乗らない。"""
+
+    name = 'detector'
+    drop = True
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.latest     = None
+        self._lock      = threading.Lock()
+
+    def process(self, packet):
+        color_image = packet.color()
+        if color_image is None:
+            return
+        results = model(color_image, verbose=False)
+        annotated_frame = results[0].plot()
+        video_writer.submit(annotated_frame)
+        with self._lock:
+            self.latest = annotated_frame
+
+    def snapshot(self):
+        with self._lock:
+            return self.latest
+
 
 print("--------------------------------------------------")
 print(f"  モデル: {MODEL_PATH}")
-print(f"  生データ (BAG)  -> {bag_path}")
+print(f"  生データ (BAG)  -> {bag_path or '（--source 再生中のため書かない）'}")
 print(f"  検出動画 (MP4)  -> {mp4_path}")
+print(f"  エンコーダ: {describe_encoder(_enc)}")
 print("--------------------------------------------------")
 try:
     input(">>> 準備完了。Enterキーを押すと録画を開始します...")
 except KeyboardInterrupt:
     print("\nキャンセルされました。")
-    video_writer.release()
     sys.exit(0)
 
-profile = pipeline.start(config)
-print("録画中... 'q' を押すと終了します")
+# 録画中はエンコードが追いつかないとき動画のフレームを捨てる（取得側を止めない）。
+# --replay fast では再生が処理を待つので、推論段・動画とも捨てずに全フレームを通す
+_lossless = lossless_replay(_cfg)
+video_writer = VideoTrackWriter(mp4_path, FPS, encoder=_enc, queue_size=FPS * 2, block=_lossless)
+profile = start_pipeline(pipeline, config, _cfg, color_format=rs.format.bgr8, ir=_has_ir)
+engine   = CaptureEngine(pipeline, align='none', lossless=_lossless)   # depth はプレビューにしか使わない
+detector = engine.add(_Detector(queue_size=2))
+engine.start()
+preview = RecordingPreview('RealSense with YOLO', mode=_args.preview)
+if preview.enabled:
+    print("録画中... 'q' を押すと終了します")
+else:
+    print("録画中（プレビューなし）... Ctrl+C で終了します")
 
 try:
-    while True:
-        frames = pipeline.wait_for_frames()
-        aligned_frames = align.process(frames)
-        color_frame = aligned_frames.get_color_frame()
-        depth_frame = aligned_frames.get_depth_frame()
-        if not depth_frame or not color_frame:
+    packet = None
+    while engine.running:
+        packet = engine.latest(after=packet)
+        if packet is None or not preview.enabled:
+            continue
+        annotated_frame = detector.snapshot()
+        if annotated_frame is None:
             continue
 
-        color_image = np.asanyarray(color_frame.get_data())
-
-        results = model(color_image, verbose=False)
-        annotated_frame = results[0].plot()
-        video_writer.write(annotated_frame)
-
-        depth_color_frame = rs.colorizer().colorize(depth_frame)
-        depth_color_image = np.asanyarray(depth_color_frame.get_data())
-
-        images = np.hstack((annotated_frame, depth_color_image))
-        cv2.namedWindow('RealSense with YOLO', cv2.WINDOW_AUTOSIZE)
-        cv2.imshow('RealSense with YOLO', images)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if preview.show(annotated_frame, packet.frames.get_depth_frame()) == ord('q'):
             print("録画停止... 'q' が押されました。")
             break
 
+except KeyboardInterrupt:
+    print("録画停止... Ctrl+C が押されました。")
+
 finally:
+    engine.stop()
+    print(engine.report())
     pipeline.stop()
-    video_writer.release()
-    print(f"MP4ファイルの書き込み完了: {mp4_path}")
+    video_writer.close()
+    _st = video_writer.stats()
+    if _st['error']:
+        print(f"動画の書き出しでエラーが発生しました: {_st['error']}")
+    print(f"MP4ファイルの書き込み完了: {mp4_path}  ({_st['frames']} フレーム,"
+          f" エンコード {_st['encode_sec']:.1f} 秒, エンコード待ちで破棄 {_st['dropped']} フレーム)")
     cv2.destroyAllWindows()
-    print("生データ(.bag)の最終処理（インデックス書き込み）を実行中...")
+    if bag_path:
+        print("生データ(.bag)の最終処理（インデックス書き込み）を実行中...")
     del pipeline
-    print(f".bagファイルの書き込み完了: {bag_path}")
+    if bag_path:
+        print(f".bagファイルの書き込み完了: {bag_path}")
     print("すべての処理が完了しました。")
@@ -2,6 +2,7 @@ import yaml
 import argparse
 import json
 import os
+import threading
 from datetime import datetime
 from pathlib import Path
 
@@ -14,15 +15,31 @@ _CAMERA_MODELS = {
 }
 
 
-def detect_camera():
+def _model_from_name(name):
+    name_lower = name.lower()
+    for key, label in _CAMERA_MODELS.items():
+        if key in name_lower:
+            return label
+    return 'unknown'
+
+
+def detect_camera(cfg=None):
     """接続されている最初のRealSenseカメラを検出して返す。
 
+    cfg に --source（.bag）が設定されていれば、カメラの代わりに .bag に記録された
+    デバイス情報を返す（カメラが接続されていなくてよい）。
+
     Returns:
         dict: {'name': str, 'model': str, 'serial': str}
               model は 'D435' / 'D405' / 'unknown' のいずれか
     Raises:
         RuntimeError: デバイスが見つからない場合
     """
+    source = (cfg or {}).get('camera', {}).get('source')
+    if source:
+        info = bag_info(source)
+        return {'name': info['name'], 'model': info['model'], 'serial': info['serial']}
+
     import pyrealsense2 as rs
     ctx = rs.context()
     devices = ctx.query_devices()
@@ -32,15 +49,110 @@ def detect_camera():
     dev = devices[0]
     name   = dev.get_info(rs.camera_info.name)
     serial = dev.get_info(rs.camera_info.serial_number)
+    return {'name': name, 'model': _model_from_name(name), 'serial': serial}
 
-    model = 'unknown'
-    name_lower = name.lower()
-    for key, label in _CAMERA_MODELS.items():
-        if key in name_lower:
-            model = label
-            break
 
-    return {'name': name, 'model': model, 'serial': serial}
+def bag_info(path):
+    """.bag に記録されたデバイス情報とストリーム構成を返す。
+
+    Returns:
+        dict: {'name', 'model', 'serial',
+               'streams': {'color' / 'depth' / 'infrared1' ...: (width, height, fps)}}
+    Raises:
+        RuntimeError: ファイルが無い・読めない場合
+    """
+    import pyrealsense2 as rs
+    path = os.path.expanduser(str(path))
+    if not os.path.exists(path):
+        raise RuntimeError(f".bag ファイルが見つかりません: {path}")
+    ctx = rs.context()
+    dev = ctx.load_device(path)
+    try:
+        def info(key, default):
+            return dev.get_info(key) if dev.supports(key) else default
+        name   = info(rs.camera_info.name, Path(path).stem)
+        serial = info(rs.camera_info.serial_number, 'bag')
+        streams = {}
+        for sensor in dev.query_sensors():
+            for prof in sensor.get_stream_profiles():
+                if not prof.is_video_stream_profile():
+                    continue
+                v   = prof.as_video_stream_profile()
+                key = prof.stream_name().lower().replace(' ', '')   # 'Infrared 1' → 'infrared1'
+                streams[key] = (v.width(), v.height(), prof.fps())
+    finally:
+        ctx.unload_device(path)
+    return {'name': name, 'model': _model_from_name(name), 'serial': serial, 'streams': streams}
+
+
+def start_pipeline(pipeline, rs_config, cfg, color_format=None, ir=False):
+    """pipeline.start() の代わりに使う。--source があればカメラの代わりに .bag を再生する。
+
+    replay='realtime' : 記録時と同じ速さで再生（処理が遅いとフレームが落ちる。実機と同じ条件）
+    replay='fast'     : set_real_time(False)。処理が終わるまで次のフレームを待つので
+                        処理が速ければ記録時より速く進む（ベンチマーク・回帰テスト向け）。
+                        CaptureEngine / VideoTrackWriter は lossless_replay(cfg) を渡したときだけ
+                        捨てずに待つ（渡さなければ drop=True の段は従来どおり捨てる）
+
+    .bag に要求どおりのストリーム（解像度・形式）が無い場合は、記録されている全ストリームで開き直す。
+    そのときは color の形式が color_format（rs.format。扱える形式が複数ならそのタプル）に含まれるか、
+    ir=True なら IR が記録されているかを確かめて警告する。IR を使うスクリプトは戻り値を has_stream() で確かめてから IR を扱うこと。
+    """
+    import pyrealsense2 as rs
+    source = cfg['camera'].get('source')
+    if not source:
+        return pipeline.start(rs_config)
+    rs_config.enable_device_from_file(os.path.expanduser(source), repeat_playback=False)
+    try:
+        profile = pipeline.start(rs_config)
+    except RuntimeError as e:
+        print(f"[警告] .bag のストリームが要求と一致しません（{e}）。記録されている全ストリームで再生します")
+        rs_config.disable_all_streams()
+        rs_config.enable_all_streams()
+        profile = pipeline.start(rs_config)
+        _warn_playback_streams(profile, color_format, ir)
+    playback = profile.get_device().as_playback()
+    playback.set_real_time(cfg['camera'].get('replay', 'realtime') == 'realtime')
+    return profile
+
+
+def lossless_replay(cfg):
+    """--source + --replay fast か。True なら処理段・動画ライタもフレームを捨てずに待たせる。"""
+    return bool(cfg['camera'].get('source')) and cfg['camera'].get('replay') == 'fast'
+
+
+def has_stream(profile, stream, index=-1):
+    """profile（pipeline_profile）で stream が有効か。index=-1 なら番号を問わない。"""
+    return any(s.stream_type() == stream and index in (-1, s.stream_index())
+               for s in profile.get_streams())
+
+
+def _warn_playback_streams(profile, color_format, ir):
+    import pyrealsense2 as rs
+    color = [s for s in profile.get_streams() if s.stream_type() == rs.stream.color]
+    if color_format is not None:
+        accepted = color_format if isinstance(color_format, (tuple, list)) else (color_format,)
+        if not color:
+            print("[警告] .bag に color ストリームがありません")
+        elif color[0].format() not in accepted:
+            swapped = {color[0].format(), *accepted} == {rs.format.rgb8, rs.format.bgr8}
+            print(f"[警告] .bag の color は {color[0].format()} で記録されています"
+                  f"（このスクリプトは {' / '.join(map(str, accepted))} を想定）。"
+                  + ("R と B が入れ替わって処理・保存されます" if swapped else "正しく処理できません"))
+    if ir and not has_stream(profile, rs.stream.infrared):
+        print("[警告] .bag に IR ストリームがありません。IR の保存・表示を行いません")
+
+
+def playback_finished(pipeline):
+    """--source の .bag を最後まで再生し終えたか（wait_for_frames のタイムアウトの理由判定用）。"""
+    import pyrealsense2 as rs
+    try:
+        dev = pipeline.get_active_profile().get_device()
+    except RuntimeError:
+        return False
+    if not dev.is_playback():
+        return False
+    return dev.as_playback().current_status() == rs.playback_status.stopped
 
 
 def get_depth_alpha(cfg, model):
@@ -70,15 +182,122 @@ def make_depth_colormap(depth_image, alpha):
     return cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=alpha), cv2.COLORMAP_JET)
 
 
+class DepthColormapper:
+    """make_depth_colormap の高速版。uint16 → BGR の 65536 要素ルックアップテーブルを使う。
+
+    alpha=float : convertScaleAbs → applyColorMap と同じ結果の LUT を起動時に 1 回作る
+    alpha=None  : 有効画素の範囲 [lo, hi] を求め、範囲が変わったときだけ LUT の
+                  lo〜hi 部分を作り直す。update_every=N なら範囲の更新は N フレームに 1 回。
+                  percentile=(0, 100) なら make_depth_colormap と同じ（最小〜最大）結果になり、
+                  それ以外はヒストグラムから外れ値を除いた範囲を使う。
+
+    LUT は BGRA を uint32 に詰めて持ち、np.take 1 回 + cvtColor 1 回で変換する。
+    out= に確保済みの配列（プレビューのタイルなど）を渡すと新しい配列を作らない。
+    作業用バッファはスレッドごとに持つので、1 つのインスタンスを複数の段で共有してよい。
+    """
+
+    def __init__(self, alpha, update_every=1, percentile=(0, 100)):
+        import cv2
+        import numpy as np
+        self.alpha        = alpha
+        self.update_every = max(1, int(update_every))
+        self.percentile   = tuple(percentile)
+        self._count       = 0
+        self._range       = None
+        self._local       = threading.local()
+
+        jet = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1),
+                                cv2.COLORMAP_JET).reshape(256, 3)
+        jet4 = np.zeros((256, 4), dtype=np.uint8)
+        jet4[:, :3] = jet
+        self._jet32 = jet4.view(np.uint32).ravel()
+        if alpha is None:
+            self.lut = np.zeros(65536, dtype=np.uint32)
+        else:
+            scaled = cv2.convertScaleAbs(np.arange(65536, dtype=np.uint16).reshape(1, -1),
+                                         alpha=alpha).ravel()
+            self.lut = self._jet32[scaled]
+
+    def _find_range(self, depth_image):
+        import cv2
+        import numpy as np
+        if self.percentile == (0, 100):
+            valid = depth_image > 0
+            if not valid.any():
+                return None
+            lo, hi, _, _ = cv2.minMaxLoc(depth_image, mask=valid.view(np.uint8))
+            return int(lo), int(hi)
+        hist = np.bincount(depth_image.ravel(), minlength=65536)
+        hist[0] = 0
+        cdf   = np.cumsum(hist)
+        total = cdf[-1]
+        if total == 0:
+            return None
+        lo_pct, hi_pct = self.percentile
+        lo = np.searchsorted(cdf, total * lo_pct / 100, side='right')
+        hi = np.searchsorted(cdf, total * hi_pct / 100, side='left')
+        return int(lo), int(max(hi, lo))
+
+    def _update_range(self, depth_image):
+        import numpy as np
+        rng = self._find_range(depth_image)
+        if rng == self._range:
+            return
+        lut = np.zeros(65536, dtype=np.uint32)
+        if rng is not None:
+            # make_depth_colormap と同じ式。lo 未満は 0、hi 超は 255 に飽和する
+            # （lo, hi は Python int。uint16 のままだと hi = 65535 で hi + 1 が 0 に戻る）
+            lo, hi = rng
+            v = np.arange(lo, hi + 1, dtype=np.float32)
+            normed = np.clip((v - lo) / np.float64(hi - lo + 1e-6) * 255, 0, 255).astype(np.uint8)
+            lut[:lo]        = self._jet32[0]
+            lut[lo:hi + 1]  = self._jet32[normed]
+            lut[hi + 1:]    = self._jet32[255]
+        # 別スレッドの apply() から見て LUT と範囲が食い違わないよう、作ってから差し替える
+        self.lut, self._range = lut, rng
+
+    def _scratch(self, shape):
+        import numpy as np
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or buf.shape != shape:
+            buf = self._local.buf = np.empty(shape, dtype=np.uint32)
+        return buf
+
+    def apply(self, depth_image, out=None):
+        """depth_image (uint16) → BGR uint8。out を渡すとそこへ書き込んで返す。"""
+        import cv2
+        import numpy as np
+        if self.alpha is None:
+            if self._count % self.update_every == 0:
+                self._update_range(depth_image)
+            self._count += 1
+        h, w = depth_image.shape
+        packed = self._scratch((h, w))
+        np.take(self.lut, depth_image, out=packed, mode='clip')
+        if out is None:
+            out = np.empty((h, w, 3), dtype=np.uint8)
+        cv2.cvtColor(packed.view(np.uint8).reshape(h, w, 4), cv2.COLOR_BGRA2BGR, dst=out)
+        return out
+
+
+def depth_colormapper(cfg, alpha):
+    """config.yaml の camera.depth_relative を反映した DepthColormapper を返す。"""
+    rel = cfg['camera'].get('depth_relative') or {}
+    return DepthColormapper(alpha, update_every=rel.get('update_every', 1),
+                            percentile=rel.get('percentile', (0, 100)))
+
+
 def load_config():
     with open(_CFG_PATH) as f:
         return yaml.safe_load(f)
 
 
-def build_parser(include_model=False, include_conf=False, bag_input=False):
+def build_parser(include_model=False, include_conf=False, bag_input=False, include_preview=False,
+                 record_preview=False, include_pc_format=False, include_source=False,
+                 include_encoder=False):
     parser = argparse.ArgumentParser()
     if bag_input:
-        parser.add_argument('bag_path', help='.bagファイルのパス')
+        parser.add_argument('bag_path', help='.bagファイル（またはそれを含むディレクトリ）のパス')
     parser.add_argument('--fps',    type=int,   default=None, metavar='N',
                         help='FPS（config.yamlの値を上書き）')
     parser.add_argument('--width',  type=int,   default=None, metavar='N',
@@ -88,12 +307,40 @@ def build_parser(include_model=False, include_conf=False, bag_input=False):
     parser.add_argument('--tag',    type=str,   default=None, metavar='NAME',
                         help='セッションディレクトリ名に付ける任意タグ 例: greenhouse'
                              '（ファイル名には付かない）')
+    if include_source:
+        parser.add_argument('--source', type=str, default=None, metavar='FILE.bag',
+                            help='カメラの代わりに .bag を再生する（解像度・FPS は .bag の color に合わせる）')
+        parser.add_argument('--replay', choices=['realtime', 'fast'], default='realtime',
+                            help='--source の再生速度  realtime: 記録時と同じ | fast: 取りこぼしなしで最速')
     if include_model:
         parser.add_argument('--model', type=str, default=None, metavar='PATH',
                             help='モデルパス（config.yamlの値を上書き）')
     if include_conf:
         parser.add_argument('--conf',  type=float, default=None, metavar='F',
                             help='信頼度閾値（config.yamlの値を上書き）')
+    if include_preview:
+        parser.add_argument('--preview-every', type=int, default=None, dest='preview_every',
+                            metavar='N',
+                            help='プレビューを N フレームに1回だけ描画（config.yamlの値を上書き）')
+    if record_preview:
+        parser.add_argument('--preview', choices=['full', 'color', 'none'], default='full',
+                            help='録画中のプレビュー  full: color+深度 | color: 深度の描画なし'
+                                 ' | none: ウィンドウなし（Ctrl+C で停止。CPU を録画に回す）')
+    if include_pc_format:
+        parser.add_argument('--pc-format', choices=['ply', 'npz'], default=None, dest='pc_format',
+                            help='点群の保存形式  ply: export_to_ply | npz: 有効点のみの float32'
+                                 '（config.yamlの値を上書き）')
+    if include_encoder:
+        parser.add_argument('--encoder', choices=['opencv', 'ffmpeg'], default=None,
+                            help='動画エンコーダ  opencv: mp4v | ffmpeg: libx264 / libx265'
+                                 '（config.yamlの値を上書き）')
+        parser.add_argument('--codec', choices=['libx264', 'libx265'], default=None,
+                            help='--encoder ffmpeg のコーデック（config.yamlの値を上書き）')
+        parser.add_argument('--crf', type=int, default=None, metavar='N',
+                            help='--encoder ffmpeg の CRF（小さいほど高画質。config.yamlの値を上書き）')
+        parser.add_argument('--preset', type=str, default=None, metavar='NAME',
+                            help='--encoder ffmpeg のプリセット ultrafast〜veryslow'
+                                 '（遅いほど小さい。config.yamlの値を上書き）')
     return parser
 
 
@@ -105,6 +352,26 @@ def apply_args(cfg, args, model_key='yolo_path'):
         cfg['model'][model_key] = args.model
     if hasattr(args, 'conf') and args.conf is not None:
         cfg['model']['confidence_threshold'] = args.conf
+    if getattr(args, 'preview_every', None) is not None:
+        cfg.setdefault('preview', {})['every'] = args.preview_every
+    if getattr(args, 'pc_format', None) is not None:
+        cfg['pointcloud']['format'] = args.pc_format
+    for key in ('encoder', 'codec', 'crf', 'preset'):
+        if getattr(args, key, None) is not None:
+            cfg.setdefault('video', {})[key] = getattr(args, key)
+    if getattr(args, 'source', None):
+        cfg['camera']['source'] = args.source
+        cfg['camera']['replay'] = args.replay
+        # 解像度・FPS は .bag の color（無ければ depth）に合わせる。明示した値はそのまま
+        try:
+            streams = bag_info(args.source)['streams']
+        except RuntimeError:
+            streams = {}   # ファイルが無い等は detect_camera() がエラーを出す
+        recorded = streams.get('color') or streams.get('depth')
+        if recorded:
+            for key, value in zip(('width', 'height', 'fps'), recorded):
+                if getattr(args, key) is None:
+                    cfg['camera'][key] = value
     return cfg
 
 
@@ -179,6 +446,8 @@ class Session:
         self.time   = self.started_at.strftime('%H%M%S')
         self.prefix = make_prefix(cam, self.started_at)
 
+        self.writer = None
+
         dir_name = f"{self.prefix}_{tag}" if tag else self.prefix
         self.dir = Path(os.path.expanduser(str(base_dir))) / self.date / dir_name
         self.dir.mkdir(parents=True, exist_ok=True)
@@ -204,8 +473,37 @@ class Session:
         """連番を持たないセッション単位のファイル（動画など）のフルパスを返す。"""
         return str(self.dir / f"{self.prefix}_{suffix}.{ext}")
 
+    def start_writer(self, workers=2, queue_size=32, policy='block'):
+        """非同期ライタ（frame_writer.FrameWriter）を起動して返す。
+        以降 save() はキャプチャスレッドで imwrite せずキューに積むだけになる。"""
+        from frame_writer import FrameWriter
+        self.writer = FrameWriter(workers=workers, queue_size=queue_size, policy=policy)
+        return self.writer
+
+    def save(self, idx, images, sub=True):
+        """1 ショット分の画像を保存する。images は {modality: image} または
+        {(modality, ext): image}。ライタ起動中は非同期、未起動なら同期で書く。
+
+        Returns:
+            bool: 保存（または投入）できたか。ライタが満杯で捨てた場合は False
+        """
+        writes = {}
+        for key, img in images.items():
+            modality, ext = key if isinstance(key, tuple) else (key, 'jpg')
+            writes[self.path(idx, modality, ext=ext, sub=sub)] = img
+        if self.writer is not None:
+            return self.writer.submit(writes)
+        import cv2
+        return all([cv2.imwrite(path, img) for path, img in writes.items()])
+
+    def close_writer(self):
+        """ライタのキューを書き切ってから停止する。write_metadata より前に呼ぶこと。"""
+        if self.writer is not None:
+            self.writer.close()
+
     def write_metadata(self, **info):
-        """metadata.json を書き出す。撮影条件など、ファイル名に載せない情報はここに。"""
+        """metadata.json を書き出す。撮影条件など、ファイル名に載せない情報はここに。
+        非同期ライタを使ったセッションでは、その統計も 'writer' に記録する。"""
         meta = {
             'session_id': self.prefix,
             'camera_code': self.cam,
@@ -213,6 +511,9 @@ class Session:
             'tag': self.tag,
             'naming': '{cam}_{YYMMDD}_{HHMMSS}_{NNNNN}_{mod}.{ext}',
         }
+        if self.writer is not None:
+            self.close_writer()
+            meta['writer'] = self.writer.stats()
         meta.update(info)
         with open(self.dir / 'metadata.json', 'w') as f:
             json.dump(meta, f, indent=2, ensure_ascii=False)
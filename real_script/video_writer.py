@@ -0,0 +1,245 @@
+"""動画 1 本の書き出しを専用スレッドで行うライタと、そのエンコーダ（バックエンド）。
+
+cv2.VideoWriter.write はエンコードを含むので、フレームを取り出すループと同じスレッドで
+呼ぶとエンコード時間がそのまま 1 フレームの処理時間に乗る。VideoTrackWriter は
+フレームを有界キューに積むだけにして、エンコードはトラックごとのスレッドで行う
+（OpenCV のエンコードや ffmpeg へのパイプ書き込みは GIL を解放するので、複数トラックが並列に進む）。
+
+    enc    = video_encoder(cfg)                  # config.yaml の video セクション
+    writer = VideoTrackWriter(f'out{enc["ext"]}', fps=30, encoder=enc)
+    writer.submit(image)        # 取り出し側は積むだけ（満杯なら空くまで待つ。コマ落ちなし）
+                                # block=False ならキュー満杯のフレームは捨てて数える（録画ループ向け）
+    ...
+    writer.close()              # 残りを書き切ってからファイルを閉じる
+
+バックエンド:
+    opencv : cv2.VideoWriter（mp4v）。追加の依存なし
+    ffmpeg : ffmpeg コマンドに生フレームをパイプで渡す。libx264 / libx265（preset・CRF 指定）は
+             mp4v より同じ画質でずっと小さい。ffv1 は可逆で 16bit 深度（z16）をそのまま残せる（.mkv）
+
+フレームサイズと color / グレースケール / 16bit は最初のフレームから決める。
+"""
+
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+_STOP = object()
+_NO_FFMPEG = ("ffmpeg が見つかりません（apt install ffmpeg）。"
+              "config.yaml の video.encoder を opencv にすると ffmpeg なしで書けます")
+
+# ffmpeg の出力コーデック → (出力 pix_fmt, 拡張子)。pix_fmt が None なら入力のまま（可逆）
+_FFMPEG_CODECS = {
+    'libx264': ('yuv420p', '.mp4'),
+    'libx265': ('yuv420p', '.mp4'),
+    'ffv1':    (None,      '.mkv'),
+}
+
+
+def video_encoder(cfg, kind='color'):
+    """config.yaml の video セクションからエンコーダ設定 dict を作る。
+
+    kind='depth' は 16bit 深度の生データ用で、常に ffmpeg + video.depth_codec（既定 ffv1）。
+    戻り値の 'ext' を出力ファイルの拡張子に使う。
+    """
+    v = cfg.get('video') or {}
+    if kind != 'depth' and v.get('encoder', 'opencv') == 'opencv':
+        return {'backend': 'opencv', 'fourcc': v.get('fourcc', 'mp4v'), 'ext': '.mp4'}
+    codec = v.get('depth_codec', 'ffv1') if kind == 'depth' else v.get('codec', 'libx264')
+    if codec not in _FFMPEG_CODECS:
+        raise ValueError(f"未対応のコーデックです: {codec}（{' / '.join(_FFMPEG_CODECS)}）")
+    if shutil.which('ffmpeg') is None:   # 録画を始めてから失敗しないよう先に確かめる
+        raise RuntimeError(_NO_FFMPEG)
+    if kind == 'depth':
+        return {'backend': 'ffmpeg', 'codec': codec, 'ext': _FFMPEG_CODECS[codec][1]}
+    return {'backend': 'ffmpeg', 'codec': codec, 'preset': v.get('preset', 'veryfast'),
+            'crf': v.get('crf', 23), 'ext': _FFMPEG_CODECS[codec][1]}
+
+
+def describe_encoder(encoder):
+    """表示用の短い説明。例: 'ffmpeg libx264 (preset=veryfast, crf=23)'"""
+    if encoder['backend'] == 'opencv':
+        return f"opencv {encoder.get('fourcc', 'mp4v')}"
+    opts = [f"{k}={encoder[k]}" for k in ('preset', 'crf') if encoder.get(k) is not None]
+    return f"ffmpeg {encoder['codec']}" + (f" ({', '.join(opts)})" if opts else '')
+
+
+class _OpenCVBackend:
+    """cv2.VideoWriter。color / グレースケール（8bit）のみ。"""
+
+    def __init__(self, path, fps, image, fourcc='mp4v'):
+        import cv2
+        if image.dtype != 'uint8':
+            raise RuntimeError(f"opencv バックエンドは 8bit 画像のみ書けます（{image.dtype}）: {path}")
+        h, w = image.shape[:2]
+        self._writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (w, h),
+                                       image.ndim == 3)
+        if not self._writer.isOpened():
+            raise RuntimeError(f"VideoWriter を開けません: {path}")
+
+    def write(self, image):
+        self._writer.write(image)
+
+    def close(self):
+        self._writer.release()
+
+
+class _FFmpegBackend:
+    """ffmpeg の子プロセスに rawvideo を標準入力で渡す。"""
+
+    def __init__(self, path, fps, image, codec='libx264', preset=None, crf=None):
+        exe = shutil.which('ffmpeg')
+        if exe is None:
+            raise RuntimeError(_NO_FFMPEG)
+        h, w = image.shape[:2]
+        if image.ndim == 3:
+            pix_in = 'bgr24'
+        elif image.dtype == 'uint16':
+            pix_in = 'gray16le'
+        else:
+            pix_in = 'gray'
+        pix_out, _ = _FFMPEG_CODECS.get(codec, ('yuv420p', None))
+
+        cmd = [exe, '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 'rawvideo', '-pix_fmt', pix_in, '-s', f'{w}x{h}', '-r', str(fps), '-i', '-',
+               '-c:v', codec]
+        if preset is not None:
+            cmd += ['-preset', str(preset)]
+        if crf is not None:
+            cmd += ['-crf', str(crf)]
+        if codec == 'ffv1':
+            cmd += ['-level', '3', '-g', '1']   # 全フレームキーフレーム（途中から読める）
+        if codec == 'libx265':
+            cmd += ['-tag:v', 'hvc1']           # QuickTime 等で再生できるように
+        if pix_out is not None:
+            cmd += ['-pix_fmt', pix_out]
+        cmd.append(path)
+
+        self.path  = path
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, image):
+        try:
+            self._proc.stdin.write(memoryview(image).cast('B'))
+        except BrokenPipeError:
+            raise RuntimeError(f"ffmpeg が終了しました: {self._stderr()}") from None
+
+    def _stderr(self):
+        self._proc.wait()
+        return self._proc.stderr.read().decode(errors='replace').strip()
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        err = self._stderr()
+        if self._proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg がエラー終了しました（{self._proc.returncode}）: {err}")
+
+
+def _open_backend(path, fps, image, encoder):
+    encoder = dict(encoder or {'backend': 'opencv'})
+    encoder.pop('ext', None)
+    backend = encoder.pop('backend')
+    if backend == 'opencv':
+        return _OpenCVBackend(path, fps, image, **encoder)
+    if backend == 'ffmpeg':
+        return _FFmpegBackend(path, fps, image, **encoder)
+    raise ValueError(f"未対応のエンコーダです: {backend}（opencv / ffmpeg）")
+
+
+class VideoTrackWriter:
+    """有界キュー + 書き出しスレッド 1 本。フレームは submit() の順に書かれる。
+
+    encoder は video_encoder() の戻り値（省略時は opencv / mp4v）。
+    block=True  : キューが満杯なら submit() が空くまで待つ（変換向け。コマ落ちなし）
+    block=False : キューが満杯なら submit() はそのフレームを捨てて dropped に数える。
+                  遅いプリセットでもカメラの取得側を止めない（録画向け）
+    """
+
+    def __init__(self, path, fps, encoder=None, queue_size=64, block=True):
+        self.path    = str(path)
+        self.fps     = fps
+        self.encoder = encoder
+        self.block   = block
+        self._queue  = queue.Queue(maxsize=max(1, queue_size))
+        self._writer = None
+        self._closed = False
+
+        # 統計（stats() で参照）
+        self.submitted   = 0
+        self.written     = 0
+        self.encode_sec  = 0.0   # 書き出しスレッドが write に費やした時間
+        self.blocked_sec = 0.0   # キュー満杯で submit が待たされた時間
+        self.dropped     = 0     # block=False でキュー満杯のため捨てたフレーム数
+        self.error       = None
+
+        self._thread = threading.Thread(target=self._run, name='video-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        """1 フレーム積む。pyrealsense2 のバッファを指す配列や非連続な配列はここでコピーする。"""
+        if self._closed:
+            raise RuntimeError("VideoTrackWriter は既に close されています")
+        if not self.block and self._queue.full():
+            self.dropped += 1   # コピーする前に捨てる
+            return
+        if image.flags.owndata and image.flags.c_contiguous:
+            item = image
+        else:
+            item = image.copy()
+        t0 = time.perf_counter()
+        try:
+            self._queue.put(item, block=self.block)
+        except queue.Full:
+            self.dropped += 1
+            return
+        finally:
+            self.blocked_sec += time.perf_counter() - t0
+        self.submitted   += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if self.error is not None:
+                    continue   # 開けなかった場合は残りを読み捨てる（submit 側を止めない）
+                t0 = time.perf_counter()
+                try:
+                    if self._writer is None:
+                        self._writer = _open_backend(self.path, self.fps, item, self.encoder)
+                    self._writer.write(item)
+                    self.written += 1
+                except Exception as e:
+                    self.error = e
+                self.encode_sec += time.perf_counter() - t0
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """キューに残ったフレームをすべて書き出してからファイルを閉じる。"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception as e:
+                self.error = self.error or e
+
+    def stats(self):
+        return {
+            'path':        self.path,
+            'frames':      self.written,
+            'encode_sec':  round(self.encode_sec, 3),
+            'blocked_sec': round(self.blocked_sec, 3),
+            'dropped':     self.dropped,
+            'error':       str(self.error) if self.error else None,
+        }
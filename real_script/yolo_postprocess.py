@@ -0,0 +1,101 @@
+"""YOLO（v8 / v11 形式）の生出力を検出結果に変換する後処理。
+
+OpenVINO などで ultralytics を通さずに推論したときの出力
+    (1, 4 + nc, A)   4 = cx, cy, w, h（入力画像のピクセル座標）、nc = クラス数、A = アンカー数
+を NumPy だけで一括処理する。Python のループはアンカーに対しては回さない。
+
+    1. クラススコアの最大値で閾値マスク
+    2. cxcywh → xyxy
+    3. 入力解像度 → 元画像の解像度へ座標を変換
+    4. クラスごとの NMS
+
+結果は (N, 6) の float32 配列 [x1, y1, x2, y2, conf, cls]（信頼度の降順）。
+ライブ推論（vino_yolo_detection_D435.py）からもバッチ処理・ベンチマークからも使う。
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+_EMPTY = np.zeros((0, 6), dtype=np.float32)
+
+
+def nms(boxes, scores, iou_threshold, max_det=300):
+    """xyxy の boxes に対する NMS。残す要素のインデックスを信頼度の降順で返す。"""
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size and len(keep) < max_det:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+        h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.asarray(keep, dtype=np.intp)
+
+
+def decode_yolo_output(output, conf_threshold=0.3, iou_threshold=0.45,
+                       input_size=None, orig_size=None, max_det=300):
+    """YOLO の生出力 → (N, 6) [x1, y1, x2, y2, conf, cls]。
+
+    input_size : モデル入力の (width, height)
+    orig_size  : 描画先の元画像の (width, height)。両方指定すると座標を元画像へ変換する
+    """
+    out = np.asarray(output)
+    if out.ndim == 3:
+        out = out[0]
+    if out.shape[0] < out.shape[1]:     # (4 + nc, A) → (A, 4 + nc)
+        out = out.T
+
+    scores_all = out[:, 4:]
+    if scores_all.shape[1] == 1:
+        scores = scores_all[:, 0]
+        cls    = np.zeros(len(out), dtype=np.float32)
+    else:
+        cls    = scores_all.argmax(axis=1)
+        scores = scores_all[np.arange(len(out)), cls]
+
+    mask = scores >= conf_threshold
+    if not mask.any():
+        return _EMPTY
+    xywh   = out[mask, :4]
+    scores = scores[mask]
+    cls    = cls[mask].astype(np.float32)
+
+    boxes = np.empty_like(xywh)
+    half  = xywh[:, 2:4] / 2
+    boxes[:, 0:2] = xywh[:, 0:2] - half
+    boxes[:, 2:4] = xywh[:, 0:2] + half
+
+    if input_size is not None and orig_size is not None:
+        sx = orig_size[0] / input_size[0]
+        sy = orig_size[1] / input_size[1]
+        boxes *= np.array([sx, sy, sx, sy], dtype=boxes.dtype)
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, orig_size[0])
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, orig_size[1])
+
+    # クラスごとの NMS を 1 回で済ませるため、クラス番号に応じて箱をずらして重ならなくする
+    offset = cls[:, None] * (boxes.max() + 1)
+    keep = nms(boxes + offset, scores, iou_threshold, max_det)
+
+    return np.concatenate([boxes[keep], scores[keep, None], cls[keep, None]],
+                          axis=1).astype(np.float32)
+
+
+def load_class_names(model_path):
+    """ultralytics の export が置く metadata.yaml からクラス名を読む。無ければ None。"""
+    meta = Path(model_path).parent / 'metadata.yaml'
+    if not meta.exists():
+        return None
+    import yaml
+    with open(meta) as f:
+        names = (yaml.safe_load(f) or {}).get('names')
+    if isinstance(names, dict):
+        return {int(k): v for k, v in names.items()}
+    if isinstance(names, list):
+        return dict(enumerate(names))
+    return None